@@ -8,8 +8,9 @@
 # 
 #
 import streamlit as st
-from internal_db import get_process_status, delete_process_status
-from gen_sql import generate_thinking_agent_response
+from internal_db import list_runs, get_run
+from progress_bus import PROGRESS_BUS, reset_progress
+from job_queue import submit_job
 from streamlit_autorefresh import st_autorefresh
 from streamlit_extras.stylable_container import stylable_container
 import streamlit.components.v1 as components
@@ -335,25 +336,16 @@ def check_data(value):
     except Exception as e:
         return False
 
-def load_progress_data():
-    #print("DEBUG: read from DB")
-    results = get_process_status(st.session_state.user_name)
-
-    if results is None:
-        st.session_state.show_question_interface = True
-        return
-    else:
-        st.session_state.show_question_interface = False
-       # print(f"\n\nDEBUG: process status\n\n{results}")
-
-
+def load_user_question_progress(results):
     if results.get('user_question'):
         st.session_state.user_question_status = True
         st.session_state.user_question = f"<span class='muted-element'>{results.get('user_question')}</span>"
     else:
         st.session_state.user_question_status = False
         st.session_state.user_question = ""
- 
+
+
+def load_cleaned_question_progress(results):
     if check_data(results.get('cleaned_question')):
         all_data = json.loads(results.get('cleaned_question'))
         st.session_state.cleaned_question_status = True
@@ -373,8 +365,8 @@ def load_progress_data():
         st.session_state.cleaned_question = ""
         st.session_state.invalid_question = False
 
-   
-   
+
+def load_tables_progress(results):
     if check_data(results.get('tables') ):
         all_data = json.loads(results.get('tables'))
         st.session_state.tables_status = True
@@ -385,7 +377,9 @@ def load_progress_data():
     else:
         st.session_state.tables_status = False
         st.session_state.tables = ""
-    
+
+
+def load_joins_progress(results):
     if results.get('joins') is not None:
     #if check_data(results.get('joins')):
         st.session_state.join_status = True
@@ -402,6 +396,8 @@ def load_progress_data():
         st.session_state.join_status =False
         st.session_state.joins =""
 
+
+def load_grouping_progress(results):
     if check_data(results.get('grouping')):
         st.session_state.grouping_status = True
         all_data = json.loads(results.get('grouping'))
@@ -419,7 +415,9 @@ def load_progress_data():
     else:
         st.session_state.grouping_status = False
         st.session_state.grouping = ""
-   
+
+
+def load_calculations_progress(results):
     if check_data(results.get('calculations')):
         st.session_state.calculations_status = True
         all_data = json.loads(results.get('calculations'))
@@ -436,7 +434,9 @@ def load_progress_data():
     else:
         st.session_state.calculations_status = False
         st.session_state.calculations = ""
-   
+
+
+def load_filtering_progress(results):
     if check_data(results.get('filtering')):
         st.session_state.filtering_status = True
         all_data = json.loads(results.get('filtering'))
@@ -454,14 +454,108 @@ def load_progress_data():
         st.session_state.filtering_status = False
         st.session_state.filtering = ""
 
+
+def load_sql_progress(results):
     if results.get('sql'):
         st.session_state.sql_status = True
+        st.session_state.sql_streaming = False
         sql = results.get('sql')
         st.session_state.sql = sql
 
+    elif results.get('sql_draft'):
+        # steps 8/9 are still generating, show the partial SQL streamed so far
+        st.session_state.sql_status = False
+        st.session_state.sql_streaming = True
+        st.session_state.sql = results.get('sql_draft')
+
     else:
         st.session_state.sql_status = False
+        st.session_state.sql_streaming = False
         st.session_state.sql = ""
+
+
+
+# Which loader to run when a progress field changes
+PROGRESS_FIELD_LOADERS = {
+    'user_question': load_user_question_progress,
+    'cleaned_question': load_cleaned_question_progress,
+    'tables': load_tables_progress,
+    'joins': load_joins_progress,
+    'grouping': load_grouping_progress,
+    'calculations': load_calculations_progress,
+    'filtering': load_filtering_progress,
+    'sql': load_sql_progress,
+    'sql_draft': load_sql_progress,
+}
+
+
+def get_current_run_id():
+    """
+    The run shown on the status page: the one picked in the run selector, or the user's newest run.
+    """
+    runs = list_runs(st.session_state.user_name)
+    st.session_state.runs = runs
+    run_ids = [run['run_id'] for run in runs]
+    if st.session_state.get('run_id') not in run_ids:
+        st.session_state.run_id = run_ids[0] if run_ids else None
+    return st.session_state.run_id
+
+
+def format_run_label(run_id):
+    for run in st.session_state.runs:
+        if run['run_id'] == run_id:
+            return f"{run['started_at'][:19].replace('T', ' ')} [{run['status']}] {run['question']}"
+    return run_id
+
+
+def get_progress_subscription(run_id):
+    subscription = st.session_state.get('progress_subscription')
+    if subscription is None or subscription.run_id != run_id:
+        subscription = PROGRESS_BUS.subscribe(run_id)
+        st.session_state.progress_subscription = subscription
+        st.session_state.progress_loaded = False
+    return subscription
+
+
+def load_progress_data():
+    run_id = get_current_run_id()
+    if run_id is None or st.session_state.get('new_question'):
+        st.session_state.show_question_interface = True
+        st.session_state.progress_loaded = False
+        return
+
+    subscription = get_progress_subscription(run_id)
+
+    if PROGRESS_BUS.has_run(run_id):
+        # pipeline publishes in this process: only re-parse the fields that changed since the last rerun
+        changes, reset = subscription.poll()
+        results = PROGRESS_BUS.snapshot(run_id)
+        changed_fields = None if reset or not st.session_state.get('progress_loaded') else changes.keys()
+    else:
+        # nothing published in this process, fall back to the durable run history
+        #print("DEBUG: read from DB")
+        run = get_run(run_id)
+        # a queued run has no steps yet, show it with just the question
+        results = {'user_question': run['question'], **run['steps']} if run else None
+        changed_fields = None
+
+    if results is None:
+        st.session_state.show_question_interface = True
+        st.session_state.progress_loaded = False
+        return
+    else:
+        st.session_state.show_question_interface = False
+       # print(f"\n\nDEBUG: process status\n\n{results}")
+
+    if changed_fields is None:
+        loaders = PROGRESS_FIELD_LOADERS.values()
+    else:
+        loaders = [PROGRESS_FIELD_LOADERS[field] for field in changed_fields if field in PROGRESS_FIELD_LOADERS]
+
+    for loader in dict.fromkeys(loaders):
+        loader(results)
+
+    st.session_state.progress_loaded = True
  
 
 
@@ -503,10 +597,9 @@ def show_question_interface():
                 print("DEBUG: start")
                 st.session_state.show_question_interface = False
                 ount = st_autorefresh(interval=1000, limit=1000, key="refreshcounter")
-                if st.session_state.model == 'Gemini':
-                    generate_thinking_agent_response(prompt, st.session_state.user_name, True)
-                else:
-                    generate_thinking_agent_response(prompt, st.session_state.user_name, False)
+                # the pipeline runs on the job workers, the page only follows the run
+                st.session_state.new_question = False
+                st.session_state.run_id = submit_job(st.session_state.user_name, prompt, use_gemini=st.session_state.model == 'Gemini')
                 
                 print("Debug: start2")
                 st.rerun()
@@ -659,7 +752,24 @@ def show_status_interface():
                 """,
         ):
             if st.button("Reset"):
-                delete_process_status(st.session_state.user_name)
+                reset_progress(st.session_state.user_name)
+
+    # earlier and concurrent runs of this user
+    col1, col2 = st.columns([0.90, 0.10], vertical_alignment="bottom")
+    with col1:
+        run_ids = [run['run_id'] for run in st.session_state.runs]
+        if len(run_ids) > 1:
+            selected_run = st.selectbox("Run:", run_ids, index=run_ids.index(st.session_state.run_id), format_func=format_run_label)
+            if selected_run != st.session_state.run_id:
+                st.session_state.run_id = selected_run
+                st.rerun()
+        current_run = next((run for run in st.session_state.runs if run['run_id'] == st.session_state.run_id), None)
+        if current_run and current_run['status'] == 'queued':
+            st.caption("Queued, waiting for a free worker...")
+    with col2:
+        if st.button("New Question"):
+            st.session_state.new_question = True
+            st.rerun()
     ""
     progress_steps = [
         {"status_key": "user_question_status", "description": "User Question <br><br>", "details": st.session_state.user_question, "running":False},
@@ -852,11 +962,15 @@ def show_status_interface():
                     sub_a, sub_b = st.columns([0.96, 0.04])
                     with sub_a:
                         with st.container(border=True):
+                            if st.session_state.sql_streaming:
+                                st.caption("Generating...")
                             st.code(details, language="sql")
                 else:
                     st.html(f"<div class='inner-container'>{details}</div>")
 
-    count = st_autorefresh(interval=5000, limit=1000, key="refreshcounter")
+    # refresh faster while SQL is streaming in
+    refresh_interval = 1000 if st.session_state.sql_streaming else 5000
+    count = st_autorefresh(interval=refresh_interval, limit=1000, key="refreshcounter")
 
 #########################################################################
 # ▗▄▄▖▗▄▄▄▖▗▄▖ ▗▄▄▖▗▄▄▄▖
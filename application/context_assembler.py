@@ -0,0 +1,216 @@
+# File: context_assembler.py
+# Description: builds the schema context string that goes into the pipeline prompts
+#  retrieved DDL and table_metadata nodes of the same table are merged into one block,
+#  overlapping lines are dropped and the result is fit to a token budget
+#  after the tables step the context is sliced down to the chosen tables for the later steps
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import re
+from typing import List
+from llama_index.core.schema import NodeWithScore
+from tracing import estimate_tokens
+
+
+HEADER_PREFIXES = ("Database:", "Table:")
+# "  name (TYPE)" or "  name (TYPE): description", as written by injest.parse_table_file
+COLUMN_LINE = re.compile(r"^\s+([\w$]+) \(")
+
+
+class SchemaContextAssembler:
+    """
+    Merges retrieved schema nodes per (database, table), in retrieval/rerank order:
+      - the Database/Table header is written once
+      - the DDL statement is kept as is, it has the keys and constraints
+      - from the table_metadata document only what the DDL doesn't have is kept: column
+        descriptions and sample rows (all columns when the DDL was not retrieved)
+    Whole tables are then added until token_budget is reached, so prompt size grows with the
+    number of distinct tables and not with the number of nodes. The most relevant table is
+    always included, cut to the budget if it has to be.
+    """
+
+    def __init__(self, token_budget=3000):
+        self.token_budget = token_budget
+
+    @staticmethod
+    def table_key(node: NodeWithScore):
+        metadata = node.metadata or {}
+        if metadata.get("database_name") and metadata.get("table_name"):
+            return (metadata["database_name"], metadata["table_name"])
+        # nodes without table metadata are kept on their own
+        return (None, node.node.node_id)
+
+    @staticmethod
+    def _body(text):
+        return [line for line in text.splitlines() if not line.startswith(HEADER_PREFIXES)]
+
+    @staticmethod
+    def _metadata_lines(text, has_ddl):
+        """
+        Lines of a table_metadata document worth keeping next to the table's DDL.
+        """
+        if not has_ddl:
+            return SchemaContextAssembler._body(text)
+
+        lines = []
+        descriptions = []
+        section = None
+        for line in SchemaContextAssembler._body(text):
+            if line.startswith("Columns:"):
+                section = "columns"
+            elif line.startswith("Sample Rows:"):
+                section = "samples"
+                lines.append(line)
+            elif section == "columns":
+                # "name (TYPE)" repeats the DDL, "name (TYPE): description" adds to it
+                if "): " in line:
+                    descriptions.append(line)
+            elif line.strip():
+                lines.append(line)
+        if descriptions:
+            lines = ["Column descriptions:"] + descriptions + lines
+        return lines
+
+    def group(self, nodes: List[NodeWithScore]):
+        """
+        Returns (database, table) -> {'ddl': [texts], 'metadata': [texts], 'other': [texts]}, in the order
+        each table was first retrieved.
+        """
+        tables = {}
+        for node in nodes:
+            entry = tables.setdefault(self.table_key(node), {"ddl": [], "metadata": [], "other": []})
+            node_type = (node.metadata or {}).get("type")
+            kind = "ddl" if node_type == "ddl" else "metadata" if node_type == "table_metadata" else "other"
+            if node.text not in entry[kind]:
+                entry[kind].append(node.text)
+        return tables
+
+    def render_table(self, key, entry):
+        database_name, table_name = key
+        if database_name is None:
+            return "\n".join(entry["ddl"] + entry["metadata"] + entry["other"])
+
+        lines = [f"Database: {database_name}", f"Table: {table_name}"]
+        for text in entry["ddl"]:
+            lines.extend(self._body(text))
+        for text in entry["metadata"]:
+            lines.extend(self._metadata_lines(text, has_ddl=bool(entry["ddl"])))
+        for text in entry["other"]:
+            lines.extend(self._body(text))
+        return "\n".join(lines)
+
+    def assemble(self, nodes: List[NodeWithScore]):
+        """
+        Returns (schema_context, stats). stats has the node and table counts, the estimated tokens
+        before and after merging, and the tables dropped to stay within the budget.
+        """
+        blocks = []
+        dropped = []
+        used_tokens = 0
+        for key, entry in self.group(nodes).items():
+            block = self.render_table(key, entry)
+            tokens = estimate_tokens(block)
+            if blocks and used_tokens + tokens > self.token_budget:
+                dropped.append(key[1] if key[0] is None else f"{key[0]}.{key[1]}")
+                continue
+            if not blocks and tokens > self.token_budget:
+                block = block[:self.token_budget * 4]
+                tokens = estimate_tokens(block)
+            blocks.append(block)
+            used_tokens += tokens
+
+        stats = {
+            "nodes": len(nodes),
+            "tables": len(blocks),
+            "tokens_before": estimate_tokens("\n\n".join(n.text for n in nodes)),
+            "tokens_after": used_tokens,
+            "dropped_tables": dropped,
+        }
+        return "\n\n".join(blocks), stats
+
+
+class SchemaContextSlicer:
+    """
+    Trims the assembled schema context to what a later step needs, using the tables step's json
+    ({"tables": [...], "columns": ["table.column", ...]}):
+      - only the blocks of the selected tables are kept, in their original order
+      - for column_steps the column lines are cut down to the selected columns as well
+      - the result is cut to the step's token budget, whole tables at a time
+    Falls back to the full context when none of the selected tables can be found in it.
+    """
+
+    def __init__(self, step_budgets=None, default_budget=3000, column_steps=("filtering",)):
+        self.step_budgets = step_budgets or {}
+        self.default_budget = default_budget
+        self.column_steps = set(column_steps)
+
+    @staticmethod
+    def _name(value):
+        # "db.table", "`table`" and "Table" all match "table"
+        return str(value).strip().strip('`"[]').split(".")[-1].strip('`"[]').lower()
+
+    @classmethod
+    def selection(cls, tables_info):
+        """
+        Returns {table: set(columns)} from the tables step json, an empty set means all columns.
+        """
+        tables_info = tables_info if isinstance(tables_info, dict) else {}
+        selected = {}
+        for table in tables_info.get("tables") or tables_info.get("table") or []:
+            selected.setdefault(cls._name(table), set())
+        for column in tables_info.get("columns") or tables_info.get("column") or []:
+            parts = str(column).split(".")
+            if len(parts) >= 2:
+                selected.setdefault(cls._name(parts[-2]), set()).add(cls._name(parts[-1]))
+        return selected
+
+    @staticmethod
+    def split_blocks(schema_context):
+        return [block for block in re.split(r"\n\n(?=Database: )", schema_context) if block.strip()]
+
+    @staticmethod
+    def block_table(block):
+        match = re.search(r"^Table: (.+)$", block, re.MULTILINE)
+        return SchemaContextSlicer._name(match.group(1)) if match else None
+
+    @staticmethod
+    def prune_columns(block, columns):
+        lines = []
+        for line in block.splitlines():
+            match = COLUMN_LINE.match(line)
+            if match and match.group(1).lower() not in columns:
+                continue
+            lines.append(line)
+        return "\n".join(lines)
+
+    def slice(self, schema_context, tables_info, step):
+        """
+        Returns (context, stats) for step. stats has the estimated tokens of the full and the sliced
+        context and the tables kept.
+        """
+        full_tokens = estimate_tokens(schema_context)
+        selected = self.selection(tables_info)
+        budget = self.step_budgets.get(step, self.default_budget)
+
+        blocks = []
+        used_tokens = 0
+        for block in self.split_blocks(schema_context):
+            table = self.block_table(block)
+            if table not in selected:
+                continue
+            if step in self.column_steps and selected[table]:
+                block = self.prune_columns(block, selected[table])
+            tokens = estimate_tokens(block)
+            if blocks and used_tokens + tokens > budget:
+                break
+            blocks.append(block)
+            used_tokens += tokens
+
+        if not blocks:
+            return schema_context, {"tokens_full": full_tokens, "tokens_sliced": full_tokens, "tables": None}
+        context = "\n\n".join(blocks)
+        return context, {"tokens_full": full_tokens, "tokens_sliced": estimate_tokens(context), "tables": len(blocks)}
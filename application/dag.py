@@ -0,0 +1,173 @@
+# File: dag.py
+# Description: small dependency graph executor for the pipeline steps
+#  independent steps are dispatched concurrently on a thread pool or an asyncio event loop
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import asyncio
+import contextvars
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Seconds the running step waited between becoming ready and starting (pool slot + backend limit)
+STEP_QUEUE_WAIT = contextvars.ContextVar("step_queue_wait", default=0.0)
+
+
+class BackendLimits:
+    """
+    Max concurrent steps per backend, shared by every DAG run that is given this object, so the
+    limit holds across runs (users) and not just within one run.
+    The thread path uses one BoundedSemaphore per backend, the asyncio path one Semaphore per
+    backend and event loop.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self._semaphores = {backend: threading.BoundedSemaphore(limit) for backend, limit in self.limits.items()}
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def semaphore(self, backend):
+        return self._semaphores.get(backend)
+
+    def asemaphore(self, backend):
+        if backend not in self.limits:
+            return None
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphores = self._async_semaphores.get(loop)
+            if semaphores is None:
+                semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+                self._async_semaphores[loop] = semaphores
+            return semaphores[backend]
+
+
+def as_backend_limits(backend_limits):
+    # a plain dict only limits the one run it is passed to
+    return backend_limits if isinstance(backend_limits, BackendLimits) else BackendLimits(backend_limits)
+
+
+def validate_dag(steps):
+    """
+    Checks that every dependency exists and that the graph has no cycles.
+    Raises ValueError otherwise.
+    """
+    for name, step in steps.items():
+        for dep in step.get("deps", []):
+            if dep not in steps:
+                raise ValueError(f"Step '{name}' depends on unknown step '{dep}'")
+
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle detected at step '{name}'")
+        visiting.add(name)
+        for dep in steps[name].get("deps", []):
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in steps:
+        visit(name)
+
+
+def run_dag(steps, max_workers=4, backend_limits=None):
+    """
+    Runs a dependency graph of steps, dispatching every step whose dependencies are done.
+
+    Args:
+        steps (dict): step name -> {"deps": [step names], "fn": callable(results) -> value, "backend": str or None}
+                      fn receives a dict of the results of all steps completed so far.
+        max_workers (int): size of the thread pool.
+        backend_limits (BackendLimits): max number of concurrent steps per backend, shared with the
+                      other runs using the same object. A dict of backend -> limit applies to this run only.
+
+    Returns:
+        dict: step name -> value returned by its fn.
+    """
+    validate_dag(steps)
+
+    backend_limits = as_backend_limits(backend_limits)
+
+    results = {}
+    remaining = dict(steps)
+    running = {}
+
+    def run_step(name, step, snapshot, ready_at):
+        semaphore = backend_limits.semaphore(step.get("backend"))
+        if semaphore is None:
+            STEP_QUEUE_WAIT.set(time.perf_counter() - ready_at)
+            return step["fn"](snapshot)
+        with semaphore:
+            STEP_QUEUE_WAIT.set(time.perf_counter() - ready_at)
+            return step["fn"](snapshot)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline_dag") as pool:
+        while remaining or running:
+            ready = [name for name, step in remaining.items() if all(dep in results for dep in step.get("deps", []))]
+            for name in ready:
+                step = remaining.pop(name)
+                running[pool.submit(run_step, name, step, dict(results), time.perf_counter())] = name
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for pending in running:
+                        pending.cancel()
+                    raise
+
+    return results
+
+
+async def arun_dag(steps, backend_limits=None):
+    """
+    asyncio version of run_dag. fn must be a coroutine function taking the results dict.
+    Every step starts as soon as its dependencies finish; backend_limits (BackendLimits or dict, as
+    for run_dag) caps concurrent steps per backend.
+
+    Returns:
+        dict: step name -> value returned by its fn.
+    """
+    validate_dag(steps)
+
+    backend_limits = as_backend_limits(backend_limits)
+    tasks = {}
+
+    async def run_step(name, step):
+        deps = step.get("deps", [])
+        if deps:
+            await asyncio.gather(*(tasks[dep] for dep in deps))
+        snapshot = {n: t.result() for n, t in tasks.items() if t.done() and not t.cancelled() and t.exception() is None}
+        ready_at = time.perf_counter()
+
+        semaphore = backend_limits.asemaphore(step.get("backend"))
+        if semaphore is None:
+            STEP_QUEUE_WAIT.set(0.0)
+            return await step["fn"](snapshot)
+        async with semaphore:
+            STEP_QUEUE_WAIT.set(time.perf_counter() - ready_at)
+            return await step["fn"](snapshot)
+
+    for name, step in steps.items():
+        tasks[name] = asyncio.ensure_future(run_step(name, step))
+
+    try:
+        values = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    return dict(zip(tasks.keys(), values))
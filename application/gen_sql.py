@@ -17,14 +17,31 @@ from llama_index.llms.ollama import Ollama
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.core.postprocessor import SentenceTransformerRerank
 from llama_index.core.schema import NodeWithScore
-from internal_db import update_process_status, delete_process_status
+from progress_bus import start_progress_run, start_progress_step, publish_progress, finish_progress_run
+from progress_bus import astart_progress_run, astart_progress_step, apublish_progress, afinish_progress_run
+from rerank import RerankerService
+from context_assembler import SchemaContextAssembler, SchemaContextSlicer
+from prefix_cache import SharedPrefixPrompt, GeminiPrefixCache
+from step_schemas import STEP_OUTPUT_SCHEMAS, parse_with_repair, aparse_with_repair, gemini_response_schema
+from llama_index.core.llms import ChatMessage
+from dag import run_dag, arun_dag, BackendLimits, STEP_QUEUE_WAIT
+from tracing import span, record_llm_call, record_retry, estimate_tokens
+from run_control import RunControl, RunAborted, RunCancelled, StepTimeout, RetryPolicy, register_run, unregister_run, call_with_retry, acall_with_retry
+from internal_db import is_run_dismissed
+from llm_pool import LLMClientPool
+from model_router import ModelRouter, routed_step
+from llm_cache import LLMResponseCache
+from semantic_cache import SemanticQuestionCache
 from typing import List
 import sys
 from datetime import datetime
 import json
 import re
+import time
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -35,8 +52,10 @@ import re
 #▐▌   ▐▌ ▐▌▐▌ ▝▜▌▐▛▀▀▘  █  ▐▌▝▜▌
 #▝▚▄▄▖▝▚▄▞▘▐▌  ▐▌▐▌   ▗▄█▄▖▝▚▄▞▘
 #########################################################################
-from injest import get_vector_storage_index, CHROMA_DB_PATH, SCHEMA_COLLECTION_NAME, BUSINESS_TERMS_COLLECTION_NAME
+from injest import get_cached_vector_storage_index, get_embed_model, CHROMA_DB_PATH, SCHEMA_COLLECTION_NAME, BUSINESS_TERMS_COLLECTION_NAME
 from prompts import CLEAN_QUESTION_PROMPT_V4, SQL_GEN_PROMPT_TEMPLATE, CLEAN_SQL_PROMPT_V4, FILTERING_PROMPT_V3, CALCULATIONS_PROMPT_V3, GROUPING_PROMPT_V3, TABLE_COLUMN_PROMPT_V4, SQL_GEN_PROMPT_TEMPLATE_V4, JOIN_PROMPT_V4
+from prompts import JSON_REPAIR_PROMPT
+from prompts import SHARED_CONTEXT_PREFIX, TABLE_COLUMN_SUFFIX_V4, JOIN_SUFFIX_V4, GROUPING_SUFFIX_V3, CALCULATIONS_SUFFIX_V3, FILTERING_SUFFIX_V3, SQL_GEN_SUFFIX_V4, CLEAN_SQL_SUFFIX_V4
 
 GEMINI_API_KEY = "YOUR_API_KEY_OR_OS_VARIABLE"
 GEMINI_PRO_MODEL = "gemini-2.5-pro"
@@ -45,32 +64,239 @@ OLLAMA_MODEL = "my-phi4:latest" #"llama3.1:8b"
 #RERANK_MODEL = "BAAI/bge-reranker-base" 
 RERANK_MODEL = None
 MIN_RELEVANCE_SCORE = 0.0005
-
-USE_GEMINI = False
-
+RETRIEVAL_TOP_K = 7
+# Estimated tokens of schema context pasted into each prompt, retrieved tables past it are dropped
+SCHEMA_CONTEXT_TOKEN_BUDGET = 3000
+# Steps 4-9 only see the tables chosen in step 3, within this budget (estimated tokens).
+# The sliced context is the same for all of them, so they share one prompt prefix (Ollama prefix
+# reuse, Gemini context cache) instead of each step getting its own.
+USE_CONTEXT_SLICING = True
+SLICED_CONTEXT_TOKEN_BUDGET = 3000
+
+# Thinking steps run as a DAG; DAG_MAX_WORKERS bounds the steps in flight per run,
+# BACKEND_CONCURRENCY the thinking steps in flight per backend across all runs in the process
+DAG_MAX_WORKERS = 4
+BACKEND_CONCURRENCY = {"ollama": 2, "gemini": 4}
+BACKEND_LIMITS = BackendLimits(BACKEND_CONCURRENCY)
+
+# Step prompts (3-9) start with one shared context block per question, so from the second step on
+# the backends only prefill the step suffix: Ollama reuses the cached prefix while the model stays
+# loaded (keep_alive), Gemini reads it from a CachedContent.
+USE_SHARED_PREFIX_PROMPTS = True
+OLLAMA_KEEP_ALIVE = "30m"
+USE_GEMINI_CONTEXT_CACHE = True
+GEMINI_PREFIX_CACHE = GeminiPrefixCache(ttl_seconds=600, min_tokens=2048)
+
+# Deadlines (seconds) for a whole run and for each step within it (all attempts and fallbacks).
+# A Reset in the UI cancels the run's calls as well, see run_control.
+RUN_DEADLINE_SECONDS = 900
+STEP_DEADLINE_SECONDS = {
+    "clean_user_question": 120,
+    "tables": 180,
+    "joins": 180,
+    "grouping": 180,
+    "calculations": 180,
+    "filtering": 180,
+    "generation": 300,
+    "cleaning": 300,
+}
+# Transient errors (timeouts, dropped connections, 429/5xx) are retried with jittered backoff
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=20.0)
+# An abandoned (cancelled or timed out) Ollama call ends after this, keep it >= the step deadlines
+OLLAMA_REQUEST_TIMEOUT = 300
+
+# Partial SQL from steps 8 and 9 is pushed to the status store at most this often (seconds)
+STREAM_STATUS_INTERVAL = 0.5
+
+
+
+# Model router: candidates per step. The first healthy one is used and the next one takes over
+# when a model errors or gets slower than its max_latency (seconds).
+# Every candidate needs a tier, the order of preference (0 first). Candidates with the same tier
+# are interchangeable, the faster one is tried first.
+# Off by default, runs then use the UI's backend choice or the model_list they are given.
+USE_MODEL_ROUTER = False
+_LOCAL_FIRST = [
+    {"backend": "ollama", "model": OLLAMA_MODEL, "tier": 0, "max_latency": 90},
+    {"backend": "gemini", "model": GEMINI_MODEL, "tier": 1},
+]
+MODEL_ROUTES = {
+    'clean_user_question': _LOCAL_FIRST,
+    'tables': _LOCAL_FIRST,
+    'joins': _LOCAL_FIRST,
+    'grouping': _LOCAL_FIRST,
+    'calculations': _LOCAL_FIRST,
+    'filtering': _LOCAL_FIRST,
+    'generation': [
+        {"backend": "gemini", "model": GEMINI_PRO_MODEL, "tier": 0, "max_latency": 120},
+        {"backend": "gemini", "model": GEMINI_MODEL, "tier": 1},
+        {"backend": "ollama", "model": OLLAMA_MODEL, "tier": 2},
+    ],
+    'cleaning': [
+        {"backend": "gemini", "model": GEMINI_MODEL, "tier": 0},
+        {"backend": "ollama", "model": OLLAMA_MODEL, "tier": 1},
+    ],
+}
+MODEL_ROUTER = ModelRouter(MODEL_ROUTES)
+
+# Long lived LLM clients, keyed by (backend, model, json_mode); every call also feeds the router,
+# under the step get_routed_llm_response is running (model_router.ROUTED_STEP)
+LLM_POOL = LLMClientPool(on_call=lambda key, seconds, ok: MODEL_ROUTER.observe(key[0], key[1], seconds, ok))
+_GEMINI_CONFIGURED = False
+
+# Persistent prompt -> response cache, consulted transparently by get_llm_response
+USE_LLM_CACHE = True
+LLM_CACHE = LLMResponseCache()
+
+# Semantic cache of answered questions, a hit skips retrieval and steps 3-9
+USE_QUESTION_CACHE = True
+QUESTION_CACHE = SemanticQuestionCache()
 
 
 def get_llm(model_name = OLLAMA_MODEL, json_mode=False, output_cls = None):
 
     if output_cls is None:
-        llm = Ollama(model=model_name, request_timeout=720, temperature=0.0, json_mode=json_mode)
+        llm = LLM_POOL.get(("ollama", model_name, json_mode),
+                           lambda: Ollama(model=model_name, request_timeout=OLLAMA_REQUEST_TIMEOUT, temperature=0.0, json_mode=json_mode, keep_alive=OLLAMA_KEEP_ALIVE))
     else:
-        llm = Ollama(model=model_name, request_timeout=720, temperature=0.0, json_mode=json_mode, output_cls=output_cls)
+        llm = Ollama(model=model_name, request_timeout=OLLAMA_REQUEST_TIMEOUT, temperature=0.0, json_mode=json_mode, output_cls=output_cls, keep_alive=OLLAMA_KEEP_ALIVE)
     return llm
 
-def set_reranker():
-    try:
-        reranker = SentenceTransformerRerank(
-            model=RERANK_MODEL,
-            top_n=5 # Keep top 5 after reranking
-        )
-        print(f"Successfully loaded reranker model: {RERANK_MODEL}")
-    except Exception as e:
-        print(f"Could not load reranker model ({RERANK_MODEL}). Retrieval quality might be lower. Error: {e}")
-        reranker = None # Set to None if loading fails
-    return reranker
 
-reranker = None
+def get_gemini_model(model_name, json_mode=False, output_cls=None):
+    """
+    Returns the pooled GenerativeModel for model_name, with the json generation config baked in.
+    output_cls (a step_schemas model) constrains the output to that schema.
+    genai.configure() only runs once per process.
+    """
+    global _GEMINI_CONFIGURED
+    import google.generativeai as genai
+
+    if not _GEMINI_CONFIGURED:
+        genai.configure(api_key=GEMINI_API_KEY)
+        _GEMINI_CONFIGURED = True
+
+    def build():
+        if output_cls is not None:
+            return genai.GenerativeModel(model_name, generation_config=genai.GenerationConfig(
+                response_mime_type="application/json", response_schema=gemini_response_schema(output_cls)))
+        if json_mode:
+            return genai.GenerativeModel(model_name, generation_config=genai.GenerationConfig(response_mime_type="application/json"))
+        return genai.GenerativeModel(model_name)
+
+    return LLM_POOL.get(gemini_pool_key(model_name, json_mode, output_cls), build)
+
+
+def gemini_pool_key(model_name, json_mode=False, output_cls=None):
+    """
+    Key of the pooled GenerativeModel, used for its call stats (LLM_POOL.track) as well.
+    """
+    return ("gemini", model_name, output_cls.__name__ if output_cls else json_mode)
+
+
+def get_gemini_request(prompt, model_name, json_mode=False, output_cls=None):
+    """
+    Returns (GenerativeModel, contents) for a prompt. For a SharedPrefixPrompt whose prefix is in
+    Gemini's context cache only the suffix is sent, otherwise the whole prompt.
+    """
+    gemini = get_gemini_model(model_name, json_mode=json_mode, output_cls=output_cls)
+    prefix = getattr(prompt, "prefix", None)
+    if USE_GEMINI_CONTEXT_CACHE and prefix:
+        response_schema = gemini_response_schema(output_cls) if output_cls is not None else None
+        cached_gemini = GEMINI_PREFIX_CACHE.get_model(model_name, prefix, json_mode, response_schema,
+                                                      output_cls.__name__ if output_cls else None)
+        if cached_gemini is not None:
+            return cached_gemini, prompt.suffix
+    return gemini, str(prompt)
+
+
+def get_llm_pool_stats():
+    """
+    Connection and latency stats for every pooled client.
+    """
+    return LLM_POOL.stats()
+
+# One cross-encoder per process, loaded lazily on first use and shared by every run
+RERANKER = RerankerService(RERANK_MODEL, top_n=5, min_score=MIN_RELEVANCE_SCORE)
+SCHEMA_CONTEXT_ASSEMBLER = SchemaContextAssembler(SCHEMA_CONTEXT_TOKEN_BUDGET)
+SCHEMA_CONTEXT_SLICER = SchemaContextSlicer(default_budget=SLICED_CONTEXT_TOKEN_BUDGET, column_steps=())
+
+# ANN lookups for the collections run side by side on this pool
+_RETRIEVAL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag_retrieval")
+
+
+class PipelineContext:
+    """
+    Per request settings of one pipeline run: backend, Gemini model, model per thinking step,
+    model router, reranker and the run's deadline / cancel flag (control). It is passed to every
+    helper instead of the helpers reading module globals, so runs with different settings can be
+    in flight in the same process.
+    outcome is set by a run that ends early without an error, e.g. 'rejected' for an invalid question.
+    """
+
+    def __init__(self, run_id=None, use_gemini=False, gemini_model=None, ollama_model=OLLAMA_MODEL, model_list=None, reranker=None, router=None, control=None):
+        self.run_id = run_id
+        self.control = control or RunControl(run_id)
+        self.use_gemini = use_gemini
+        self.gemini_model = gemini_model or GEMINI_MODEL
+        self.ollama_model = ollama_model
+        self.model_list = model_list
+        self.reranker = reranker or RERANKER
+        self.router = router
+        self.outcome = None
+
+    @classmethod
+    def from_request(cls, use_gemini=False, use_pro=False, model_list=None, run_id=None):
+        # an explicit model_list (prompt tests) always wins over the router
+        router = MODEL_ROUTER if USE_MODEL_ROUTER and model_list is None else None
+        # a Reset from a UI in another process only reaches the run through the runs table
+        control = register_run(run_id, RUN_DEADLINE_SECONDS, is_cancelled=lambda: is_run_dismissed(run_id))
+        return cls(run_id=run_id, use_gemini=use_gemini, gemini_model=GEMINI_PRO_MODEL if use_pro else GEMINI_MODEL, model_list=model_list, router=router, control=control)
+
+    def step_deadline(self, step):
+        return self.control.step_deadline(STEP_DEADLINE_SECONDS.get(step))
+
+    def candidates(self, step):
+        """
+        llm_args for a step (a THINKING_STEPS name, 'clean_user_question', 'generation' or 'cleaning'),
+        best first. With a router these are its healthy candidates followed by the fallbacks,
+        otherwise the single model/backend the run was configured with.
+        """
+        if self.router is not None:
+            routed = self.router.candidates(step, prefer_backend="gemini" if self.use_gemini else None)
+            if routed:
+                return [{
+                    "model_name": candidate["model"] if candidate["backend"] == "ollama" else self.ollama_model,
+                    "use_gemini": candidate["backend"] == "gemini",
+                    "gemini_model": candidate["model"] if candidate["backend"] == "gemini" else self.gemini_model,
+                } for candidate in routed]
+
+        if step in THINKING_STEPS:
+            return [self.llm_args(THINKING_STEPS[step]['model_step'])]
+        if step in ['generation', 'cleaning']:
+            return [self.final_llm_args()]
+        return [self.llm_args()]
+
+    def llm_args(self, model_step=None):
+        """
+        Keyword arguments for get_llm_response / aget_llm_response. With model_step, the model
+        and backend come from model_list for that step.
+        """
+        model_name, use_gemini = self.ollama_model, self.use_gemini
+        if model_step is not None and self.model_list is not None:
+            model_name, use_gemini = get_model_for_step(model_step, self.model_list, self.use_gemini)
+        return {"model_name": model_name, "use_gemini": use_gemini, "gemini_model": self.gemini_model}
+
+    def final_llm_args(self):
+        """
+        Steps 8 and 9 use the default model, on the backend chosen for the last thinking step.
+        """
+        use_gemini = self.llm_args(THINKING_STEPS['filtering']['model_step'])['use_gemini']
+        return {"model_name": self.ollama_model, "use_gemini": use_gemini, "gemini_model": self.gemini_model}
+
+    def cache_signature(self):
+        models = self.model_list if self.router is None else self.router.routes
+        return get_question_cache_signature(self.use_gemini, self.gemini_model, models)
 
 #########################################################################
 #▗▄▄▖  ▗▄▖  ▗▄▄▖
@@ -78,24 +304,26 @@ reranker = None
 #▐▛▀▚▖▐▛▀▜▌▐▌▝▜▌
 #▐▌ ▐▌▐▌ ▐▌▝▚▄▞▘             
 #########################################################################
-def get_rag_context(user_question: str) -> tuple[str, str, List[NodeWithScore], List[NodeWithScore]]:
+def _retrieve_nodes(collection_name: str, query_bundle: QueryBundle) -> tuple[List[NodeWithScore], float]:
     """
-    Retrieves context from both schema and business terms collections.
-    Returns schema_context_str, business_terms_context_str, schema_nodes, business_terms_nodes.
-    The nodes are returned for potential re-use in the SQL cleaning step.
+    Runs the ANN lookup for one collection. Returns the nodes and the time spent.
     """
-
-    print("About to retrieve context from schema collection...")
-
-    schema_index = get_vector_storage_index(SCHEMA_COLLECTION_NAME)
-    schema_retriever = VectorIndexRetriever(
-        index=schema_index,
-        similarity_top_k=7, # Retrieve more to allow reranker to work
+    start = time.perf_counter()
+    index = get_cached_vector_storage_index(collection_name)
+    retriever = VectorIndexRetriever(
+        index=index,
+        similarity_top_k=RETRIEVAL_TOP_K, # Retrieve more to allow reranker to work
     )
-    schema_nodes = schema_retriever.retrieve(QueryBundle(user_question))
+    nodes = retriever.retrieve(query_bundle)
+    return nodes, time.perf_counter() - start
 
-    
 
+def assemble_rag_context(user_question: str, schema_nodes: List[NodeWithScore], business_terms_nodes: List[NodeWithScore], timings: dict, reranker=None) -> tuple[str, str, List[NodeWithScore], List[NodeWithScore], dict]:
+    """
+    Reranks the retrieved nodes and builds the context strings. Shared by the sync and async retrieval paths.
+    reranker defaults to the shared process wide RERANKER.
+    """
+    reranker = reranker or RERANKER
     ###########
     print(f"\nInitial retrieved schema nodes (before reranking, top {len(schema_nodes)}):")
     for i, node_with_score in enumerate(schema_nodes):
@@ -104,64 +332,74 @@ def get_rag_context(user_question: str) -> tuple[str, str, List[NodeWithScore],
     ##########
 
 
+    # Score both collections with the shared reranker in a single batch
+    phase_start = time.perf_counter()
+    if reranker.enabled:
+        reranked = reranker.rerank(user_question, {"schema": schema_nodes, "business_terms": business_terms_nodes})
+        schema_nodes = reranked["schema"]
+        business_terms_nodes = reranked["business_terms"]
 
-    if reranker:
-        reranked_nodes = reranker.postprocess_nodes(schema_nodes, query_bundle=QueryBundle(user_question))
-
-        for i, node_with_score in enumerate(reranked_nodes):
-            score_to_print = node_with_score.score # Fallback to initial score if reranker didn't add 'relevance_score'
-
-            print(f"Node {i+1} (Reranked Raw Score: {score_to_print:.4f}): Content: {node_with_score.text[:10]}...") 
-
-
-
-        filtered_schema_nodes = [
-            node_with_score
-            for node_with_score in reranked_nodes
-            if node_with_score.score >= MIN_RELEVANCE_SCORE
-            #if hasattr(node_with_score, 'relevance_score') and node_with_score.score is not None and node_with_score.score >= MIN_RELEVANCE_SCORE
-        ]
-        schema_nodes = filtered_schema_nodes
+        for i, node_with_score in enumerate(schema_nodes):
+            print(f"Node {i+1} (Reranked Raw Score: {node_with_score.score:.4f}): Content: {node_with_score.text[:10]}...") 
 
         print(f"Reranked schema nodes. Top {len(schema_nodes)} selected.")
+        print(f"Reranked & filtered business terms nodes. Top {len(business_terms_nodes)} selected.")
     else:
         print(f"Retrieved top {len(schema_nodes)} schema nodes (no reranker).")
-
-    schema_context = "\n\n".join([n.text for n in schema_nodes])
+        print(f"Retrieved top {len(business_terms_nodes)} business terms nodes (no reranker).")
+    timings['rerank'] = time.perf_counter() - phase_start
+
+    # one block per table instead of one per node, fit to the token budget
+    phase_start = time.perf_counter()
+    schema_context, assembly = SCHEMA_CONTEXT_ASSEMBLER.assemble(schema_nodes)
+    timings['assemble'] = time.perf_counter() - phase_start
+    print(f"Schema context: {assembly['nodes']} nodes -> {assembly['tables']} tables, "
+          f"~{assembly['tokens_before']} -> ~{assembly['tokens_after']} tokens")
+    if assembly['dropped_tables']:
+        print(f"Dropped to fit the schema context budget: {', '.join(assembly['dropped_tables'])}")
     if not schema_context.strip():
         print("No relevant schema context found.")
         schema_context = "No database schema information found."
 
-
-    # Retrieve context from Business Terms Collection
-    print("Retrieving context from business terms collection...")
-    business_terms_index = get_vector_storage_index(BUSINESS_TERMS_COLLECTION_NAME)
-    business_terms_retriever = VectorIndexRetriever(
-        index=business_terms_index,
-        similarity_top_k=7, # Retrieve more to allow reranker to work
-    )
-    business_terms_nodes = business_terms_retriever.retrieve(QueryBundle(user_question))
-
-    if reranker:
-        reranked_nodes = reranker.postprocess_nodes(business_terms_nodes, query_bundle=QueryBundle(user_question))
-        
-        filtered_business_terms_nodes = [
-            node_with_score
-            for node_with_score in reranked_nodes
-            if node_with_score.score >= MIN_RELEVANCE_SCORE
-            #if hasattr(node_with_score, 'relevance_score') and node_with_score.score is not None and node_with_score.score >= MIN_RELEVANCE_SCORE
-        ]
-        business_terms_nodes = filtered_business_terms_nodes
-        print(f"Reranked & filtered business terms nodes. Top {len(business_terms_nodes)} selected.")
-    else:
-        print(f"Retrieved top {len(business_terms_nodes)} business terms nodes (no reranker).")
-
     business_terms_context = "\n\n".join([n.text for n in business_terms_nodes])
     if not business_terms_context.strip():
         print("No relevant business terms context found.")
         business_terms_context = "No specific business terms or definitions found."
+
+    return schema_context, business_terms_context, schema_nodes, business_terms_nodes, timings
+
+
+def get_rag_context(user_question: str, reranker=None) -> tuple[str, str, List[NodeWithScore], List[NodeWithScore], dict]:
+    """
+    Retrieves context from both schema and business terms collections.
+    The question is embedded once and both ANN lookups run concurrently.
+    Returns schema_context_str, business_terms_context_str, schema_nodes, business_terms_nodes, timings.
+    The nodes are returned for potential re-use in the SQL cleaning step.
+    timings holds the seconds spent in each retrieval phase.
+    """
+    timings = {}
+    total_start = time.perf_counter()
+
+    # Embed the question once and reuse it for every collection
+    phase_start = time.perf_counter()
+    query_embedding = get_embed_model().get_query_embedding(user_question)
+    query_bundle = QueryBundle(query_str=user_question, embedding=query_embedding)
+    timings['embed'] = time.perf_counter() - phase_start
+
+    print("Retrieving context from schema and business terms collections...")
+    phase_start = time.perf_counter()
+    schema_future = _RETRIEVAL_POOL.submit(_retrieve_nodes, SCHEMA_COLLECTION_NAME, query_bundle)
+    business_terms_future = _RETRIEVAL_POOL.submit(_retrieve_nodes, BUSINESS_TERMS_COLLECTION_NAME, query_bundle)
+    schema_nodes, timings['schema_retrieve'] = schema_future.result()
+    business_terms_nodes, timings['business_terms_retrieve'] = business_terms_future.result()
+    timings['retrieve'] = time.perf_counter() - phase_start
+
+    result = assemble_rag_context(user_question, schema_nodes, business_terms_nodes, timings, reranker)
+
+    timings['total'] = time.perf_counter() - total_start
+    print("RAG timings: " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
         
-    return schema_context, business_terms_context, schema_nodes, business_terms_nodes
+    return result
 
 
 
@@ -187,45 +425,160 @@ def strip_key_from_json(data, key_to_strip='reasoning'):
     return data
 
 
-def ask_gemini_json(prompt, use_json=True, model='models/gemini-2.0-flash-lite'):
-    import os
-    import google.generativeai as genai
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(model)
-    if use_json:
-        generation_config = genai.GenerationConfig(response_mime_type="application/json")
-        response = model.generate_content(prompt, generation_config=generation_config)
-    else:
-        response = model.generate_content(prompt)
+def ask_gemini_json(prompt, use_json=True, model='models/gemini-2.0-flash-lite', output_cls=None):
+    gemini, contents = get_gemini_request(prompt, model, json_mode=use_json, output_cls=output_cls)
+    with LLM_POOL.track(gemini_pool_key(model, use_json, output_cls)):
+        response = gemini.generate_content(contents)
+    record_llm_call("gemini", model, prompt, response.text, response)
     return response.text
 
-def get_llm_response(prompt, model_name=OLLAMA_MODEL, json_mode=False):
-    try:
-        if USE_GEMINI:
-            response = ask_gemini_json(prompt, use_json=json_mode, model=GEMINI_MODEL)
-            cleaned = clean_response(response)
-        else:
-            llm = get_llm(model_name, json_mode=json_mode)
+def get_cache_model_key(model_name, use_gemini, gemini_model=None, output_cls=None):
+    """
+    Model identifier used in the response cache key, includes the backend and the output schema.
+    """
+    schema = f"/{output_cls.__name__}" if output_cls is not None else ""
+    if use_gemini:
+        return f"gemini:{gemini_model or GEMINI_MODEL}{schema}"
+    return f"ollama:{model_name}{schema}"
+
+
+def stream_llm_response(prompt, model_name, json_mode, use_gemini, gemini_model, on_token):
+    """
+    Streams a completion, calling on_token(text_so_far) as tokens arrive. Returns the full text.
+    """
+    text = ""
+    chunk = None
+    if use_gemini:
+        gemini_model = gemini_model or GEMINI_MODEL
+        gemini, contents = get_gemini_request(prompt, gemini_model, json_mode=json_mode)
+        with LLM_POOL.track(gemini_pool_key(gemini_model, json_mode)):
+            for chunk in gemini.generate_content(contents, stream=True):
+                text += chunk.text
+                on_token(text)
+        record_llm_call("gemini", gemini_model, prompt, text, chunk)
+    else:
+        llm = get_llm(model_name, json_mode=json_mode)
+        with LLM_POOL.track(("ollama", model_name, json_mode)):
+            for chunk in llm.stream_complete(prompt):
+                text = chunk.text
+                on_token(text)
+        record_llm_call("ollama", model_name, prompt, text, chunk)
+    return text
+
+
+def make_status_streamer(run_id, field='sql_draft', min_interval=STREAM_STATUS_INTERVAL, control=None):
+    """
+    Returns an on_token callback that publishes partial output to the progress bus on every token,
+    and writes it to the run history at most once every min_interval seconds so streaming does not flood the DB.
+    control: the run's RunControl, tokens of a cancelled or finished run (an abandoned call) are dropped.
+    """
+    last_write = [0.0]
+
+    def on_token(text):
+        if control is not None and (control.finished or control.cancelled()):
+            return
+        now = time.perf_counter()
+        persist = now - last_write[0] >= min_interval
+        if persist:
+            last_write[0] = now
+        publish_progress(run_id, {field: text}, persist=persist)
+
+    return on_token
+
+
+def get_llm_response(prompt, model_name=OLLAMA_MODEL, json_mode=False, use_gemini=False, gemini_model=None, on_token=None, output_cls=None, control=None, deadline=None):
+    """
+    on_token: optional callback, when given the completion is streamed and
+    on_token(text_so_far) is called as tokens arrive.
+    output_cls: optional step_schemas model, decoding is constrained to its json schema
+    (Ollama format, Gemini response_schema). Not combined with on_token.
+    control / deadline: the run's RunControl and the step's deadline. Transient errors are retried
+    until then, a cancelled or timed out run raises RunAborted, every other failure returns "".
+    The backend and model are explicit arguments, see PipelineContext.llm_args().
+    """
+    cache_model = get_cache_model_key(model_name, use_gemini, gemini_model, output_cls)
+    json_mode = json_mode or output_cls is not None
+    if USE_LLM_CACHE:
+        cached = LLM_CACHE.get(cache_model, json_mode, prompt)
+        if cached is not None:
+            print(f"Response (cached): '{cached}'")
+            record_llm_call(*cache_model.split(":", 1), prompt, cached, cache_hit=True)
+            if on_token is not None:
+                on_token(cached)
+            return cached
+
+    def call():
+        if on_token is not None:
+            return stream_llm_response(prompt, model_name, json_mode, use_gemini, gemini_model, on_token)
+        if use_gemini:
+            return ask_gemini_json(prompt, use_json=json_mode, model=gemini_model or GEMINI_MODEL, output_cls=output_cls)
+        llm = get_llm(model_name, json_mode=json_mode)
+        if output_cls is not None:
+            with LLM_POOL.track(("ollama", model_name, json_mode)):
+                response = llm.chat([ChatMessage(role="user", content=str(prompt))], format=output_cls.model_json_schema())
+            record_llm_call("ollama", model_name, prompt, response.message.content or "", response)
+            return response.message.content or ""
+        with LLM_POOL.track(("ollama", model_name, json_mode)):
             response = llm.complete(prompt)
-            cleaned = clean_response(str(response))
+        record_llm_call("ollama", model_name, prompt, str(response), response)
+        return str(response)
+
+    try:
+        response = call_with_retry(call, control or RunControl(), deadline, LLM_RETRY_POLICY, on_retry=report_llm_retry)
+        cleaned = clean_response(response)
         print(f"Response: '{cleaned}'")
+        if USE_LLM_CACHE and cleaned:
+            LLM_CACHE.put(cache_model, json_mode, prompt, cleaned)
         return cleaned
+    except RunAborted:
+        raise
     except Exception as e:
         print(f"Error with LLM response: {e}")
         return ""
 
 
-def clean_user_question(original_question: str) -> str:
+def report_llm_retry(error, attempt):
+    print(f"Transient LLM error, retrying (attempt {attempt + 2}): {error}")
+    record_retry()
+
+
+def get_routed_llm_response(prompt, step, ctx, json_mode=False, on_token=None, output_cls=None, deadline=None):
     """
-    Uses an LLM to rephrase and clarify the user's question.
+    Calls the LLM for a pipeline step, trying the context's candidates for that step in order
+    until one returns a response or the step's deadline (STEP_DEADLINE_SECONDS) passes.
     """
-    print(f"Cleaning user question: '{original_question}'")
+    deadline = deadline or ctx.step_deadline(step)
+    for attempt, llm_args in enumerate(ctx.candidates(step)):
+        if not step_time_left(step, ctx, deadline):
+            break
+        if attempt > 0:
+            print(f"Step '{step}': falling back to {'gemini/' + llm_args['gemini_model'] if llm_args['use_gemini'] else 'ollama/' + llm_args['model_name']}")
+            record_retry()
+        with routed_step(step):
+            response = get_llm_response(prompt, json_mode=json_mode, on_token=on_token, output_cls=output_cls, control=ctx.control, deadline=deadline, **llm_args)
+        if response:
+            return response
+    return ""
+
+
+def step_time_left(step, ctx, deadline):
+    """
+    False once the step's deadline has passed. Raises RunAborted if the whole run has to stop.
+    """
+    try:
+        ctx.control.check(deadline)
+        return True
+    except StepTimeout:
+        print(f"Step '{step}': deadline passed, giving up")
+        return False
+
+
+def build_clean_question_prompt(original_question: str) -> str:
     current_date = datetime.now().strftime("%Y-%m-%d")
-    
-    prompt = CLEAN_QUESTION_PROMPT_V4.format(original_question=original_question, current_date=current_date)
-    
-    response = get_llm_response(prompt, OLLAMA_MODEL, True)
+    return CLEAN_QUESTION_PROMPT_V4.format(original_question=original_question, current_date=current_date)
+
 
+def parse_clean_question_response(response):
     try:
         info_json = json.loads(response)
         return info_json
@@ -233,6 +586,40 @@ def clean_user_question(original_question: str) -> str:
         return None
 
 
+def clean_user_question(original_question: str, ctx=None) -> str:
+    """
+    Uses an LLM to rephrase and clarify the user's question.
+    """
+    ctx = ctx or PipelineContext()
+    print(f"Cleaning user question: '{original_question}'")
+    
+    prompt = build_clean_question_prompt(original_question)
+    
+    response = get_routed_llm_response(prompt, 'clean_user_question', ctx, json_mode=True)
+
+    return parse_clean_question_response(response)
+
+
+def get_cleaned_question(cleaned_question_info, user_question):
+    """
+    Picks the rephrased question out of the step 1 json, falling back to the original question.
+    Writes the chosen value back under 'rephrased_question'.
+    """
+    cleaned_question = cleaned_question_info.get('rephrased_question')
+
+    if not cleaned_question:
+        #print("Clean question prompt did not return valid 'rephrased_question'")
+        cleaned_question = cleaned_question_info.get('rephrased')
+        if not cleaned_question:
+            cleaned_question = cleaned_question_info.get('rephr_question')
+            if not cleaned_question:
+                print("Clean question prompt did not return a valid response.")
+                cleaned_question = user_question
+
+    cleaned_question_info['rephrased_question'] = cleaned_question
+    return cleaned_question
+
+
 def generate_sql_query(query_str: str, schema_context: str, business_terms_context: str) -> str:
     """
     Generates a SQL query using the LLM based on the cleaned question and RAG context.
@@ -250,28 +637,24 @@ def generate_sql_query(query_str: str, schema_context: str, business_terms_conte
     return get_llm_response(full_prompt)
 
 
-def clean_generated_sql(generated_sql: str, schema_nodes: List[NodeWithScore], business_terms_nodes: List[NodeWithScore]) -> str:
+def clean_generated_sql(generated_sql: str, schema_nodes: List[NodeWithScore], business_terms_nodes: List[NodeWithScore], on_token=None, ctx=None, state=None, tables_info=None) -> str:
     """
     Uses an LLM to review and clean the generated SQL query.
+    on_token streams the cleaned SQL as it is generated.
+    state: the pipeline state, when given the prompt is built from it (shared prefix, and the
+    context sliced to tables_info, the tables step json).
     """
+    ctx = ctx or PipelineContext()
     if not generated_sql.strip():
         return "" # No SQL to clean
 
     #print(f"Cleaning generated SQL: '{generated_sql}'")
 
-    # Reconstruct contexts from the nodes for the SQL cleaning prompt
-    schema_context_for_cleaning = "\n\n".join([n.text for n in schema_nodes])
-    business_terms_context_for_cleaning = "\n\n".join([n.text for n in business_terms_nodes])
-
-    prompt = CLEAN_SQL_PROMPT_V4.format(
-        schema_context=schema_context_for_cleaning,
-        business_terms_context=business_terms_context_for_cleaning,
-        generated_sql=generated_sql
-    )
+    prompt = build_clean_sql_prompt(generated_sql, schema_nodes, business_terms_nodes, state, tables_info)
 
     #print(f"Full prompt for SQL cleaning LLM:\n{prompt}")
 
-    response = get_llm_response(prompt)
+    response = get_routed_llm_response(prompt, 'cleaning', ctx, on_token=on_token)
     if response == "":
         print("error cleaning sql")
         return generated_sql
@@ -279,6 +662,21 @@ def clean_generated_sql(generated_sql: str, schema_nodes: List[NodeWithScore], b
     return response
 
 
+def build_clean_sql_prompt(generated_sql: str, schema_nodes: List[NodeWithScore], business_terms_nodes: List[NodeWithScore], state=None, tables_info=None) -> str:
+    if state is not None:
+        return build_step_prompt(state, CLEAN_SQL_PROMPT_V4, CLEAN_SQL_SUFFIX_V4, 'cleaning', tables_info, generated_sql=generated_sql)
+
+    # Reconstruct contexts from the nodes for the SQL cleaning prompt
+    schema_context_for_cleaning, _ = SCHEMA_CONTEXT_ASSEMBLER.assemble(schema_nodes)
+    business_terms_context_for_cleaning = "\n\n".join([n.text for n in business_terms_nodes])
+
+    return CLEAN_SQL_PROMPT_V4.format(
+        schema_context=schema_context_for_cleaning,
+        business_terms_context=business_terms_context_for_cleaning,
+        generated_sql=generated_sql
+    )
+
+
 
 def get_value_alt(data, key1, key2):
     try:
@@ -289,22 +687,43 @@ def get_value_alt(data, key1, key2):
         return None
 
 
-def get_thinking_step_response(prompt, key, alt_key, model_name=OLLAMA_MODEL):
-    response = get_llm_response(prompt, model_name=model_name, json_mode=True)
+def build_repair_prompt(response, error, output_cls):
+    return JSON_REPAIR_PROMPT.format(response=response, error=error, schema=json.dumps(output_cls.model_json_schema()))
 
-    try:
-        info_json = json.loads(response)
 
+def get_thinking_step_response(prompt, step, ctx):
+    """
+    Runs a thinking step with its output constrained to the step's schema (STEP_OUTPUT_SCHEMAS).
+    Output that still doesn't validate gets one repair call, after that the step continues with
+    the schema's empty output, so a bad step never returns None. The repair call counts against
+    the step's deadline.
+    Returns the step json as a dict.
+    """
+    output_cls = STEP_OUTPUT_SCHEMAS[step]
+    deadline = ctx.step_deadline(step)
+
+    def repair(response, error):
+        record_retry()
+        return get_routed_llm_response(build_repair_prompt(response, error, output_cls), step, ctx, output_cls=output_cls, deadline=deadline)
 
-        # Lets try to clean up incorrect json schema adherence 
-        info_json[key] = get_value_alt(info_json, key, alt_key)
-        info_json['reasoning'] = get_value_alt(info_json, 'reasoning', 'reason')
-       
-        return info_json
+    response = get_routed_llm_response(prompt, step, ctx, output_cls=output_cls, deadline=deadline)
+    return parse_with_repair(response, output_cls, repair, step).model_dump()
+
+
+async def aget_thinking_step_response(prompt, step, ctx):
+    """
+    Async version of get_thinking_step_response.
+    """
+    output_cls = STEP_OUTPUT_SCHEMAS[step]
+    deadline = ctx.step_deadline(step)
+
+    async def repair(response, error):
+        record_retry()
+        return await aget_routed_llm_response(build_repair_prompt(response, error, output_cls), step, ctx, output_cls=output_cls, deadline=deadline)
+
+    response = await aget_routed_llm_response(prompt, step, ctx, output_cls=output_cls, deadline=deadline)
+    return (await aparse_with_repair(response, output_cls, repair, step)).model_dump()
 
-    except json.JSONDecodeError:
-        print(f"LLM failed to output valid JSON : {response}")
-        return None
 
 #########################################################################
 #▗▄▄▄  ▗▄▖     ▗▄▄▄▖▗▄▄▄▖    ▗▄▄▄▖▗▄▖     ▗▄▄▄▖▗▄▄▄▖
@@ -314,208 +733,365 @@ def get_thinking_step_response(prompt, key, alt_key, model_name=OLLAMA_MODEL):
 #########################################################################
 
 
-def get_model_for_step(step, model_list):
-    global USE_GEMINI
-
+def get_model_for_step(step, model_list, use_gemini=False):
+    """
+    Resolves the (model_name, use_gemini) pair for a thinking step without touching module globals,
+    so steps can run concurrently.
+    """
     if model_list is None:
-        return OLLAMA_MODEL
+        return OLLAMA_MODEL, use_gemini
 
     value = model_list[step]
 
     if  value == 'Gemini':
-        USE_GEMINI = True
-        return "Gemini"
+        return "Gemini", True
     else:
-        USE_GEMINI = False
-        return value
+        return value, False
+
+
+def without_reasoning(data):
+    """
+    Copy of strip_key_from_json that leaves the original dict alone, steps running in parallel share it.
+    """
+    if isinstance(data, dict):
+        data = dict(data)
+    return strip_key_from_json(data)
 
 
+def get_aggregate_info(results):
+    return get_value_alt(results.get('grouping'), 'aggregations', 'aggregation')
 
-#
-#
-# 
-#
-#
 
-def generate_thinking_agent_response(user_question: str, user_id: str = "default_user", use_gemini: bool = False, save_logs=False, test_id=None, use_pro=False, model_list = None) -> str: 
-    global reranker, USE_GEMINI, GEMINI_MODEL
+def build_pipeline_state(cleaned_question, schema_context, business_terms_context):
+    """
+    The inputs shared by steps 3-9, including the shared prompt prefix rendered once.
+    """
+    return {
+        'cleaned_question': cleaned_question,
+        'schema_context': schema_context,
+        'business_terms_context': business_terms_context,
+        'shared_prefix': render_shared_prefix(cleaned_question, schema_context, business_terms_context),
+        # the context sliced to the chosen tables and its prefix, built once by the first step after
+        # the tables step (joins and grouping run concurrently)
+        'sliced': None,
+        'slice_lock': threading.Lock(),
+        # step -> estimated schema context tokens saved by slicing
+        'context_savings': {},
+    }
+
+
+def render_shared_prefix(cleaned_question, schema_context, business_terms_context):
+    return SHARED_CONTEXT_PREFIX.format(
+        schema_context=schema_context,
+        business_terms_context=business_terms_context,
+        query_str=cleaned_question
+    )
+
 
-    USE_GEMINI = use_gemini
+def get_step_context(state, step, tables_info):
+    """
+    (schema_context, prefix) for a step. After the tables step this is the context sliced to the
+    chosen tables, one slice per run so steps 4-9 all send the same prefix. Records the tokens saved
+    per step in state['context_savings'].
+    """
+    if not USE_CONTEXT_SLICING or step is None or not tables_info:
+        return state['schema_context'], state['shared_prefix']
+    with state['slice_lock']:
+        if state['sliced'] is None:
+            schema_context, stats = SCHEMA_CONTEXT_SLICER.slice(state['schema_context'], tables_info, None)
+            prefix = state['shared_prefix']
+            if schema_context != state['schema_context']:
+                prefix = render_shared_prefix(state['cleaned_question'], schema_context, state['business_terms_context'])
+            state['sliced'] = (schema_context, prefix, stats['tokens_full'] - stats['tokens_sliced'])
+        schema_context, prefix, saved = state['sliced']
+        state['context_savings'][step] = saved
+    return schema_context, prefix
+
+
+def report_context_savings(state):
+    savings = state['context_savings']
+    if savings:
+        prefix_tokens = estimate_tokens(state['sliced'][1])
+        cached = "cached by Gemini" if prefix_tokens >= GEMINI_PREFIX_CACHE.min_tokens else "below Gemini's cache minimum"
+        print(f"Context slicing saved ~{sum(savings.values())} schema tokens this run: {savings}, "
+              f"sliced prefix ~{prefix_tokens} tokens shared by {len(savings)} steps ({cached})")
+
+
+def build_step_prompt(state, template, suffix_template, step=None, tables_info=None, **kwargs):
+    """
+    Shared prefix + the step's suffix, or the step's full template when USE_SHARED_PREFIX_PROMPTS is off.
+    step/tables_info slice the schema context for steps after the tables step, see get_step_context.
+    kwargs are the step specific template variables.
+    """
+    schema_context, prefix = get_step_context(state, step, tables_info)
+    if USE_SHARED_PREFIX_PROMPTS:
+        return SharedPrefixPrompt(prefix, suffix_template.format(**kwargs))
+    return template.format(
+        schema_context=schema_context,
+        business_terms_context=state['business_terms_context'],
+        query_str=state['cleaned_question'],
+        original_question=state['cleaned_question'],
+        **kwargs
+    )
 
-    TABLE_PROMPT_VER = "V4"
-    GROUPING_PROMPT_VER = "V4"
-    CALCULATIONS_PROMPT_VER = "V3"
-    FILTERING_PROMPT_VER = "V3"
-    JOIN_PROMPT_VER = "V4"
 
-    COMPLICATED_CALLS = False
+def build_tables_prompt(state, results):
+    return build_step_prompt(state, TABLE_COLUMN_PROMPT_V4, TABLE_COLUMN_SUFFIX_V4)
 
 
-    if model_list is not None:
-        COMPLICATED_CALLS = True
+def build_join_prompt(state, results):
+    return build_step_prompt(state, JOIN_PROMPT_V4, JOIN_SUFFIX_V4, 'joins', results['tables'],
+        identified_tables_columns_json=json.dumps(without_reasoning(results['tables']))
+    )
 
-    print("\n\n------------------------------------")
-    if use_pro:
-        GEMINI_MODEL = GEMINI_PRO_MODEL
-        print("Using Gemini Pro")
-    elif use_gemini:
-        print("Using Gemini Flash")
 
-    
-    #reset status for user
-    delete_process_status(user_id)
+def build_grouping_prompt(state, results):
+    return build_step_prompt(state, GROUPING_PROMPT_V3, GROUPING_SUFFIX_V3, 'grouping', results['tables'],
+        identified_tables_columns_json=json.dumps(without_reasoning(results['tables']))
+    )
 
-    update_process_status(user_id, {'user_question': user_question})
 
-    reranker = set_reranker()
+def build_calculations_prompt(state, results):
+    return build_step_prompt(state, CALCULATIONS_PROMPT_V3, CALCULATIONS_SUFFIX_V3, 'calculations', results['tables'],
+        aggregate_info=get_aggregate_info(results),
+        identified_tables_columns_json=json.dumps(without_reasoning(results['tables']))
+    )
 
-    print("\n--- Step 1: cleaning user question ---")
-    cleaned_question_info = clean_user_question(user_question)
 
-    cancel_process = get_value_alt(cleaned_question_info, 'cancel_process', 'cancel')
-    if cancel_process:
-        print('\n\nLLM DETERMINED INVALID QUESTION: CANCEL PROCESS')
-        return
+def build_filtering_prompt(state, results):
+    return build_step_prompt(state, FILTERING_PROMPT_V3, FILTERING_SUFFIX_V3, 'filtering', results['tables'],
+        aggregate_info=get_aggregate_info(results),
+        identified_tables_columns_json=json.dumps(without_reasoning(results['tables']))
+    )
 
-    cleaned_question = cleaned_question_info.get('rephrased_question')
 
-    if not cleaned_question:
-        #print("Clean question prompt did not return valid 'rephrased_question'")
-        cleaned_question = cleaned_question_info.get('rephrased')
-        if not cleaned_question:
-            cleaned_question = cleaned_question_info.get('rephr_question')
-            if not cleaned_question:
-                print("Clean question prompt did not return a valid response.")
-                cleaned_question = user_question
+# Prompt versions recorded in the prompt logs
+PROMPT_VERSIONS = {
+    'tables': "V4",
+    'grouping': "V4",
+    'calculations': "V3",
+    'filtering': "V3",
+    'joins': "V4",
+}
 
-    cleaned_question_info['rephrased_question'] = cleaned_question
-    update_process_status(user_id, {'cleaned_question': json.dumps(cleaned_question_info)})
 
-    print("\n--- Step 2: RAG CALL ---")
-    schema_context_str, business_terms_context_str, schema_nodes, business_terms_nodes = get_rag_context(cleaned_question)
+def build_sql_gen_prompt(state, step_results):
+    """
+    Final SQL Generation prompt consolidates all the decisions from the thinking steps.
+    """
+    return build_step_prompt(state, SQL_GEN_PROMPT_TEMPLATE_V4, SQL_GEN_SUFFIX_V4, 'generation', step_results['tables'],
+        identified_tables_columns=json.dumps(without_reasoning(step_results['tables'])),
+        grouping_details=json.dumps(step_results['grouping']),
+        calculation_details=json.dumps(step_results['calculations']),
+        filtering_details=json.dumps(step_results['filtering']),
+        aggregate_info=get_aggregate_info(step_results),
+        #complex_aggregate_info =get_value_alt(grouping_info, "complex_aggregations", "complex_aggregation")
+        complex_aggregate_info="",
+        join_info=json.dumps(step_results['joins']),
+        )
 
-    #tables and columns
-    print("\n--- Step 3: Determining Tables and Columns ---")
-    tables_prompt = TABLE_COLUMN_PROMPT_V4.format(
-        schema_context=schema_context_str,
-        query_str=cleaned_question
-    )
-    #print(f'\n --- DEBUG TABLES PROMPT:\n\n{tables_prompt}\n---------------------\n')
 
-    model = get_model_for_step(0,model_list)
-    tables_and_columns = get_thinking_step_response(tables_prompt, 'tables', 'table', model_name=model)
+def save_prompt_logs(test_id, step_results):
+    log_response_json = {
+        "ID":test_id,
+        "table prompt ver": PROMPT_VERSIONS['tables'],
+        "table prompt result": json.dumps(without_reasoning(step_results['tables'])),
+        "grouping prompt ver": PROMPT_VERSIONS['grouping'],
+        "grouping prompt result": json.dumps(step_results['grouping']),
+        "calculations prompt ver": PROMPT_VERSIONS['calculations'],
+        "calculations prompt result": json.dumps(step_results['calculations']),
+        "filtering prompt ver": PROMPT_VERSIONS['filtering'],
+        "filtering prompt result": json.dumps(step_results['filtering']),
+        "join prompt ver": PROMPT_VERSIONS['joins'],
+        "join prompt result": json.dumps(step_results['joins']),
+    }
+    now = datetime.now()
+    timestamp_str = now.strftime("%Y-%m-%d_%H-%M")
+    filename = f"./prompt_logs/prompt_log_{timestamp_str}.json"
+    with open(filename, 'w') as f:
+        json.dump(log_response_json, f, indent=4)
+    print(f'Prompt Logs saved to: {filename}')
+
+
+# The thinking steps as a dependency graph. Joins and grouping only need the tables,
+# calculations and filtering need the aggregations from grouping.
+# 'model_step' is the index into model_list, the step's json schema is STEP_OUTPUT_SCHEMAS[name].
+THINKING_STEPS = {
+    'tables': {"number": 3, "title": "Determining Tables and Columns", "deps": [], "model_step": 0, "build_prompt": build_tables_prompt},
+    'joins': {"number": 4, "title": "Determining Joins", "deps": ['tables'], "model_step": 1, "build_prompt": build_join_prompt},
+    'grouping': {"number": 5, "title": "Determining Grouping", "deps": ['tables'], "model_step": 2, "build_prompt": build_grouping_prompt},
+    'calculations': {"number": 6, "title": "Determining Calculations", "deps": ['grouping'], "model_step": 3, "build_prompt": build_calculations_prompt},
+    'filtering': {"number": 7, "title": "Determining Filtering", "deps": ['grouping'], "model_step": 4, "build_prompt": build_filtering_prompt},
+}
+
+
+def run_thinking_steps(state, ctx):
+    """
+    Runs steps 3-7 through the DAG executor, so independent LLM calls are in flight at the same time
+    and latency follows the critical path (tables -> grouping -> calculations/filtering).
+    Each step writes its own status as soon as it finishes.
+    Returns step name -> step json.
+    """
+    def make_step(name, spec):
+        # the step counts against the concurrency limit of its first choice backend
+        use_gemini = ctx.candidates(name)[0]['use_gemini']
 
-    update_process_status(user_id, {'tables': json.dumps(tables_and_columns)})
+        def run(results):
+            print(f"\n--- Step {spec['number']}: {spec['title']} ---")
+            start_progress_step(ctx.run_id, name)
+            prompt = spec['build_prompt'](state, results)
+            with span(name, ctx.run_id, queue_wait=STEP_QUEUE_WAIT.get()):
+                info = get_thinking_step_response(prompt, name, ctx)
+            publish_progress(ctx.run_id, {name: json.dumps(info)})
+            return info
 
-   
-    # Determine Joins
-    print("\n--- Step 4: Determining Joins ---")
-    join_prompt = JOIN_PROMPT_V4.format(
-        schema_context=schema_context_str,
-        query_str=cleaned_question,
-        identified_tables_columns_json=json.dumps(strip_key_from_json(tables_and_columns))
-    )
-    model = get_model_for_step(1,model_list)
-    join_info =get_thinking_step_response(join_prompt, "joins","join", model_name=model)
-    update_process_status(user_id, {'joins': json.dumps(join_info)})
-
-    # Determine Grouping
-    print("\n--- Step 5: Determining Grouping ---")
-    group_prompt = GROUPING_PROMPT_V3.format(
-        schema_context=schema_context_str,
-        business_terms_context=business_terms_context_str,
-        query_str=cleaned_question,
-        identified_tables_columns_json=json.dumps(strip_key_from_json(tables_and_columns))
-    )
+        return {"deps": spec['deps'], "fn": run, "backend": "gemini" if use_gemini else "ollama"}
 
-    model = get_model_for_step(2,model_list)
+    steps = {name: make_step(name, spec) for name, spec in THINKING_STEPS.items()}
+    return run_dag(steps, max_workers=DAG_MAX_WORKERS, backend_limits=BACKEND_LIMITS)
 
-    grouping_info = get_thinking_step_response(group_prompt, "group_by_columns", 'group_by', model_name = model)
-    aggregate_info = get_value_alt(grouping_info, 'aggregations', 'aggregation')
-    #complex_aggregate_info =get_value_alt(grouping_info, "complex_aggregations", "complex_aggregation")
-    complex_aggregate_info =""
 
-    update_process_status(user_id, {'grouping': json.dumps(grouping_info)})
 
+def get_question_cache_signature(use_gemini, gemini_model, model_list):
+    """
+    Identifies the prompt versions and models an answer was produced with.
+    Only answers with the same signature are served from the question cache.
+    """
+    return json.dumps({
+        "prompts": PROMPT_VERSIONS,
+        "backend": "gemini" if use_gemini else "ollama",
+        "gemini_model": gemini_model if use_gemini else None,
+        "model_list": model_list,
+        "shared_prefix": USE_SHARED_PREFIX_PROMPTS,
+    }, sort_keys=True)
 
-    # Determine Calculations
-    print("\n--- Step 6: Determining Calculations ---")
-    calculations_prompt = CALCULATIONS_PROMPT_V3.format(
-        schema_context=schema_context_str,
-        business_terms_context=business_terms_context_str,
-        query_str=cleaned_question,
-        aggregate_info=aggregate_info,
-        identified_tables_columns_json=json.dumps(strip_key_from_json(tables_and_columns))
-    )
 
-    model = get_model_for_step(3,model_list)
-    calculations_info = get_thinking_step_response(calculations_prompt, "calculations", 'calculation', model_name = model)
+def get_cached_answer_updates(cached_answer):
+    """
+    Status updates that replay a cached answer's step outputs and SQL in one write.
+    """
+    updates = {name: json.dumps(cached_answer['steps'].get(name)) for name in THINKING_STEPS}
+    updates['sql'] = cached_answer['sql']
+    return updates
 
-    update_process_status(user_id, {'calculations': json.dumps(calculations_info)})
 
+def get_run_status(result, ctx):
+    """
+    Final status of a run that returned normally: 'done' with SQL, ctx.outcome (e.g. 'rejected')
+    if the run ended early, 'no_sql' otherwise. Only RunCancelled makes a run 'cancelled'.
+    """
+    if ctx.outcome:
+        return ctx.outcome
+    return 'done' if result else 'no_sql'
 
-    # Determine Filtering
-    print("\n--- Step 7: Determining Filtering ---")
-    filtering_prompt = FILTERING_PROMPT_V3.format(
-        schema_context=schema_context_str,
-        business_terms_context=business_terms_context_str,
-        query_str=cleaned_question,
-        aggregate_info=aggregate_info,
-        identified_tables_columns_json=json.dumps(strip_key_from_json(tables_and_columns))
-    )
 
-    model = get_model_for_step(4,model_list)
-    filtering_info = get_thinking_step_response(filtering_prompt, "filters", 'filtering', model_name=model)
+#
+#
+# 
+#
+#
+
+def generate_thinking_agent_response(user_question: str, user_id: str = "default_user", use_gemini: bool = False, save_logs=False, test_id=None, use_pro=False, model_list = None, use_question_cache=None, run_id=None, raise_aborted=False) -> str: 
+    """
+    Runs the pipeline as a new run of user_id. Progress is published under the run_id, so a user
+    can have several runs in flight and earlier runs stay in the history.
+    A cancelled or timed out run returns "", or raises RunCancelled / RunTimeout with raise_aborted.
+    """
+    return run_thinking_agent(user_question, user_id, use_gemini, save_logs, test_id, use_pro, model_list, use_question_cache, run_id, raise_aborted)[0]
 
-    update_process_status(user_id, {'filtering': json.dumps(filtering_info)})
-    
-    print("\n--- Step 8: SQL Generation ---")
-    # Final SQL Generation prompt would then consolidate all these decisions
-    final_sql_gen_prompt = SQL_GEN_PROMPT_TEMPLATE_V4.format( 
-        schema_context=schema_context_str,
-        business_terms_context=business_terms_context_str,
-        original_question=cleaned_question,
-        identified_tables_columns=json.dumps(strip_key_from_json(tables_and_columns)),
-        grouping_details=json.dumps(grouping_info),
-        calculation_details=json.dumps(calculations_info),
-        filtering_details=json.dumps(filtering_info),
-        aggregate_info=aggregate_info,
-        complex_aggregate_info=complex_aggregate_info,
-        join_info=json.dumps(join_info),
-        )
 
-    raw_sql = get_llm_response(final_sql_gen_prompt)
+def run_thinking_agent(user_question: str, user_id: str = "default_user", use_gemini: bool = False, save_logs=False, test_id=None, use_pro=False, model_list = None, use_question_cache=None, run_id=None, raise_aborted=False):
+    """
+    generate_thinking_agent_response, returning (result, status) with the status the run was
+    finished with (see get_run_status), so the job queue records the same outcome.
+    """
+    run_id = start_progress_run(user_id, user_question, run_id)
+    ctx = PipelineContext.from_request(use_gemini, use_pro, model_list, run_id)
+    status = 'failed'
+    try:
+        with span('pipeline', run_id):
+            result = _generate_thinking_agent_response(user_question, ctx, save_logs, test_id, use_question_cache)
+        status = get_run_status(result, ctx)
+        return result, status
+    except RunAborted as e:
+        print(f"Run stopped: {e}")
+        status = 'cancelled' if isinstance(e, RunCancelled) else 'timeout'
+        if raise_aborted:
+            raise
+        return "", status
+    finally:
+        ctx.control.finish()
+        unregister_run(run_id)
+        finish_progress_run(run_id, status)
+
+
+def _generate_thinking_agent_response(user_question, ctx, save_logs, test_id, use_question_cache):
+    run_id = ctx.run_id
+
+    print("\n\n------------------------------------")
+    if ctx.use_gemini:
+        print(f"Using {ctx.gemini_model}")
+
+    publish_progress(run_id, {'user_question': user_question})
+
+    print("\n--- Step 1: cleaning user question ---")
+    start_progress_step(run_id, 'cleaned_question')
+    with span('clean_user_question', run_id):
+        cleaned_question_info = clean_user_question(user_question, ctx) or {}
+
+    cancel_process = get_value_alt(cleaned_question_info, 'cancel_process', 'cancel')
+    if cancel_process:
+        print('\n\nLLM DETERMINED INVALID QUESTION: CANCEL PROCESS')
+        ctx.outcome = 'rejected'
+        return
+
+    cleaned_question = get_cleaned_question(cleaned_question_info, user_question)
+    publish_progress(run_id, {'cleaned_question': json.dumps(cleaned_question_info)})
+
+    if use_question_cache is None:
+        use_question_cache = USE_QUESTION_CACHE
+    cache_signature = ctx.cache_signature()
+    if use_question_cache:
+        cached_answer = QUESTION_CACHE.lookup(cleaned_question, cache_signature)
+        if cached_answer is not None:
+            print("\n--- Answered from question cache, skipping steps 2-9 ---")
+            publish_progress(run_id, get_cached_answer_updates(cached_answer))
+            if save_logs:
+                save_prompt_logs(test_id, cached_answer['steps'])
+            return cached_answer['sql']
+
+    print("\n--- Step 2: RAG CALL ---")
+    with span('get_rag_context', run_id):
+        schema_context_str, business_terms_context_str, schema_nodes, business_terms_nodes, rag_timings = get_rag_context(cleaned_question, ctx.reranker)
+
+    state = build_pipeline_state(cleaned_question, schema_context_str, business_terms_context_str)
+
+    # Steps 3-7 run as a dependency graph
+    step_results = run_thinking_steps(state, ctx)
+
+    print("\n--- Step 8: SQL Generation ---")
+    start_progress_step(run_id, 'sql')
+    # partial SQL is streamed into the run history so the UI shows it while it is written
+    with span('generation', run_id):
+        raw_sql = get_routed_llm_response(build_sql_gen_prompt(state, step_results), 'generation', ctx, on_token=make_status_streamer(run_id, control=ctx.control))
         
     if not raw_sql:
         print("Error: could not generate SQL for that question.")
         return "\nCould not generate a SQL query for that question based on the available context."
     
     print("\n--- Step 9: CLEANED SQL  ---")
-    final_sql = clean_generated_sql(raw_sql, schema_nodes, business_terms_nodes)
+    with span('cleaning', run_id):
+        final_sql = clean_generated_sql(raw_sql, schema_nodes, business_terms_nodes, on_token=make_status_streamer(run_id, control=ctx.control), ctx=ctx, state=state, tables_info=step_results['tables'])
 
-    update_process_status(user_id, {'sql': final_sql})
+    publish_progress(run_id, {'sql': final_sql})
+    report_context_savings(state)
+
+    if use_question_cache and final_sql:
+        QUESTION_CACHE.store(cleaned_question, cache_signature, final_sql, step_results)
 
 
     if save_logs:
-        log_response_json = {
-            "ID":test_id,
-            "table prompt ver": TABLE_PROMPT_VER,
-            "table prompt result": json.dumps(tables_and_columns),
-            "grouping prompt ver": GROUPING_PROMPT_VER,
-            "grouping prompt result": json.dumps(grouping_info),
-            "calculations prompt ver": CALCULATIONS_PROMPT_VER,
-            "calculations prompt result": json.dumps(calculations_info),
-            "filtering prompt ver": FILTERING_PROMPT_VER,
-            "filtering prompt result": json.dumps(filtering_info),
-            "join prompt ver": JOIN_PROMPT_VER,
-            "join prompt result": json.dumps(join_info),
-        }
-        now = datetime.now()
-        timestamp_str = now.strftime("%Y-%m-%d_%H-%M")
-        filename = f"./prompt_logs/prompt_log_{timestamp_str}.json"
-        with open(filename, 'w') as f:
-            json.dump(log_response_json, f, indent=4)
-        print(f'Prompt Logs saved to: {filename}')
+        save_prompt_logs(test_id, step_results)
 
 
     if final_sql:
@@ -529,7 +1105,7 @@ def generate_agent_response(user_question: str) -> str:
         print('Warning: failed to clean the uesr question!')
         cleaned_question = user_question
 
-    schema_context, business_terms_context, schema_nodes, business_terms_nodes = get_rag_context(cleaned_question)
+    schema_context, business_terms_context, schema_nodes, business_terms_nodes, rag_timings = get_rag_context(cleaned_question)
     raw_sql = generate_sql_query(cleaned_question, schema_context, business_terms_context)
         
     if not raw_sql:
@@ -547,6 +1123,284 @@ def generate_agent_response(user_question: str) -> str:
         return f"\nFailed to clean SQL, or the generated SQL was invalid. Original generated SQL:\n{raw_sql}"
 
 
+#########################################################################
+# ASYNC
+# asyncio-native version of the pipeline: one event loop can serve many
+# questions without holding a thread per in-flight LLM call.
+#########################################################################
+async def aask_gemini_json(prompt, use_json=True, model='models/gemini-2.0-flash-lite', output_cls=None):
+    gemini, contents = await asyncio.to_thread(get_gemini_request, prompt, model, use_json, output_cls)
+    with LLM_POOL.track(gemini_pool_key(model, use_json, output_cls)):
+        response = await gemini.generate_content_async(contents)
+    record_llm_call("gemini", model, prompt, response.text, response)
+    return response.text
+
+
+async def astream_llm_response(prompt, model_name, json_mode, use_gemini, gemini_model, on_token):
+    """
+    Async version of stream_llm_response, on_token is a coroutine function.
+    """
+    text = ""
+    chunk = None
+    if use_gemini:
+        gemini_model = gemini_model or GEMINI_MODEL
+        gemini, contents = await asyncio.to_thread(get_gemini_request, prompt, gemini_model, json_mode)
+        with LLM_POOL.track(gemini_pool_key(gemini_model, json_mode)):
+            async for chunk in await gemini.generate_content_async(contents, stream=True):
+                text += chunk.text
+                await on_token(text)
+        record_llm_call("gemini", gemini_model, prompt, text, chunk)
+    else:
+        llm = get_llm(model_name, json_mode=json_mode)
+        with LLM_POOL.track(("ollama", model_name, json_mode)):
+            async for chunk in await llm.astream_complete(prompt):
+                text = chunk.text
+                await on_token(text)
+        record_llm_call("ollama", model_name, prompt, text, chunk)
+    return text
+
+
+def amake_status_streamer(run_id, field='sql_draft', min_interval=STREAM_STATUS_INTERVAL, control=None):
+    """
+    Async version of make_status_streamer.
+    """
+    last_write = [0.0]
+
+    async def on_token(text):
+        if control is not None and (control.finished or control.cancelled()):
+            return
+        now = time.perf_counter()
+        persist = now - last_write[0] >= min_interval
+        if persist:
+            last_write[0] = now
+        await apublish_progress(run_id, {field: text}, persist=persist)
+
+    return on_token
+
+
+async def aget_llm_response(prompt, model_name=OLLAMA_MODEL, json_mode=False, use_gemini=False, gemini_model=None, on_token=None, output_cls=None, control=None, deadline=None):
+    cache_model = get_cache_model_key(model_name, use_gemini, gemini_model, output_cls)
+    json_mode = json_mode or output_cls is not None
+    if USE_LLM_CACHE:
+        cached = await asyncio.to_thread(LLM_CACHE.get, cache_model, json_mode, prompt)
+        if cached is not None:
+            print(f"Response (cached): '{cached}'")
+            record_llm_call(*cache_model.split(":", 1), prompt, cached, cache_hit=True)
+            if on_token is not None:
+                await on_token(cached)
+            return cached
+
+    async def call():
+        if on_token is not None:
+            return await astream_llm_response(prompt, model_name, json_mode, use_gemini, gemini_model, on_token)
+        if use_gemini:
+            return await aask_gemini_json(prompt, use_json=json_mode, model=gemini_model or GEMINI_MODEL, output_cls=output_cls)
+        llm = get_llm(model_name, json_mode=json_mode)
+        if output_cls is not None:
+            with LLM_POOL.track(("ollama", model_name, json_mode)):
+                response = await llm.achat([ChatMessage(role="user", content=str(prompt))], format=output_cls.model_json_schema())
+            record_llm_call("ollama", model_name, prompt, response.message.content or "", response)
+            return response.message.content or ""
+        with LLM_POOL.track(("ollama", model_name, json_mode)):
+            response = await llm.acomplete(prompt)
+        record_llm_call("ollama", model_name, prompt, str(response), response)
+        return str(response)
+
+    try:
+        response = await acall_with_retry(call, control or RunControl(), deadline, LLM_RETRY_POLICY, on_retry=report_llm_retry)
+        cleaned = clean_response(response)
+        print(f"Response: '{cleaned}'")
+        if USE_LLM_CACHE and cleaned:
+            await asyncio.to_thread(LLM_CACHE.put, cache_model, json_mode, prompt, cleaned)
+        return cleaned
+    except RunAborted:
+        raise
+    except Exception as e:
+        print(f"Error with LLM response: {e}")
+        return ""
+
+
+async def aget_routed_llm_response(prompt, step, ctx, json_mode=False, on_token=None, output_cls=None, deadline=None):
+    """
+    Async version of get_routed_llm_response.
+    """
+    deadline = deadline or ctx.step_deadline(step)
+    for attempt, llm_args in enumerate(ctx.candidates(step)):
+        if not step_time_left(step, ctx, deadline):
+            break
+        if attempt > 0:
+            print(f"Step '{step}': falling back to {'gemini/' + llm_args['gemini_model'] if llm_args['use_gemini'] else 'ollama/' + llm_args['model_name']}")
+            record_retry()
+        with routed_step(step):
+            response = await aget_llm_response(prompt, json_mode=json_mode, on_token=on_token, output_cls=output_cls, control=ctx.control, deadline=deadline, **llm_args)
+        if response:
+            return response
+    return ""
+
+
+async def aget_rag_context(user_question: str, reranker=None) -> tuple[str, str, List[NodeWithScore], List[NodeWithScore], dict]:
+    """
+    Async version of get_rag_context. Embeds the question once and awaits both retrievers together.
+    """
+    timings = {}
+    total_start = time.perf_counter()
+
+    phase_start = time.perf_counter()
+    query_embedding = await get_embed_model().aget_query_embedding(user_question)
+    query_bundle = QueryBundle(query_str=user_question, embedding=query_embedding)
+    timings['embed'] = time.perf_counter() - phase_start
+
+    print("Retrieving context from schema and business terms collections...")
+    phase_start = time.perf_counter()
+    schema_index, business_terms_index = await asyncio.gather(
+        asyncio.to_thread(get_cached_vector_storage_index, SCHEMA_COLLECTION_NAME),
+        asyncio.to_thread(get_cached_vector_storage_index, BUSINESS_TERMS_COLLECTION_NAME),
+    )
+    schema_nodes, business_terms_nodes = await asyncio.gather(
+        VectorIndexRetriever(index=schema_index, similarity_top_k=RETRIEVAL_TOP_K).aretrieve(query_bundle),
+        VectorIndexRetriever(index=business_terms_index, similarity_top_k=RETRIEVAL_TOP_K).aretrieve(query_bundle),
+    )
+    timings['retrieve'] = time.perf_counter() - phase_start
+
+    # reranking is CPU bound, keep it off the event loop
+    result = await asyncio.to_thread(assemble_rag_context, user_question, schema_nodes, business_terms_nodes, timings, reranker)
+
+    timings['total'] = time.perf_counter() - total_start
+    print("RAG timings: " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
+
+    return result
+
+
+async def arun_thinking_steps(state, ctx):
+    """
+    Async version of run_thinking_steps, using the same THINKING_STEPS graph.
+    """
+    def make_step(name, spec):
+        use_gemini = ctx.candidates(name)[0]['use_gemini']
+
+        async def run(results):
+            print(f"\n--- Step {spec['number']}: {spec['title']} ---")
+            await astart_progress_step(ctx.run_id, name)
+            prompt = spec['build_prompt'](state, results)
+            with span(name, ctx.run_id, queue_wait=STEP_QUEUE_WAIT.get()):
+                info = await aget_thinking_step_response(prompt, name, ctx)
+            await apublish_progress(ctx.run_id, {name: json.dumps(info)})
+            return info
+
+        return {"deps": spec['deps'], "fn": run, "backend": "gemini" if use_gemini else "ollama"}
+
+    steps = {name: make_step(name, spec) for name, spec in THINKING_STEPS.items()}
+    return await arun_dag(steps, backend_limits=BACKEND_LIMITS)
+
+
+async def agenerate_thinking_agent_response(user_question: str, user_id: str = "default_user", use_gemini: bool = False, save_logs=False, test_id=None, use_pro=False, model_list = None, use_question_cache=None, run_id=None, raise_aborted=False) -> str:
+    """
+    asyncio version of generate_thinking_agent_response. Does not touch the module level
+    backend globals, so many runs can share one event loop.
+    """
+    return (await arun_thinking_agent(user_question, user_id, use_gemini, save_logs, test_id, use_pro, model_list, use_question_cache, run_id, raise_aborted))[0]
+
+
+async def arun_thinking_agent(user_question: str, user_id: str = "default_user", use_gemini: bool = False, save_logs=False, test_id=None, use_pro=False, model_list = None, use_question_cache=None, run_id=None, raise_aborted=False):
+    """
+    Async version of run_thinking_agent.
+    """
+    run_id = await astart_progress_run(user_id, user_question, run_id)
+    ctx = PipelineContext.from_request(use_gemini, use_pro, model_list, run_id)
+    status = 'failed'
+    try:
+        with span('pipeline', run_id):
+            result = await _agenerate_thinking_agent_response(user_question, ctx, save_logs, test_id, use_question_cache)
+        status = get_run_status(result, ctx)
+        return result, status
+    except RunAborted as e:
+        print(f"Run stopped: {e}")
+        status = 'cancelled' if isinstance(e, RunCancelled) else 'timeout'
+        if raise_aborted:
+            raise
+        return "", status
+    finally:
+        ctx.control.finish()
+        unregister_run(run_id)
+        await afinish_progress_run(run_id, status)
+
+
+async def _agenerate_thinking_agent_response(user_question, ctx, save_logs, test_id, use_question_cache):
+    run_id = ctx.run_id
+
+    print("\n\n------------------------------------")
+    if ctx.use_gemini:
+        print(f"Using {ctx.gemini_model}")
+
+    await apublish_progress(run_id, {'user_question': user_question})
+
+    print("\n--- Step 1: cleaning user question ---")
+    await astart_progress_step(run_id, 'cleaned_question')
+    with span('clean_user_question', run_id):
+        response = await aget_routed_llm_response(build_clean_question_prompt(user_question), 'clean_user_question', ctx, json_mode=True)
+    cleaned_question_info = parse_clean_question_response(response) or {}
+
+    cancel_process = get_value_alt(cleaned_question_info, 'cancel_process', 'cancel')
+    if cancel_process:
+        print('\n\nLLM DETERMINED INVALID QUESTION: CANCEL PROCESS')
+        ctx.outcome = 'rejected'
+        return
+
+    cleaned_question = get_cleaned_question(cleaned_question_info, user_question)
+    await apublish_progress(run_id, {'cleaned_question': json.dumps(cleaned_question_info)})
+
+    if use_question_cache is None:
+        use_question_cache = USE_QUESTION_CACHE
+    cache_signature = ctx.cache_signature()
+    if use_question_cache:
+        cached_answer = await asyncio.to_thread(QUESTION_CACHE.lookup, cleaned_question, cache_signature)
+        if cached_answer is not None:
+            print("\n--- Answered from question cache, skipping steps 2-9 ---")
+            await apublish_progress(run_id, get_cached_answer_updates(cached_answer))
+            if save_logs:
+                await asyncio.to_thread(save_prompt_logs, test_id, cached_answer['steps'])
+            return cached_answer['sql']
+
+    print("\n--- Step 2: RAG CALL ---")
+    with span('get_rag_context', run_id):
+        schema_context_str, business_terms_context_str, schema_nodes, business_terms_nodes, rag_timings = await aget_rag_context(cleaned_question, ctx.reranker)
+
+    state = build_pipeline_state(cleaned_question, schema_context_str, business_terms_context_str)
+
+    # Steps 3-7 run as a dependency graph
+    step_results = await arun_thinking_steps(state, ctx)
+
+    print("\n--- Step 8: SQL Generation ---")
+    await astart_progress_step(run_id, 'sql')
+    with span('generation', run_id):
+        raw_sql = await aget_routed_llm_response(build_sql_gen_prompt(state, step_results), 'generation', ctx, on_token=amake_status_streamer(run_id, control=ctx.control))
+
+    if not raw_sql:
+        print("Error: could not generate SQL for that question.")
+        return "\nCould not generate a SQL query for that question based on the available context."
+
+    print("\n--- Step 9: CLEANED SQL  ---")
+    with span('cleaning', run_id):
+        final_sql = await aget_routed_llm_response(build_clean_sql_prompt(raw_sql, schema_nodes, business_terms_nodes, state, step_results['tables']), 'cleaning', ctx, on_token=amake_status_streamer(run_id, control=ctx.control))
+    if final_sql == "":
+        print("error cleaning sql")
+        final_sql = raw_sql
+
+    await apublish_progress(run_id, {'sql': final_sql})
+    report_context_savings(state)
+
+    if use_question_cache and final_sql:
+        await asyncio.to_thread(QUESTION_CACHE.store, cleaned_question, cache_signature, final_sql, step_results)
+
+    if save_logs:
+        await asyncio.to_thread(save_prompt_logs, test_id, step_results)
+
+    if final_sql:
+        return final_sql
+    else:
+        return f"\nFailed to clean SQL, or the generated SQL was invalid. Original generated SQL:\n{raw_sql}"
+
+
 #########################################################################
 #▗▄▄▄▖▗▄▄▄▖ ▗▄▄▖▗▄▄▄▖
 #  █  ▐▌   ▐▌     █  
@@ -574,4 +1428,11 @@ if __name__ == "__main__":
         if sql_result:
             print(f"\nGenerated SQL:\n{sql_result}")
         else:
-            print("\nCould not generate a SQL query for that question based on the available context.")
\ No newline at end of file
+            print("\nCould not generate a SQL query for that question based on the available context.")
+
+        LLM_POOL.print_stats()
+        if USE_MODEL_ROUTER:
+            MODEL_ROUTER.print_stats()
+        if USE_GEMINI_CONTEXT_CACHE:
+            print(f"Gemini prefix cache: {GEMINI_PREFIX_CACHE.metrics()}")
+        print(f"LLM cache: {LLM_CACHE.metrics()}")
@@ -4,14 +4,17 @@
 #
 # Copyright (c) 2025 Michael Powers
 #
-# Usage: python3 injest.py 
-# Note: the collections are rebuilt each run
-#   
+# Usage: python3 injest.py [--rebuild]
+#        python3 injest.py --benchmark --docs 2000 -> docs/sec, per document inserts vs batched upserts
+# Note: ingestion is incremental, only added, changed or removed documents are
+#   embedded or deleted (see sync_collection). --rebuild drops the collections first.
 # 
 #
 
 import os
 import json
+import hashlib
+import time
 import pandas as pd
 from llama_index.core import Document, VectorStoreIndex, Settings
 from llama_index.llms.ollama import Ollama
@@ -19,8 +22,13 @@ from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.embeddings.ollama import OllamaEmbedding
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 import chromadb
 import argparse
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from pathlib import Path
 
 #########################################################################
@@ -37,33 +45,95 @@ CHROMA_DB_PATH = "./chroma_db"
 OLLAMA_MODEL = "llama3.1:8b"
 SCHEMA_COLLECTION_NAME = "sql_schema_metadata_collection"
 BUSINESS_TERMS_COLLECTION_NAME = "business_terms_collection"
+QUESTION_CACHE_COLLECTION_NAME = "question_cache_collection"
 
 EMBEDDING_MODEL_NOT_SET = True
 
+# Incremental ingestion: every node carries the hash of its content and the file it came from.
+# Neither is part of the text that is embedded or shown to the LLM.
+SYNC_METADATA_KEYS = ["content_hash", "source_id"]
+# nodes per Chroma upsert, and texts per encoder forward pass
+INGEST_BATCH_SIZE = 256
+EMBED_BATCH_SIZE = 64
+# parser processes, and how many parsed nodes may wait for the embedding stage
+PARSE_WORKERS = max(1, min(8, (os.cpu_count() or 2) - 1))
+PARSE_QUEUE_SIZE = 1024
+
 
 
 def configure_embeddings():
     global EMBEDDING_MODEL_NOT_SET
     print('configuring embeddings...')
     Settings.llm = Ollama(model=OLLAMA_MODEL, temperature=0.1, request_timeout=600)
-    Settings.embed_model = HuggingFaceEmbedding( model_name = "BAAI/bge-small-en-v1.5") # sql_schema_metadata_collection
+    Settings.embed_model = HuggingFaceEmbedding( model_name = "BAAI/bge-small-en-v1.5", embed_batch_size=EMBED_BATCH_SIZE) # sql_schema_metadata_collection
     #Settings.embed_model = HuggingFaceEmbedding( model_name = "BAAI/bge-large-en") # sql_schema_metadata_collection_large
     #Settings.embed_model = OllamaEmbedding( model_name = "nomic-embed-text:latest") # sql_schema_metadata_collection_nomic
     EMBEDDING_MODEL_NOT_SET = False
 
 # ChromaDB config
 
+# Long lived indexes, keyed by (collection_name, embedding model name), with the id of the
+# collection they were built on. Rebuilding the PersistentClient + VectorStoreIndex is expensive,
+# so query time callers should use get_cached_vector_storage_index() and only pay for the ANN query.
+# Reentrant: the index is built, and the client created, while the lock is held
+_CHROMA_CLIENT = None
+_INDEX_REGISTRY = {}
+_INDEX_REGISTRY_LOCK = threading.RLock()
+
+
+def get_embed_model():
+    """
+    Returns the configured embedding model, configuring it on first use.
+    """
+    if EMBEDDING_MODEL_NOT_SET:
+        configure_embeddings()
+    return Settings.embed_model
+
+
+def get_embed_model_name():
+    """
+    Returns a stable name for the configured embedding model, used in the index registry key.
+    """
+    embed_model = get_embed_model()
+    return getattr(embed_model, "model_name", None) or type(embed_model).__name__
+
+
+def get_chroma_client():
+    """
+    Returns the process wide chromadb client, creating it on first use.
+    """
+    global _CHROMA_CLIENT
+    if _CHROMA_CLIENT is None:
+        # the DAG and retrieval threads can get here at the same time
+        with _INDEX_REGISTRY_LOCK:
+            if _CHROMA_CLIENT is None:
+                _CHROMA_CLIENT = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    return _CHROMA_CLIENT
+
+
+def get_collection_id(collection_name):
+    """
+    Id of the collection as it is stored now, None if it does not exist. A collection that was
+    dropped and created again, e.g. by python3 injest.py --rebuild in another process, has a new id.
+    """
+    try:
+        return get_chroma_client().get_collection(collection_name).id
+    except Exception:
+        return None
+
+
 def get_vector_storage_index(collection_name=SCHEMA_COLLECTION_NAME, delete_existing=False):
  
 
     if EMBEDDING_MODEL_NOT_SET:
         configure_embeddings()
     try:
-        db = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+        db = get_chroma_client()
         if delete_existing:
             if collection_name in [c.name for c in db.list_collections()]:
                 db.delete_collection(collection_name)
                 print(f"Deleted existing collection: {collection_name}")
+            invalidate_vector_storage_index(collection_name)
 
         chroma_collection = db.get_or_create_collection(collection_name)
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
@@ -76,6 +146,270 @@ def get_vector_storage_index(collection_name=SCHEMA_COLLECTION_NAME, delete_exis
         return None
 
 
+def get_cached_vector_storage_index(collection_name=SCHEMA_COLLECTION_NAME):
+    """
+    Returns a long lived index for the collection from the registry, building it once per
+    (collection_name, embedding model). Failed builds are not cached so the next call retries.
+    The cached index is rebuilt when the collection's id changed, i.e. it was dropped and created
+    again by another process, which invalidate_vector_storage_index() can't reach.
+    """
+    key = (collection_name, get_embed_model_name())
+    collection_id = get_collection_id(collection_name)
+    entry = _INDEX_REGISTRY.get(key)
+    if entry is not None and collection_id is not None and entry[1] == collection_id:
+        return entry[0]
+
+    with _INDEX_REGISTRY_LOCK:
+        entry = _INDEX_REGISTRY.get(key)
+        if entry is not None and collection_id is not None and entry[1] == collection_id:
+            return entry[0]
+        if entry is not None:
+            print(f"Collection {collection_name} was rebuilt, reloading its index")
+            del _INDEX_REGISTRY[key]
+        index = get_vector_storage_index(collection_name)
+        if index is not None:
+            _INDEX_REGISTRY[key] = (index, get_collection_id(collection_name))
+    return index
+
+
+def invalidate_vector_storage_index(collection_name=None):
+    """
+    Drops cached indexes for a collection (or all collections when collection_name is None).
+    Must be called whenever a collection is deleted or rebuilt, otherwise the cached index
+    keeps pointing at the old chroma collection.
+    """
+    with _INDEX_REGISTRY_LOCK:
+        for key in list(_INDEX_REGISTRY.keys()):
+            if collection_name is None or key[0] == collection_name:
+                del _INDEX_REGISTRY[key]
+                print(f"Invalidated cached index: {key[0]} ({key[1]})")
+
+
+
+
+def clear_question_cache():
+    """
+    Drops the semantic question cache. Cached SQL can reference tables that were just changed,
+    so it has to go whenever the schema collection is rebuilt.
+    """
+    try:
+        db = get_chroma_client()
+        if QUESTION_CACHE_COLLECTION_NAME in [c.name for c in db.list_collections()]:
+            db.delete_collection(QUESTION_CACHE_COLLECTION_NAME)
+            print(f"Deleted question cache collection: {QUESTION_CACHE_COLLECTION_NAME}")
+    except Exception as e:
+        print(f"Error clearing question cache: {e}")
+
+
+
+
+def compute_content_hash(text, metadata):
+    """
+    Hash of a node's text and its visible metadata, i.e. everything that ends up in the embedding.
+    """
+    visible = {k: v for k, v in metadata.items() if k not in SYNC_METADATA_KEYS}
+    payload = json.dumps({"text": text, "metadata": visible}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def stamp_node(node, source_id):
+    """
+    Adds source_id and content_hash to a node's metadata, excluded from the embed and LLM text.
+    """
+    node.metadata["source_id"] = source_id
+    node.metadata["content_hash"] = compute_content_hash(node.get_content(), node.metadata)
+    for key in SYNC_METADATA_KEYS:
+        if key not in node.excluded_embed_metadata_keys:
+            node.excluded_embed_metadata_keys.append(key)
+        if key not in node.excluded_llm_metadata_keys:
+            node.excluded_llm_metadata_keys.append(key)
+    return node
+
+
+def upsert_nodes(collection, nodes):
+    """
+    Embeds nodes with one batched encoder call and writes them with a single Chroma upsert,
+    in the same layout ChromaVectorStore writes, so the retrievers read them back as usual.
+    """
+    embeddings = get_embed_model().get_text_embedding_batch(
+        [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    )
+    collection.upsert(
+        ids=[node.id_ for node in nodes],
+        embeddings=embeddings,
+        metadatas=[node_to_metadata_dict(node, remove_text=True, flat_metadata=True) for node in nodes],
+        documents=[node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes],
+    )
+
+
+def sync_collection(collection_name, nodes, batch_size=INGEST_BATCH_SIZE, failed_sources=None):
+    """
+    Brings a collection in line with nodes, by node id:
+      - new nodes and nodes whose content_hash changed are embedded and written
+      - ids in the collection that are not in nodes are deleted, unless their source_id is in
+        failed_sources (files that could not be parsed this time, filled while nodes is consumed)
+      - unchanged nodes are left alone
+    nodes can be any iterable, e.g. the stream from iter_parsed(), changed nodes are embedded and
+    upserted batch_size at a time while the rest is still being parsed. Each batch is durable on
+    its own: after a crash the next run compares hashes again and only redoes what is missing.
+    Returns {'upserted', 'deleted', 'unchanged', 'docs_per_sec'}, or None if the collection is not available.
+    """
+    try:
+        collection = get_chroma_client().get_or_create_collection(collection_name)
+    except Exception as e:
+        print(f"Error connecting to ChromaDB: {e}")
+        return None
+
+    existing = collection.get(include=["metadatas"])
+    existing_hashes = {
+        node_id: (metadata or {}).get("content_hash")
+        for node_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+    existing_sources = {
+        node_id: (metadata or {}).get("source_id")
+        for node_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+
+    seen_ids = set()
+    pending = []
+    upserted = 0
+    start = time.perf_counter()
+    for node in nodes:
+        if node.id_ in seen_ids:
+            print(f"Warning: duplicate node id '{node.id_}', keeping the first one.")
+            continue
+        seen_ids.add(node.id_)
+        if existing_hashes.get(node.id_) != node.metadata.get("content_hash"):
+            pending.append(node)
+        if len(pending) >= batch_size:
+            upsert_nodes(collection, pending)
+            upserted += len(pending)
+            pending = []
+            print(f"Ingested {upserted} new or changed nodes into {collection_name}")
+    if pending:
+        upsert_nodes(collection, pending)
+        upserted += len(pending)
+        print(f"Ingested {upserted} new or changed nodes into {collection_name}")
+    elapsed = time.perf_counter() - start
+
+    if not seen_ids:
+        # nothing was parsed, don't treat that as "every document was removed"
+        print("No documents to ingest.")
+        return {"upserted": 0, "deleted": 0, "unchanged": 0, "docs_per_sec": 0.0}
+
+    # includes nodes written by older full rebuilds, those have random ids.
+    # A file that failed to parse yields no nodes, its documents stay until it parses again
+    failed_sources = failed_sources or set()
+    stale = [node_id for node_id in existing_hashes if node_id not in seen_ids]
+    removed = [node_id for node_id in stale if existing_sources[node_id] not in failed_sources]
+    if len(removed) < len(stale):
+        print(f"Kept {len(stale) - len(removed)} nodes of files that failed to parse: {sorted(failed_sources)}")
+    for i in range(0, len(removed), batch_size):
+        collection.delete(ids=removed[i:i + batch_size])
+    if removed:
+        print(f"Deleted {len(removed)} stale nodes from {collection_name}")
+
+    counts = {
+        "upserted": upserted,
+        "deleted": len(removed),
+        "unchanged": len(seen_ids) - upserted,
+        "docs_per_sec": round(upserted / elapsed, 1) if upserted and elapsed > 0 else 0.0,
+    }
+    print(f"Sync of {collection_name}: {counts}")
+    return counts
+
+
+def iter_parsed(tasks, max_workers=PARSE_WORKERS, queue_size=PARSE_QUEUE_SIZE, failed_sources=None):
+    """
+    Runs tasks, (source_id, parse_fn, args) where parse_fn returns a list of nodes, on a process
+    pool and yields the nodes as they come in. A producer thread feeds them through a bounded queue,
+    so parsing overlaps with whatever consumes the nodes (embedding) but never runs more than
+    queue_size nodes ahead of it. max_workers <= 1 parses in this process.
+    The source_id of every task that raised is added to failed_sources, if given.
+    """
+    def parse_failed(source_id, error):
+        print(f"Error parsing ingestion input '{source_id}': {error}. Skipping.")
+        if failed_sources is not None:
+            failed_sources.add(source_id)
+
+    if max_workers <= 1:
+        for source_id, parse_fn, args in tasks:
+            try:
+                nodes = parse_fn(*args)
+            except Exception as e:
+                parse_failed(source_id, e)
+                continue
+            yield from nodes
+        return
+
+    parsed = queue.Queue(maxsize=queue_size)
+    done = object()
+    # set when the consumer is gone (finished, raised or stopped early), the producer then quits
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                parsed.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def put_results(futures):
+        for future in futures:
+            if stop.is_set():
+                return
+            try:
+                nodes = future.result()
+            except Exception as e:
+                parse_failed(in_flight_sources.pop(future), e)
+                continue
+            in_flight_sources.pop(future)
+            for node in nodes:
+                if not put(node):
+                    return
+
+    in_flight_sources = {}
+
+    def produce():
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            in_flight = set()
+            for source_id, parse_fn, args in tasks:
+                if stop.is_set():
+                    break
+                future = pool.submit(parse_fn, *args)
+                in_flight_sources[future] = source_id
+                in_flight.add(future)
+                # only keep a few tasks per worker in flight, the queue does the rest
+                if len(in_flight) >= max_workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    put_results(finished)
+            if not stop.is_set():
+                put_results(as_completed(in_flight))
+        finally:
+            # tasks that haven't started are dropped when the consumer is gone
+            pool.shutdown(wait=True, cancel_futures=stop.is_set())
+            put(done)
+
+    producer = threading.Thread(target=produce, name="ingest_parser", daemon=True)
+    producer.start()
+    try:
+        while True:
+            node = parsed.get()
+            if node is done:
+                break
+            yield node
+    finally:
+        stop.set()
+        # unblock a producer waiting on a full queue
+        while producer.is_alive():
+            try:
+                parsed.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
 
 
 #########################################################################
@@ -84,14 +418,95 @@ def get_vector_storage_index(collection_name=SCHEMA_COLLECTION_NAME, delete_exis
 #  █  ▐▌ ▝▜▌   ▐▌▐▛▀▀▘ ▝▀▚▖  █    █  ▐▌ ▐▌▐▌ ▝▜▌
 #▗▄█▄▖▐▌  ▐▌▗▄▄▞▘▐▙▄▄▖▗▄▄▞▘  █  ▗▄█▄▖▝▚▄▞▘▐▌  ▐▌
 #########################################################################
-def ingest_metadata(data_directory: str = SCHEMA_DIR):
+def parse_ddl_file(db_name, ddl_path, source_id):
+    """
+    One Document per DDL statement in a database's DDL.csv. Runs in a parser process.
+    """
+    documents = []
+    ddl_df = pd.read_csv(ddl_path)
+
+    # Ingest DDL statements as separate documents (optional, but good for context)
+    if not all(col in ddl_df.columns for col in ['table_name', 'DDL']): # Check for your actual columns
+        return documents
+    for table_name, ddl in zip(ddl_df['table_name'], ddl_df['DDL']):
+        ddl_content = f"Database: {db_name}\nTable: {table_name}\nDDL: {ddl}"
+        documents.append(stamp_node(Document(
+            text=ddl_content,
+            metadata={
+                "type": "ddl",
+                "database_name": db_name,  # Use db_name from the directory
+                "table_name": table_name
+            },
+            id_=f"ddl_{db_name}_{table_name}" # Unique ID
+        ), source_id))
+    return documents
+
+
+def parse_table_file(db_name, json_path, source_id):
+    """
+    The Document for one table JSON file. Runs in a parser process.
+    """
+    filename = os.path.basename(json_path)
+    with open(json_path, 'r') as f:
+        table_data = json.load(f)
+
+    table_name = table_data.get("table_name")
+    column_names = table_data.get("column_names", [])
+    column_types = table_data.get("column_types", [])
+    column_descriptions = table_data.get("description", [])
+    sample_rows = table_data.get("sample_rows", [])
+
+    if not table_name:
+        print(f"Warning: Skipping {filename} in {db_name} due to missing 'table_name'.")
+        return []
+
+    # Construct the content for the RAG document
+    content = f"Database: {db_name}\nTable: {table_name}\n"
+    column_info = []
+    for i, col_name in enumerate(column_names):
+        col_type = column_types[i] if i < len(column_types) else "UNKNOWN"
+        col_desc = column_descriptions[i] if i < len(column_descriptions) else ""
+        if col_desc:
+            column_info.append(f"{col_name} ({col_type}): {col_desc}")
+        else:
+            column_info.append(f"{col_name} ({col_type})")
+
+    content += "Columns:\n" + "  " + "\n  ".join(column_info) + "\n"
+
+    if sample_rows:
+        content += "Sample Rows:\n"
+        # Limit sample rows for brevity in RAG context
+        for i, row in enumerate(sample_rows):
+            if i >= 2: break # Only include first 2 sample rows
+            content += f"  {row}\n"
+
+    # Convert lists to comma-separated strings for metadata
+    column_names_str = ", ".join(column_names)
+
+    return [stamp_node(Document(
+        text=content,
+        metadata={
+            "type": "table_metadata",
+            "database_name": db_name,
+            "table_name": table_name,
+            "column_names": column_names_str,
+            #"column_types": ", ".join(column_types),
+            #"column_descriptions": " | ".join(column_descriptions) # Store the list in metadata too
+        },
+        id_=f"table_{db_name}_{table_name}" # Stable ID, so changes can be detected
+    ), source_id)]
+
+
+def ingest_metadata(data_directory: str = SCHEMA_DIR, rebuild=False, batch_size=INGEST_BATCH_SIZE, max_workers=PARSE_WORKERS):
     """
     Ingests database metadata from the specified directory into ChromaDB.
     Creates a LlamaIndex Document for each table with relevant metadata.
     Expects DDL.csv file, and JSON file for each table
+    Files are parsed on max_workers processes while the documents are embedded.
+    Only documents that were added, changed or removed since the last run are written,
+    rebuild=True drops the collection and embeds everything again.
     """
-    documents = []
-
+    tasks = []
     for db_name in os.listdir(data_directory):
         db_path = os.path.join(data_directory, db_name)
         if not os.path.isdir(db_path):
@@ -100,177 +515,174 @@ def ingest_metadata(data_directory: str = SCHEMA_DIR):
         print(f"Processing database: {db_name}")
 
         ddl_path = os.path.join(db_path, "DDL.csv")
-        ddl_df = pd.read_csv(ddl_path) if os.path.exists(ddl_path) else pd.DataFrame()
-
-        # Ingest DDL statements as separate documents (optional, but good for context)
-        for _, row in ddl_df.iterrows():
-             if all(col in row for col in ['table_name', 'DDL']): # Check for your actual columns
-                ddl_content = f"Database: {db_name}\nTable: {row['table_name']}\nDDL: {row['DDL']}"
-                documents.append(Document(
-                    text=ddl_content,
-                    metadata={
-                        "type": "ddl",
-                        "database_name": db_name,  # Use db_name from the directory
-                        "table_name": row['table_name']
-                    },
-                    id_=f"ddl_{db_name}_{row['table_name']}" # Unique ID
-                ))
-           
+        if os.path.exists(ddl_path):
+            source_id = f"{db_name}/DDL.csv"
+            tasks.append((source_id, parse_ddl_file, (db_name, ddl_path, source_id)))
 
         # Ingest table-specific metadata
         for filename in os.listdir(db_path):
             if filename.endswith(".json"):
-                json_path = os.path.join(db_path, filename)
-                with open(json_path, 'r') as f:
-                    table_data = json.load(f)
-
-                table_name = table_data.get("table_name")
-                column_names = table_data.get("column_names", [])
-                column_types = table_data.get("column_types", [])
-                column_descriptions = table_data.get("description", [])
-                sample_rows = table_data.get("sample_rows", [])
-
-                if not table_name:
-                    print(f"Warning: Skipping {filename} in {db_name} due to missing 'table_name'.")
-                    continue
-
-                # Construct the content for the RAG document
-                content = f"Database: {db_name}\nTable: {table_name}\n"
-                column_info = []
-                for i, col_name in enumerate(column_names):
-                    col_type = column_types[i] if i < len(column_types) else "UNKNOWN"
-                    col_desc = column_descriptions[i] if i < len(column_descriptions) else ""
-                    if col_desc:
-                        column_info.append(f"{col_name} ({col_type}): {col_desc}")
-                    else:
-                        column_info.append(f"{col_name} ({col_type})")
-                
-                content += "Columns:\n" + "  " + "\n  ".join(column_info) + "\n"
-
-                if sample_rows:
-                    content += f"Sample Rows:\n"
-                    # Limit sample rows for brevity in RAG context
-                    for i, row in enumerate(sample_rows):
-                        if i >= 2: break # Only include first 2 sample rows
-                        content += f"  {row}\n"
-
-                # Convert lists to comma-separated strings for metadata
-                column_names_str = ", ".join(column_names)
-                column_types_str = ", ".join(column_types)
-                column_descriptions_str = " | ".join(column_descriptions) # Use a different separator for descriptions for clarity
-
-                
-
-
-                documents.append(Document(
-                    text=content,
-                    metadata={
-                        "type": "table_metadata",
-                        "database_name": db_name,
-                        "table_name": table_name,
-                        "column_names": column_names_str,
-                        #"column_types": column_types_str,
-                        #"column_descriptions": column_descriptions_str # Store the list in metadata too
-                    }
-                ))
-    
-    if documents:
-        index = get_vector_storage_index(SCHEMA_COLLECTION_NAME, True)
-        if index == None:
-            print("No valid ChromaDB found")
-            return
-        for doc in documents:
-            index.insert(doc)
-            print(f"Successfully ingested document: {doc.id_}")
- 
-        print("Ingestion complete.")
-    else:
+                source_id = f"{db_name}/{filename}"
+                tasks.append((source_id, parse_table_file, (db_name, os.path.join(db_path, filename), source_id)))
+
+    if not tasks:
         print("No documents to ingest.")
+        return
+
+    if rebuild:
+        get_vector_storage_index(SCHEMA_COLLECTION_NAME, True)
+    failed_sources = set()
+    counts = sync_collection(SCHEMA_COLLECTION_NAME, iter_parsed(tasks, max_workers, failed_sources=failed_sources),
+                             batch_size, failed_sources)
+    if counts is None:
+        return
+
+    if counts["upserted"] or counts["deleted"]:
+        invalidate_vector_storage_index(SCHEMA_COLLECTION_NAME)
+        clear_question_cache()
+    print("Ingestion complete.")
+
+
+_BUSINESS_TERM_SPLITTER = None
+
+
+def get_business_term_splitter():
+    # one splitter per parser process
+    global _BUSINESS_TERM_SPLITTER
+    if _BUSINESS_TERM_SPLITTER is None:
+        _BUSINESS_TERM_SPLITTER = SentenceSplitter(
+            chunk_size=512,
+            chunk_overlap=200, # Overlap helps maintain context between chunks
+            separator=" " # Split by spaces to avoid breaking words mid-sentence
+        )
+    return _BUSINESS_TERM_SPLITTER
+
+
+def parse_business_term_file(file_path, source_id):
+    """
+    Reads one business term markdown file and returns its chunks. Runs in a parser process.
+    """
+    filename = os.path.basename(file_path)
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        term_name = Path(filename).stem.replace("_", " ").title()
+
+        original_doc = Document(
+            text=content,
+            metadata={
+                "type": "business_term",
+                "file_name": filename,
+                "term_name": term_name # Human-readable name
+            },
+            id_=f"original_business_term_file_{Path(filename).stem}" # Unique ID for the *file*
+        )
+
+        chunks = get_business_term_splitter().get_nodes_from_documents([original_doc])
+
+        # Assign a unique ID to each chunk
+        for i, chunk in enumerate(chunks):
+            chunk.id_ = f"{original_doc.id_}_chunk_{i}"
 
+            # You might also want to add chunk-specific metadata like chunk_number
+            chunk.metadata.update({
+                "chunk_number": i,
+                "total_chunks_in_file": len(chunks)
+            })
+            stamp_node(chunk, source_id)
 
-def ingest_business_terms(business_terms_directory: str = BIZ_TERMS_DIR):
+        print(f"Processed markdown file '{filename}' into {len(chunks)} chunks.")
+        return chunks
+
+    except Exception as e:
+        # raised on, so sync_collection keeps the file's chunks from the last run
+        print(f"Error reading or processing markdown file '{file_path}': {e}. Skipping.")
+        raise
+
+
+def ingest_business_terms(business_terms_directory: str = BIZ_TERMS_DIR, rebuild=False, batch_size=INGEST_BATCH_SIZE, max_workers=PARSE_WORKERS):
     """
     Ingests business term markdown files into a separate ChromaDB collection,
     applying chunking to handle larger files.
+    Files are read and chunked on max_workers processes while the chunks are embedded.
+    Incremental like ingest_metadata, chunks are compared by their content hash.
     """
     print(f"Starting business terms ingestion from: {business_terms_directory}")
-    
-    # Initialize a text splitter for chunking
-    text_splitter = SentenceSplitter(
-        chunk_size=512,
-        chunk_overlap=200, # Overlap helps maintain context between chunks
-        separator=" " # Split by spaces to avoid breaking words mid-sentence
-    )
-
-    documents_to_ingest = [] # This will hold the original LlamaIndex Documents (one per file)
-    nodes_to_ingest = []     # This will hold the chunked nodes (from each file)
 
     if not os.path.isdir(business_terms_directory):
         print(f"The provided business terms directory '{business_terms_directory}' does not exist or is not a directory.")
         return
 
-    md_files_found = False
-    for filename in os.listdir(business_terms_directory):
-        if filename.endswith(".md"):
-            md_files_found = True
-            file_path = os.path.join(business_terms_directory, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                term_name = Path(filename).stem.replace("_", " ").title()
-
-               
-                original_doc = Document(
-                    text=content,
-                    metadata={
-                        "type": "business_term",
-                        "file_name": filename,
-                        "term_name": term_name # Human-readable name
-                    },
-                    id_=f"original_business_term_file_{Path(filename).stem}" # Unique ID for the *file*
-                )
-                documents_to_ingest.append(original_doc) # Keep track of original documents if needed later
-
-                chunks = text_splitter.get_nodes_from_documents([original_doc], show_progress=True)
-                
-                # Assign a unique ID to each chunk and add to nodes_to_ingest
-                for i, chunk in enumerate(chunks):
-                    chunk.id_ = f"{original_doc.id_}_chunk_{i}"
-                    
-                    # You might also want to add chunk-specific metadata like chunk_number
-                    chunk.metadata.update({
-                        "chunk_number": i,
-                        "total_chunks_in_file": len(chunks)
-                    })
-                    
-                    nodes_to_ingest.append(chunk)
-
-                print(f"Processed markdown file '{filename}' into {len(chunks)} chunks.")
-
-            except Exception as e:
-                print(f"Error reading or processing markdown file '{file_path}': {e}. Skipping.")
-    
-    if not md_files_found:
+    tasks = [
+        (f"business_terms/{filename}", parse_business_term_file,
+         (os.path.join(business_terms_directory, filename), f"business_terms/{filename}"))
+        for filename in os.listdir(business_terms_directory) if filename.endswith(".md")
+    ]
+    if not tasks:
         print(f"No .md files found in '{business_terms_directory}'. Skipping business term ingestion.")
+        return
 
-    if nodes_to_ingest: 
-        print(f"Attempting to ingest {len(nodes_to_ingest)} business term chunks into ChromaDB collection: {BUSINESS_TERMS_COLLECTION_NAME}...")
-        
-        business_terms_index = get_vector_storage_index(BUSINESS_TERMS_COLLECTION_NAME, True)
-        if business_terms_index == None:
-            print("Could not get biz term index, quitting injestion")
-            return
+    print(f"Attempting to ingest {len(tasks)} business term files into ChromaDB collection: {BUSINESS_TERMS_COLLECTION_NAME}...")
 
-        try:
-            business_terms_index.insert_nodes(nodes_to_ingest)
-            print(f"Successfully ingested {len(nodes_to_ingest)} chunks into {BUSINESS_TERMS_COLLECTION_NAME}.")
-        except Exception as e:
-            print(f"Failed to insert chunks: {e}")
-        
-        print(f"Business terms ingestion process complete for collection: {BUSINESS_TERMS_COLLECTION_NAME}.")
-    else:
-        print(f"No valid business term chunks found for ingestion in {business_terms_directory}.")
+    if rebuild:
+        get_vector_storage_index(BUSINESS_TERMS_COLLECTION_NAME, True)
+
+    failed_sources = set()
+    try:
+        counts = sync_collection(BUSINESS_TERMS_COLLECTION_NAME, iter_parsed(tasks, max_workers, failed_sources=failed_sources),
+                                 batch_size, failed_sources)
+    except Exception as e:
+        print(f"Error syncing business terms into {BUSINESS_TERMS_COLLECTION_NAME}: {e}, quitting injestion")
+        return
+    if counts is None:
+        print("Could not get biz term index, quitting injestion")
+        return
+
+    if counts["upserted"] or counts["deleted"]:
+        invalidate_vector_storage_index(BUSINESS_TERMS_COLLECTION_NAME)
+
+    print(f"Business terms ingestion process complete for collection: {BUSINESS_TERMS_COLLECTION_NAME}.")
+
+
+def benchmark_ingestion(num_docs=1000, batch_size=INGEST_BATCH_SIZE, collection_name="ingest_benchmark_collection"):
+    """
+    Ingestion throughput in docs/sec for num_docs synthetic table documents: the old path (one
+    index.insert per document, i.e. one embedding call and one Chroma write each) against
+    batched embedding + bulk upsert. The benchmark collection is dropped afterwards.
+    Returns (per_doc_docs_per_sec, batched_docs_per_sec).
+    """
+    documents = []
+    for i in range(num_docs):
+        columns = "\n  ".join(f"col_{c} (VARCHAR): benchmark column {c} of table {i}" for c in range(12))
+        documents.append(stamp_node(Document(
+            text=f"Database: benchmark\nTable: table_{i}\nColumns:\n  {columns}\n",
+            metadata={"type": "table_metadata", "database_name": "benchmark", "table_name": f"table_{i}"},
+            id_=f"table_benchmark_table_{i}"
+        ), "benchmark"))
+
+    get_embed_model()
+    results = []
+    for batched in [False, True]:
+        index = get_vector_storage_index(collection_name, delete_existing=True)
+        start = time.perf_counter()
+        if batched:
+            collection = get_chroma_client().get_collection(collection_name)
+            for i in range(0, num_docs, batch_size):
+                upsert_nodes(collection, documents[i:i + batch_size])
+        else:
+            for doc in documents:
+                index.insert_nodes([doc])
+        elapsed = time.perf_counter() - start
+        docs_per_sec = num_docs / elapsed
+        mode = f"batched upsert (batch {batch_size}, embed batch {EMBED_BATCH_SIZE})" if batched else "per document insert"
+        print(f"{num_docs} documents, {mode}: {elapsed:.2f}s, {docs_per_sec:.1f} docs/sec")
+        results.append(docs_per_sec)
+
+    get_chroma_client().delete_collection(collection_name)
+    invalidate_vector_storage_index(collection_name)
+    print(f"Speedup: {results[1] / results[0]:.1f}x")
+    return tuple(results)
 
 
 #########################################################################
@@ -281,11 +693,6 @@ def ingest_business_terms(business_terms_directory: str = BIZ_TERMS_DIR):
 #########################################################################
 
 if __name__ == "__main__":
-   
-    
-    ingest_metadata()
-    #ingest_business_terms()
-
     parser = argparse.ArgumentParser(
         description="Ingest various types of metadata into ChromaDB for RAG. "
                     "Supports database schema metadata (.csv, .json) and business terms (.md)."
@@ -303,7 +710,25 @@ if __name__ == "__main__":
         default=None # Make it optional
     )
 
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Drop the collections and embed everything again instead of syncing the changes."
+    )
+
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="Parser processes, 1 parses in the main process.")
+    parser.add_argument("--benchmark", action="store_true", help="Benchmark ingestion throughput instead of ingesting.")
+    parser.add_argument("--docs", type=int, default=1000, help="Synthetic documents for the benchmark.")
+    parser.add_argument("--batch_size", type=int, default=INGEST_BATCH_SIZE, help="Documents per embedding batch and Chroma upsert.")
+
     args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_ingestion(args.docs, args.batch_size)
+    else:
+        ingest_metadata(args.schema_data_directory or SCHEMA_DIR, rebuild=args.rebuild, batch_size=args.batch_size, max_workers=args.workers)
+        if args.business_terms_directory:
+            ingest_business_terms(args.business_terms_directory, rebuild=args.rebuild, batch_size=args.batch_size, max_workers=args.workers)
     
    
 
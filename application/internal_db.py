@@ -5,17 +5,37 @@
 # Copyright (c) 2025 Michael Powers
 #
 # Usage: not to be run directly
-#   
-# 
+#   python3 internal_db.py               -> create the database and tables
+#   python3 internal_db.py --latencies   -> per step latencies from the run history
 #
 import sqlite3
 import datetime
 import json 
+import asyncio
+import threading
+import time
+import os
+import argparse
+import uuid
 
 DB_PATH = 'status.db'
 PROCESS_TABLE_NAME = 'user_process_status'
+RUNS_TABLE_NAME = 'pipeline_runs'
+RUN_STEPS_TABLE_NAME = 'pipeline_run_steps'
 RECOMMENDATIONS_TABLE_NAME = "recommendations"
 
+# Columns added to the status table after the first release, migrated by create_db_and_table
+# sql_draft: partial SQL streamed while steps 8 and 9 are generating
+ADDED_COLUMNS = {
+    'sql_draft': 'TEXT',
+}
+
+# Write-behind mode: status updates are queued and group-committed by a background thread
+STATUS_WRITE_BEHIND = False
+WRITE_BEHIND_INTERVAL = 0.05
+# how long finish_run waits for a run's queued writes before it marks the run finished anyway
+WRITE_BEHIND_FLUSH_TIMEOUT = 10.0
+
 
 def create_db_and_table(db_path=DB_PATH):
     """
@@ -42,13 +62,25 @@ def create_db_and_table(db_path=DB_PATH):
             calculations TEXT DEFAULT 'Not started',
             filtering TEXT DEFAULT 'Not started',
             sql TEXT DEFAULT 'Not started',
+            sql_draft TEXT,
             field8 TEXT DEFAULT 'Not started',
             last_updated TEXT
         );
         """
         cursor.execute(create_table_sql)
+
+        # Add columns introduced after the table was first created
+        cursor.execute(f"PRAGMA table_info({PROCESS_TABLE_NAME});")
+        existing_columns = {col[1] for col in cursor.fetchall()}
+        for col_name, col_type in ADDED_COLUMNS.items():
+            if col_name not in existing_columns:
+                cursor.execute(f"ALTER TABLE {PROCESS_TABLE_NAME} ADD COLUMN {col_name} {col_type}")
+                print(f"Added column '{col_name}' to '{PROCESS_TABLE_NAME}'.")
+        create_run_tables(conn)
         conn.commit()
-        print(f"Database '{db_path}' and table '{PROCESS_TABLE_NAME}' ensured to exist.")
+        if db_path in _STATUS_STORES:
+            _STATUS_STORES[db_path].refresh_columns()
+        print(f"Database '{db_path}' and tables '{PROCESS_TABLE_NAME}', '{RUNS_TABLE_NAME}', '{RUN_STEPS_TABLE_NAME}' ensured to exist.")
     except sqlite3.Error as e:
         print(f"Error creating database/table: {e}")
     finally:
@@ -56,6 +88,459 @@ def create_db_and_table(db_path=DB_PATH):
             conn.close()
 
 
+def create_run_tables(conn):
+    """
+    Run scoped status: one row per pipeline run, and one row per (run, step) with the step's
+    payload and timestamps. A user can have any number of runs, old runs are kept as history.
+    """
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {RUNS_TABLE_NAME} (
+        run_id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        question TEXT,
+        status TEXT DEFAULT 'running',
+        started_at TEXT,
+        finished_at TEXT,
+        dismissed INTEGER DEFAULT 0
+    );
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{RUNS_TABLE_NAME}_user_started ON {RUNS_TABLE_NAME} (user_id, started_at);")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {RUN_STEPS_TABLE_NAME} (
+        run_id TEXT NOT NULL,
+        step TEXT NOT NULL,
+        payload TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        PRIMARY KEY (run_id, step)
+    );
+    """)
+
+
+class SQLiteStore:
+    """
+    Base for the stores on one SQLite file. Each thread keeps its own open connection (WAL mode,
+    so readers never block the writer).
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class StatusStore(SQLiteStore):
+    """
+    Status store keyed on user_id. The table's column set is read once and cached, and every
+    status write is a single INSERT ... ON CONFLICT DO UPDATE statement.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        super().__init__(db_path)
+        self._columns = None
+
+    def columns(self):
+        """
+        Column names of the status table, read once per store.
+        """
+        if not self._columns:
+            table_columns_info = self._connection().execute(f"PRAGMA table_info({PROCESS_TABLE_NAME});").fetchall()
+            # Extract column names (second element in each tuple), not cached until the table exists
+            self._columns = [col[1] for col in table_columns_info]
+        return self._columns
+
+    def refresh_columns(self):
+        self._columns = None
+
+    def _upsert(self, conn, user_id, updates):
+        columns = self.columns()
+        fields = [field for field in updates if field in columns and field not in ['user_id', 'last_updated']]
+        other_columns = [col for col in columns if col not in fields and col not in ['user_id', 'last_updated']]
+
+        insert_columns = ['user_id'] + fields + other_columns + ['last_updated']
+        values = [user_id] + [updates[field] for field in fields] + [None] * len(other_columns) + [datetime.datetime.now().isoformat()]
+        set_clauses = [f"{field} = excluded.{field}" for field in fields + ['last_updated']]
+
+        upsert_sql = (
+            f"INSERT INTO {PROCESS_TABLE_NAME} ({', '.join(insert_columns)}) "
+            f"VALUES ({', '.join(['?'] * len(insert_columns))}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {', '.join(set_clauses)}"
+        )
+        conn.execute(upsert_sql, values)
+
+    def update(self, user_id, updates):
+        """
+        Upserts the given fields for user_id in one statement. Fields that are not columns of the
+        table are ignored. A new record starts with every other field empty.
+        """
+        try:
+            conn = self._connection()
+            self._upsert(conn, user_id, updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating process status for user '{user_id}': {e}")
+
+    def update_many(self, batch):
+        """
+        Group commit: upserts {user_id: updates} for many users in a single transaction.
+        """
+        try:
+            conn = self._connection()
+            for user_id, updates in batch.items():
+                self._upsert(conn, user_id, updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating process status for {len(batch)} users: {e}")
+
+    def get(self, user_id, field_name=None):
+        try:
+            conn = self._connection()
+            if field_name:
+                # Validate field_name to prevent SQL injection
+                if field_name not in self.columns():
+                    print(f"Invalid field name '{field_name}'.")
+                    return None
+                row = conn.execute(f"SELECT {field_name} FROM {PROCESS_TABLE_NAME} WHERE user_id = ?", (user_id,)).fetchone()
+                return row[0] if row else None
+
+            cursor = conn.execute(f"SELECT * FROM {PROCESS_TABLE_NAME} WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            if row:
+                # Get column names from cursor description
+                col_names = [description[0] for description in cursor.description]
+                return dict(zip(col_names, row))
+            else:
+                print(f"No status found for user '{user_id}'.")
+                return None
+        except sqlite3.Error as e:
+            print(f"Error retrieving process status for user '{user_id}': {e}")
+            return None
+
+    def delete(self, user_id):
+        try:
+            conn = self._connection()
+            cursor = conn.execute(f"DELETE FROM {PROCESS_TABLE_NAME} WHERE user_id = ?", (user_id,))
+            conn.commit()
+            if cursor.rowcount > 0:
+                print(f"Deleted status for user '{user_id}'.")
+            return True # True either way, the desired state (absence of user) is met
+        except sqlite3.Error as e:
+            print(f"Error deleting process status for user '{user_id}': {e}")
+            return False
+
+
+class RunStore(SQLiteStore):
+    """
+    Run scoped status store. update() and update_many() have the same shape as StatusStore's, keyed
+    on run_id instead of user_id, so the write-behind writer works with either store.
+    Each field of an update is one step row: payload is the latest value, started_at is kept from the
+    first write (or start_step) and finished_at is the time of the latest write.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        super().__init__(db_path)
+        conn = self._connection()
+        create_run_tables(conn)
+        conn.commit()
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat()
+
+    def start_run(self, run_id, user_id, question, status='running'):
+        # a queued run is recorded at submit time and moves to running when a worker picks it up
+        try:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT INTO {RUNS_TABLE_NAME} (run_id, user_id, question, status, started_at) VALUES (?, ?, ?, ?, ?) "
+                f"ON CONFLICT(run_id) DO UPDATE SET status = excluded.status, started_at = excluded.started_at",
+                (run_id, user_id, question, status, self._now())
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error starting run '{run_id}' for user '{user_id}': {e}")
+
+    def finish_run(self, run_id, status):
+        try:
+            conn = self._connection()
+            conn.execute(f"UPDATE {RUNS_TABLE_NAME} SET status = ?, finished_at = ? WHERE run_id = ?", (status, self._now(), run_id))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error finishing run '{run_id}': {e}")
+
+    def start_step(self, run_id, step):
+        try:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT INTO {RUN_STEPS_TABLE_NAME} (run_id, step, started_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT(run_id, step) DO UPDATE SET started_at = excluded.started_at, finished_at = NULL",
+                (run_id, step, self._now())
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error starting step '{step}' of run '{run_id}': {e}")
+
+    def _upsert(self, conn, run_id, updates):
+        now = self._now()
+        conn.executemany(
+            f"INSERT INTO {RUN_STEPS_TABLE_NAME} (run_id, step, payload, started_at, finished_at) VALUES (?, ?, ?, ?, ?) "
+            f"ON CONFLICT(run_id, step) DO UPDATE SET payload = excluded.payload, finished_at = excluded.finished_at",
+            [(run_id, step, payload, now, now) for step, payload in updates.items()]
+        )
+
+    def update(self, run_id, updates):
+        try:
+            conn = self._connection()
+            self._upsert(conn, run_id, updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating run '{run_id}': {e}")
+
+    def update_many(self, batch):
+        try:
+            conn = self._connection()
+            for run_id, updates in batch.items():
+                self._upsert(conn, run_id, updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating {len(batch)} runs: {e}")
+
+    def list_runs(self, user_id, include_dismissed=False, limit=20):
+        """
+        Returns the user's runs, newest first, as a list of dicts (without step payloads).
+        """
+        try:
+            sql = f"SELECT * FROM {RUNS_TABLE_NAME} WHERE user_id = ?"
+            if not include_dismissed:
+                sql += " AND dismissed = 0"
+            sql += " ORDER BY started_at DESC LIMIT ?"
+            cursor = self._connection().execute(sql, (user_id, limit))
+            col_names = [description[0] for description in cursor.description]
+            return [dict(zip(col_names, row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Error listing runs for user '{user_id}': {e}")
+            return []
+
+    def get_run(self, run_id):
+        """
+        Returns the run's record with a 'steps' dict of step -> payload, or None if the run doesn't exist.
+        """
+        try:
+            conn = self._connection()
+            cursor = conn.execute(f"SELECT * FROM {RUNS_TABLE_NAME} WHERE run_id = ?", (run_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            run = dict(zip([description[0] for description in cursor.description], row))
+            steps = conn.execute(f"SELECT step, payload FROM {RUN_STEPS_TABLE_NAME} WHERE run_id = ?", (run_id,)).fetchall()
+            run['steps'] = {step: payload for step, payload in steps}
+            return run
+        except sqlite3.Error as e:
+            print(f"Error retrieving run '{run_id}': {e}")
+            return None
+
+    def is_dismissed(self, run_id):
+        """
+        True once the run's user pressed Reset, the pipeline polls this to stop a dismissed run.
+        """
+        try:
+            row = self._connection().execute(f"SELECT dismissed FROM {RUNS_TABLE_NAME} WHERE run_id = ?", (run_id,)).fetchone()
+            return bool(row and row[0])
+        except sqlite3.Error as e:
+            print(f"Error reading run '{run_id}': {e}")
+            return False
+
+    def dismiss_runs(self, user_id):
+        """
+        Hides the user's runs from the UI, history stays in the table. Returns the dismissed run_ids.
+        """
+        try:
+            conn = self._connection()
+            run_ids = [row[0] for row in conn.execute(f"SELECT run_id FROM {RUNS_TABLE_NAME} WHERE user_id = ? AND dismissed = 0", (user_id,))]
+            conn.execute(f"UPDATE {RUNS_TABLE_NAME} SET dismissed = 1 WHERE user_id = ?", (user_id,))
+            conn.commit()
+            return run_ids
+        except sqlite3.Error as e:
+            print(f"Error dismissing runs for user '{user_id}': {e}")
+            return []
+
+    def step_latencies(self, since=None):
+        """
+        Returns step -> list of durations in seconds for every finished step, optionally only runs started after since (iso timestamp).
+        """
+        sql = (
+            f"SELECT s.step, (julianday(s.finished_at) - julianday(s.started_at)) * 86400.0 "
+            f"FROM {RUN_STEPS_TABLE_NAME} s JOIN {RUNS_TABLE_NAME} r ON r.run_id = s.run_id "
+            f"WHERE s.started_at IS NOT NULL AND s.finished_at IS NOT NULL"
+        )
+        params = ()
+        if since is not None:
+            sql += " AND r.started_at >= ?"
+            params = (since,)
+        latencies = {}
+        try:
+            for step, seconds in self._connection().execute(sql, params):
+                latencies.setdefault(step, []).append(seconds)
+        except sqlite3.Error as e:
+            print(f"Error reading step latencies: {e}")
+        return latencies
+
+
+class WriteBehindStatusWriter:
+    """
+    Optional write-behind mode for a StatusStore or RunStore. Updates are queued and a background thread
+    coalesces updates for the same key (user_id or run_id) and group-commits them every `interval` seconds,
+    so many concurrent pipelines share one transaction instead of serializing on SQLite's write lock.
+    Call flush() when a run completes to make its final status durable.
+    """
+
+    def __init__(self, store, interval=WRITE_BEHIND_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self._pending = {}
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="status_write_behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, updates):
+        with self._condition:
+            self._pending.setdefault(user_id, {}).update(updates)
+            self._condition.notify_all()
+
+    def discard(self, user_id):
+        """
+        Drops queued updates for user_id and waits for any batch holding them, used before a delete.
+        """
+        with self._condition:
+            self._pending.pop(user_id, None)
+            self._condition.wait_for(lambda: user_id not in self._in_flight)
+
+    def flush(self, user_id=None, timeout=None):
+        """
+        Blocks until queued updates for user_id (or for everyone) are committed.
+        Returns False if the timeout expired first.
+        """
+        def written():
+            if user_id is None:
+                return not self._pending and not self._in_flight
+            return user_id not in self._pending and user_id not in self._in_flight
+
+        with self._condition:
+            self._condition.notify_all()
+            return self._condition.wait_for(written, timeout=timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._stopped)
+                if self._stopped and not self._pending:
+                    return
+
+            # let more updates pile up so they share one commit
+            time.sleep(self.interval)
+
+            with self._condition:
+                batch, self._pending = self._pending, {}
+                self._in_flight = set(batch)
+
+            try:
+                self.store.update_many(batch)
+            except Exception as e:
+                # update_many handles sqlite3 errors itself, anything else would kill this thread
+                # and leave flush() waiting forever. The batch is dropped, later updates still go in
+                print(f"Error writing {len(batch)} queued status updates, dropping them: {e}")
+            finally:
+                with self._condition:
+                    self._in_flight = set()
+                    self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+_STATUS_STORES = {}
+_STATUS_WRITERS = {}
+_RUN_STORES = {}
+_RUN_WRITERS = {}
+_STATUS_STORES_LOCK = threading.Lock()
+
+
+def get_status_store(db_path=DB_PATH):
+    """
+    Returns the process wide StatusStore for db_path.
+    """
+    store = _STATUS_STORES.get(db_path)
+    if store is None:
+        with _STATUS_STORES_LOCK:
+            store = _STATUS_STORES.setdefault(db_path, StatusStore(db_path))
+    return store
+
+
+def get_status_writer(db_path=DB_PATH):
+    """
+    Returns the process wide write-behind writer for db_path, starting it on first use.
+    """
+    writer = _STATUS_WRITERS.get(db_path)
+    if writer is None:
+        store = get_status_store(db_path)
+        with _STATUS_STORES_LOCK:
+            writer = _STATUS_WRITERS.get(db_path)
+            if writer is None:
+                writer = WriteBehindStatusWriter(store)
+                _STATUS_WRITERS[db_path] = writer
+    return writer
+
+
+def get_run_store(db_path=DB_PATH):
+    """
+    Returns the process wide RunStore for db_path.
+    """
+    store = _RUN_STORES.get(db_path)
+    if store is None:
+        with _STATUS_STORES_LOCK:
+            store = _RUN_STORES.get(db_path)
+            if store is None:
+                store = RunStore(db_path)
+                _RUN_STORES[db_path] = store
+    return store
+
+
+def get_run_writer(db_path=DB_PATH):
+    writer = _RUN_WRITERS.get(db_path)
+    if writer is None:
+        store = get_run_store(db_path)
+        with _STATUS_STORES_LOCK:
+            writer = _RUN_WRITERS.get(db_path)
+            if writer is None:
+                writer = WriteBehindStatusWriter(store)
+                _RUN_WRITERS[db_path] = writer
+    return writer
+
+
 def update_process_status(user_id, updates, db_path=DB_PATH):
     """
     Updates the status fields for a given user_id in the database.
@@ -67,79 +552,22 @@ def update_process_status(user_id, updates, db_path=DB_PATH):
                         and values are their new status.
         db_path (str): Path to the SQLite database file.
     """
+    if STATUS_WRITE_BEHIND:
+        get_status_writer(db_path).submit(user_id, updates)
+    else:
+        get_status_store(db_path).update(user_id, updates)
 
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
 
-        current_time = datetime.datetime.now().isoformat()
+def flush_process_status(user_id=None, db_path=DB_PATH, timeout=None):
+    """
+    Flush-on-completion hook: waits until queued status updates for user_id (or all users) are committed.
+    No-op when write-behind mode is off.
+    """
+    writer = _STATUS_WRITERS.get(db_path)
+    if writer is None:
+        return True
+    return writer.flush(user_id, timeout)
 
-       
-        cursor.execute(f"PRAGMA table_info({PROCESS_TABLE_NAME});")
-        table_columns_info = cursor.fetchall()
-        # Extract column names (second element in each tuple)
-        existing_columns = {col[1] for col in table_columns_info}
-
-        # Check if the user_id already exists
-        cursor.execute(f"SELECT user_id FROM {PROCESS_TABLE_NAME} WHERE user_id = ?", (user_id,))
-        existing_user = cursor.fetchone()
-
-        if existing_user:
-            # Update existing record
-            set_clauses = []
-            values = []
-            
-            # Filter updates to only include fields that exist in the table
-            for field, value in updates.items():
-                if field in existing_columns and field not in ['user_id', 'last_updated']:
-                    set_clauses.append(f"{field} = ?")
-                    values.append(value)
-            
-            # Always update last_updated
-            set_clauses.append("last_updated = ?")
-            values.append(current_time)
-            values.append(user_id) # For the WHERE clause
-
-            if not set_clauses: # If no valid fields were provided in updates
-                print(f"No valid fields to update for user '{user_id}'.")
-                return
-
-            update_sql = f"UPDATE {PROCESS_TABLE_NAME} SET {', '.join(set_clauses)} WHERE user_id = ?"
-            cursor.execute(update_sql, tuple(values))
-            #print(f"Updated status for user '{user_id}'.")
-        else:
-        
-            new_record_data = {
-                'user_id': user_id,
-                'last_updated': current_time
-            }
-
-            # Add provided updates, ensuring they are valid columns
-            for field, value in updates.items():
-                if field in existing_columns and field not in ['user_id', 'last_updated']:
-                    new_record_data[field] = value
-            
-          
-            for col_name in existing_columns:
-                if col_name not in new_record_data and col_name not in ['user_id', 'last_updated']:
-                    new_record_data[col_name] = None 
-                    
-            columns = ', '.join(new_record_data.keys())
-            placeholders = ', '.join(['?' for _ in new_record_data.keys()])
-            values = tuple(new_record_data.values())
-
-            insert_sql = f"INSERT INTO {PROCESS_TABLE_NAME} ({columns}) VALUES ({placeholders})"
-            cursor.execute(insert_sql, values)
-            print(f"Created new status record for user '{user_id}'.")
-
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Error updating process status for user '{user_id}': {e}")
-    finally:
-        if conn:
-            conn.close()
-    #print('DEBUG: update DB')
 
 def get_process_status(user_id, field_name=None, db_path=DB_PATH):
     """
@@ -149,7 +577,7 @@ def get_process_status(user_id, field_name=None, db_path=DB_PATH):
     Args:
         user_id (str): The unique identifier for the user.
         field_name (str, optional): The name of the specific field to retrieve
-                                    (e.g., 'field1', 'last_updated').
+                                    (e.g., 'sql', 'last_updated').
                                     If None, all fields are retrieved.
         db_path (str): Path to the SQLite database file.
 
@@ -159,39 +587,8 @@ def get_process_status(user_id, field_name=None, db_path=DB_PATH):
             - If field_name is None, returns a dictionary containing all process status fields,
               or None if the user_id is not found.
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+    return get_status_store(db_path).get(user_id, field_name)
 
-        if field_name:
-            # Validate field_name to prevent SQL injection
-            valid_fields = [f'field{i}' for i in range(1, 9)] + ['user_id', 'last_updated']
-            if field_name not in valid_fields:
-                print(f"Invalid field name '{field_name}'.")
-                return None
-            select_sql = f"SELECT {field_name} FROM {PROCESS_TABLE_NAME} WHERE user_id = ?"
-            cursor.execute(select_sql, (user_id,))
-            row = cursor.fetchone()
-            return row[0] if row else None
-        else:
-            select_sql = f"SELECT * FROM {PROCESS_TABLE_NAME} WHERE user_id = ?"
-            cursor.execute(select_sql, (user_id,))
-            row = cursor.fetchone()
-
-            if row:
-                # Get column names from cursor description
-                col_names = [description[0] for description in cursor.description]
-                return dict(zip(col_names, row))
-            else:
-                print(f"No status found for user '{user_id}'.")
-                return None
-    except sqlite3.Error as e:
-        print(f"Error retrieving process status for user '{user_id}': {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
 
 def delete_process_status(user_id, db_path=DB_PATH):
     """
@@ -204,31 +601,162 @@ def delete_process_status(user_id, db_path=DB_PATH):
     Returns:
         bool: True if the entry was deleted (or didn't exist), False if an error occurred.
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+    writer = _STATUS_WRITERS.get(db_path)
+    if writer is not None:
+        # queued updates must not recreate the record after the delete
+        writer.discard(user_id)
+    return get_status_store(db_path).delete(user_id)
 
-        delete_sql = f"DELETE FROM {PROCESS_TABLE_NAME} WHERE user_id = ?"
-        cursor.execute(delete_sql, (user_id,))
-        conn.commit()
 
-        if cursor.rowcount > 0:
-            print(f"Deleted status for user '{user_id}'.")
-            return True
-        else:
-            #print(f"No status found for user '{user_id}' to delete.")
-            return True # Still return True as the desired state (absence of user) is met
-    except sqlite3.Error as e:
-        print(f"Error deleting process status for user '{user_id}': {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+def start_run(user_id, question, run_id=None, status='running', db_path=DB_PATH):
+    """
+    Records a new pipeline run for user_id (or moves a queued run to running) and returns its run_id.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    get_run_store(db_path).start_run(run_id, user_id, question, status)
+    return run_id
 
 
-if __name__ == "__main__":
-    create_db_and_table()
+def start_run_step(run_id, step, db_path=DB_PATH):
+    """
+    Stamps the start time of a step, so its latency can be read back from the step row.
+    """
+    get_run_store(db_path).start_step(run_id, step)
+
 
+def update_run_steps(run_id, updates, db_path=DB_PATH):
+    """
+    Saves step payloads for a run. updates is step name -> payload.
+    """
+    if STATUS_WRITE_BEHIND:
+        get_run_writer(db_path).submit(run_id, updates)
+    else:
+        get_run_store(db_path).update(run_id, updates)
 
 
+def finish_run(run_id, status='done', db_path=DB_PATH):
+    """
+    Flushes any queued step writes for the run, then marks it finished with the given status.
+    """
+    writer = _RUN_WRITERS.get(db_path)
+    if writer is not None and not writer.flush(run_id, WRITE_BEHIND_FLUSH_TIMEOUT):
+        print(f"Warning: queued step writes of run '{run_id}' were not committed within {WRITE_BEHIND_FLUSH_TIMEOUT}s")
+    get_run_store(db_path).finish_run(run_id, status)
+
+
+def list_runs(user_id, include_dismissed=False, limit=20, db_path=DB_PATH):
+    return get_run_store(db_path).list_runs(user_id, include_dismissed, limit)
+
+
+def get_run(run_id, db_path=DB_PATH):
+    return get_run_store(db_path).get_run(run_id)
+
+
+def dismiss_runs(user_id, db_path=DB_PATH):
+    return get_run_store(db_path).dismiss_runs(user_id)
+
+
+def is_run_dismissed(run_id, db_path=DB_PATH):
+    return get_run_store(db_path).is_dismissed(run_id)
+
+
+def get_step_latencies(since=None, db_path=DB_PATH):
+    return get_run_store(db_path).step_latencies(since)
+
+
+def print_step_latencies(since=None, db_path=DB_PATH):
+    for step, seconds in sorted(get_step_latencies(since, db_path).items()):
+        seconds = sorted(seconds)
+        print(f"{step}: runs={len(seconds)} avg={sum(seconds) / len(seconds):.2f}s "
+              f"median={seconds[len(seconds) // 2]:.2f}s max={seconds[-1]:.2f}s")
+
+
+def benchmark_status_writes(num_users=50, writes_per_user=9, db_path="status_benchmark.db", write_behind=False):
+    """
+    Microbenchmark: num_users threads each write a full pipeline's worth of status updates
+    concurrently. Prints and returns the writes/sec achieved.
+    write_behind=True measures the group commit writer, including the final flush.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    create_db_and_table(db_path)
+    store = StatusStore(db_path)
+    writer = WriteBehindStatusWriter(store) if write_behind else None
+    fields = ['user_question', 'cleaned_question', 'tables', 'joins', 'grouping', 'calculations', 'filtering', 'sql_draft', 'sql']
+    payload = json.dumps({"reasoning": "x" * 500})
+
+    def run_user(i):
+        for n in range(writes_per_user):
+            if writer is not None:
+                writer.submit(f"bench_user_{i}", {fields[n % len(fields)]: payload})
+            else:
+                store.update(f"bench_user_{i}", {fields[n % len(fields)]: payload})
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_user, args=(i,)) for i in range(num_users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if writer is not None:
+        writer.flush()
+    elapsed = time.perf_counter() - start
+
+    total_writes = num_users * writes_per_user
+    writes_per_sec = total_writes / elapsed
+    mode = "write-behind" if write_behind else "direct"
+    print(f"{total_writes} status writes ({mode}) from {num_users} concurrent users in {elapsed:.2f}s: {writes_per_sec:.0f} writes/sec")
+    if writer is not None:
+        writer.stop()
+    store.close()
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    return writes_per_sec
+
+
+async def aupdate_process_status(user_id, updates, db_path=DB_PATH):
+    """
+    Async version of update_process_status, the write runs off the event loop.
+    """
+    return await asyncio.to_thread(update_process_status, user_id, updates, db_path)
+
+
+async def adelete_process_status(user_id, db_path=DB_PATH):
+    """
+    Async version of delete_process_status, the delete runs off the event loop.
+    """
+    return await asyncio.to_thread(delete_process_status, user_id, db_path)
+
+
+async def astart_run(user_id, question, run_id=None, db_path=DB_PATH):
+    return await asyncio.to_thread(start_run, user_id, question, run_id, 'running', db_path)
+
+
+async def astart_run_step(run_id, step, db_path=DB_PATH):
+    return await asyncio.to_thread(start_run_step, run_id, step, db_path)
+
+
+async def aupdate_run_steps(run_id, updates, db_path=DB_PATH):
+    return await asyncio.to_thread(update_run_steps, run_id, updates, db_path)
+
+
+async def afinish_run(run_id, status='done', db_path=DB_PATH):
+    return await asyncio.to_thread(finish_run, run_id, status, db_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the status database, or benchmark status writes.")
+    parser.add_argument("--benchmark", action="store_true", help="Run the concurrent status write microbenchmark.")
+    parser.add_argument("--users", type=int, default=50, help="Concurrent users for the benchmark.")
+    parser.add_argument("--writes", type=int, default=9, help="Status writes per user for the benchmark.")
+    parser.add_argument("--write-behind", action="store_true", help="Benchmark the write-behind group commit mode.")
+    parser.add_argument("--latencies", action="store_true", help="Print per step latencies from the run history.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_status_writes(args.users, args.writes, write_behind=args.write_behind)
+    elif args.latencies:
+        print_step_latencies()
+    else:
+        create_db_and_table()
@@ -0,0 +1,341 @@
+# File: job_queue.py
+# Description: SQLite backed job queue and worker pool for pipeline runs
+#  the UI only submits questions and watches the run, workers run the pipeline
+#  concurrency is bounded globally (number of workers) and per user
+#  running jobs hold a lease renewed by a heartbeat, jobs of a worker that died are recovered
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly, or as a standalone worker process
+#   python3 job_queue.py --workers 4 --per-user 1
+#
+import sqlite3
+import datetime
+import json
+import threading
+import time
+import uuid
+import argparse
+from internal_db import DB_PATH, start_run, finish_run, is_run_dismissed
+from run_control import RunCancelled, RunTimeout
+
+JOBS_TABLE_NAME = 'pipeline_jobs'
+JOB_WORKERS = 2
+JOB_MAX_PER_USER = 1
+JOB_POLL_INTERVAL = 1.0
+# A running job whose heartbeat is older than this is considered lost (worker crashed or restarted)
+JOB_LEASE_SECONDS = 120
+# Lost jobs are queued again until they have been claimed this many times, then failed
+JOB_MAX_ATTEMPTS = 2
+
+# Columns added to the jobs table after the first release, migrated by _ensure_table
+JOB_ADDED_COLUMNS = {
+    'heartbeat_at': 'TEXT',
+    'attempts': 'INTEGER DEFAULT 0',
+}
+
+
+def run_pipeline_job(question, user_id, run_id, **params):
+    """
+    Runs a job's pipeline and returns the status its run was finished with, e.g. 'done' or 'rejected'.
+    """
+    # imported here so the queue itself does not need the pipeline's dependencies
+    from gen_sql import run_thinking_agent
+    result, status = run_thinking_agent(question, user_id, run_id=run_id, raise_aborted=True, **params)
+    return status
+
+
+class JobQueue:
+    """
+    Durable queue of pipeline runs in the status database. A job's id is also its run_id, so the
+    UI follows a submitted question through the run history and progress bus as usual.
+
+    Workers claim the oldest queued job whose user is below max_per_user running jobs. The claim
+    is one IMMEDIATE transaction, so workers in several processes can share the same queue.
+
+    A claimed job holds a lease of lease_seconds, renewed by a heartbeat thread while it runs. Jobs
+    whose lease ran out are recovered (see recover_expired), so a crash never leaves a user's
+    running slot taken. runner(question, user_id, run_id, **params) runs a job.
+    """
+
+    def __init__(self, db_path=DB_PATH, num_workers=JOB_WORKERS, max_per_user=JOB_MAX_PER_USER, poll_interval=JOB_POLL_INTERVAL,
+                 lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS, runner=run_pipeline_job):
+        self.db_path = db_path
+        self.num_workers = num_workers
+        self.max_per_user = max_per_user
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.runner = runner
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._workers = []
+        self._running = set()
+        self._heartbeat = None
+        self._stopped = False
+        self._ensure_table()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode, transactions are opened explicitly
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            self._local.conn = conn
+        return conn
+
+    def _ensure_table(self):
+        conn = self._connection()
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {JOBS_TABLE_NAME} (
+            job_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            question TEXT,
+            params TEXT,
+            status TEXT DEFAULT 'queued',
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT
+        );
+        """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{JOBS_TABLE_NAME}_status_created ON {JOBS_TABLE_NAME} (status, created_at);")
+        existing_columns = {col[1] for col in conn.execute(f"PRAGMA table_info({JOBS_TABLE_NAME});")}
+        for col_name, col_type in JOB_ADDED_COLUMNS.items():
+            if col_name not in existing_columns:
+                conn.execute(f"ALTER TABLE {JOBS_TABLE_NAME} ADD COLUMN {col_name} {col_type}")
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat()
+
+    def submit(self, user_id, question, **params):
+        """
+        Queues a question for user_id and returns the job id (= run_id). params are passed on to
+        generate_thinking_agent_response, e.g. use_gemini=True.
+        """
+        job_id = uuid.uuid4().hex
+        self._connection().execute(
+            f"INSERT INTO {JOBS_TABLE_NAME} (job_id, user_id, question, params, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+            (job_id, user_id, question, json.dumps(params), self._now())
+        )
+        # the run shows up in the UI right away, as queued
+        start_run(user_id, question, job_id, status='queued', db_path=self.db_path)
+        with self._condition:
+            self._condition.notify()
+        return job_id
+
+    def claim(self):
+        """
+        Marks the next runnable job as running and returns it, or None if nothing can run now.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT job_id, user_id, question, params FROM {JOBS_TABLE_NAME} j WHERE status = 'queued' "
+                f"AND (SELECT COUNT(*) FROM {JOBS_TABLE_NAME} r WHERE r.user_id = j.user_id AND r.status = 'running') < ? "
+                f"ORDER BY created_at LIMIT 1",
+                (self.max_per_user,)
+            ).fetchone()
+            if row is not None:
+                now = self._now()
+                conn.execute(
+                    f"UPDATE {JOBS_TABLE_NAME} SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = COALESCE(attempts, 0) + 1 WHERE job_id = ?",
+                    (now, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job_id, user_id, question, params = row
+        return {"job_id": job_id, "user_id": user_id, "question": question, "params": json.loads(params or "{}")}
+
+    def recover_expired(self):
+        """
+        Jobs left 'running' with no heartbeat for lease_seconds (their worker died) are queued
+        again, or failed once they have been claimed max_attempts times. Returns the number recovered.
+        """
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=self.lease_seconds)).isoformat()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT job_id, COALESCE(attempts, 0) FROM {JOBS_TABLE_NAME} WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?",
+                (cutoff,)
+            ).fetchall()
+            failed = [job_id for job_id, attempts in rows if attempts >= self.max_attempts]
+            for job_id, attempts in rows:
+                if job_id in failed:
+                    conn.execute(f"UPDATE {JOBS_TABLE_NAME} SET status = 'failed', finished_at = ?, error = 'lease expired' WHERE job_id = ?", (self._now(), job_id))
+                else:
+                    conn.execute(f"UPDATE {JOBS_TABLE_NAME} SET status = 'queued' WHERE job_id = ?", (job_id,))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        for job_id in failed:
+            finish_run(job_id, 'failed', db_path=self.db_path)
+        if rows:
+            print(f"Recovered {len(rows)} jobs with an expired lease, {len(failed)} failed")
+            with self._condition:
+                self._condition.notify_all()
+        return len(rows)
+
+    def heartbeat(self):
+        """
+        Renews the lease of the jobs running in this queue.
+        """
+        with self._condition:
+            job_ids = list(self._running)
+        if job_ids:
+            self._connection().execute(
+                f"UPDATE {JOBS_TABLE_NAME} SET heartbeat_at = ? WHERE job_id IN ({','.join('?' * len(job_ids))}) AND status = 'running'",
+                (self._now(), *job_ids)
+            )
+
+    def _heartbeat_loop(self):
+        while not self._stopped:
+            try:
+                self.heartbeat()
+                self.recover_expired()
+            except sqlite3.Error as e:
+                print(f"Error renewing job leases: {e}")
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped, timeout=self.lease_seconds / 4)
+
+    def _finish(self, job_id, status, error=None):
+        self._connection().execute(
+            f"UPDATE {JOBS_TABLE_NAME} SET status = ?, finished_at = ?, error = ? WHERE job_id = ?",
+            (status, self._now(), error, job_id)
+        )
+        # a slot for this user is free again
+        with self._condition:
+            self._condition.notify_all()
+
+    def run_job(self, job):
+        """
+        Runs a claimed job, its status follows the run's outcome: the status the runner returns
+        (done, rejected, no_sql, ...), or cancelled, timeout or failed when it raised.
+        """
+        if is_run_dismissed(job['job_id'], self.db_path):
+            # the user pressed Reset while the job was queued
+            self._finish(job['job_id'], 'cancelled')
+            finish_run(job['job_id'], 'cancelled', db_path=self.db_path)
+            return
+        with self._condition:
+            self._running.add(job['job_id'])
+        try:
+            status = self.runner(job['question'], job['user_id'], job['job_id'], **job['params'])
+            self._finish(job['job_id'], status or 'done')
+        except RunCancelled:
+            self._finish(job['job_id'], 'cancelled')
+        except RunTimeout as e:
+            self._finish(job['job_id'], 'timeout', str(e))
+        except Exception as e:
+            print(f"Error running job '{job['job_id']}': {e}")
+            self._finish(job['job_id'], 'failed', str(e))
+        finally:
+            with self._condition:
+                self._running.discard(job['job_id'])
+
+    def _worker(self):
+        while not self._stopped:
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming job: {e}")
+                job = None
+
+            if job is None:
+                # woken by submit/finish in this process, the timeout picks up jobs from other processes
+                with self._condition:
+                    self._condition.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def start(self):
+        """
+        Starts the worker threads. Safe to call more than once.
+        """
+        # jobs a previous process left running
+        self.recover_expired()
+        with self._condition:
+            if self._workers:
+                return
+            self._stopped = False
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="pipeline_job_heartbeat", daemon=True)
+            self._heartbeat.start()
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._worker, name=f"pipeline_job_{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self):
+        """
+        Stops the workers after their current job.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self._workers = []
+        self._heartbeat = None
+
+    def get_job(self, job_id):
+        cursor = self._connection().execute(f"SELECT * FROM {JOBS_TABLE_NAME} WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([description[0] for description in cursor.description], row))
+
+    def counts(self):
+        """
+        Returns status -> number of jobs, e.g. {'queued': 3, 'running': 2, 'done': 40}.
+        """
+        return dict(self._connection().execute(f"SELECT status, COUNT(*) FROM {JOBS_TABLE_NAME} GROUP BY status").fetchall())
+
+
+_JOB_QUEUE = None
+_JOB_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Returns the process wide job queue with its workers running.
+    """
+    global _JOB_QUEUE
+    with _JOB_QUEUE_LOCK:
+        if _JOB_QUEUE is None:
+            _JOB_QUEUE = JobQueue()
+            _JOB_QUEUE.start()
+    return _JOB_QUEUE
+
+
+def submit_job(user_id, question, **params):
+    """
+    Submits a question for user_id and returns its run_id.
+    """
+    return get_job_queue().submit(user_id, question, **params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run pipeline jobs from the queue.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="Number of concurrent pipeline runs.")
+    parser.add_argument("--per-user", type=int, default=JOB_MAX_PER_USER, help="Max concurrent runs per user.")
+    args = parser.parse_args()
+
+    queue = JobQueue(num_workers=args.workers, max_per_user=args.per_user)
+    queue.start()
+    print(f"Job workers started: {args.workers} workers, {args.per_user} per user. Jobs: {queue.counts()}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"Jobs: {queue.counts()}")
+    except KeyboardInterrupt:
+        queue.stop()
@@ -0,0 +1,165 @@
+# File: llm_cache.py
+# Description: persistent prompt -> response cache for the pipeline LLM calls
+#  temperature is 0.0, so identical prompts to the same model give the same answer
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#   python3 llm_cache.py   -> print cache metrics
+#   python3 llm_cache.py --clear
+#
+import sqlite3
+import hashlib
+import threading
+import time
+import argparse
+
+CACHE_DB_PATH = 'llm_cache.db'
+CACHE_TABLE_NAME = 'llm_response_cache'
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 5000
+
+
+class LLMResponseCache:
+    """
+    Content addressed cache keyed on a hash of (model, json_mode, rendered prompt).
+    Entries expire after ttl_seconds and the least recently used entries are evicted
+    once the cache holds more than max_entries. Keeps hit/miss metrics for the process.
+    """
+
+    def __init__(self, db_path=CACHE_DB_PATH, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "expired": 0, "puts": 0, "evictions": 0}
+        self._ensure_table()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            self._local.conn = conn
+        return conn
+
+    def _ensure_table(self):
+        conn = self._connection()
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CACHE_TABLE_NAME} (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT,
+            json_mode INTEGER,
+            response TEXT,
+            created_at REAL,
+            last_accessed REAL
+        );
+        """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{CACHE_TABLE_NAME}_last_accessed ON {CACHE_TABLE_NAME} (last_accessed);")
+        conn.commit()
+
+    def _count(self, metric, amount=1):
+        with self._metrics_lock:
+            self._metrics[metric] += amount
+
+    @staticmethod
+    def make_key(model, json_mode, prompt):
+        payload = f"{model}\x00{int(bool(json_mode))}\x00{prompt}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model, json_mode, prompt):
+        """
+        Returns the cached response or None. Expired entries are removed on read.
+        """
+        key = self.make_key(model, json_mode, prompt)
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(f"SELECT response, created_at FROM {CACHE_TABLE_NAME} WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+
+            response, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                conn.execute(f"DELETE FROM {CACHE_TABLE_NAME} WHERE cache_key = ?", (key,))
+                conn.commit()
+                self._count("expired")
+                self._count("misses")
+                return None
+
+            conn.execute(f"UPDATE {CACHE_TABLE_NAME} SET last_accessed = ? WHERE cache_key = ?", (now, key))
+            conn.commit()
+            self._count("hits")
+            return response
+        except sqlite3.Error as e:
+            print(f"Error reading LLM cache: {e}")
+            self._count("misses")
+            return None
+
+    def put(self, model, json_mode, prompt, response):
+        """
+        Stores a response, then evicts least recently used entries above max_entries.
+        """
+        key = self.make_key(model, json_mode, prompt)
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT OR REPLACE INTO {CACHE_TABLE_NAME} (cache_key, model, json_mode, response, created_at, last_accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, int(bool(json_mode)), response, now, now)
+            )
+            self._count("puts")
+
+            if self.max_entries is not None:
+                cursor = conn.execute(
+                    f"DELETE FROM {CACHE_TABLE_NAME} WHERE cache_key IN "
+                    f"(SELECT cache_key FROM {CACHE_TABLE_NAME} ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+                if cursor.rowcount > 0:
+                    self._count("evictions", cursor.rowcount)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def purge_expired(self):
+        if self.ttl_seconds is None:
+            return 0
+        conn = self._connection()
+        cursor = conn.execute(f"DELETE FROM {CACHE_TABLE_NAME} WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        conn.commit()
+        self._count("expired", cursor.rowcount)
+        return cursor.rowcount
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute(f"DELETE FROM {CACHE_TABLE_NAME}")
+        conn.commit()
+
+    def metrics(self):
+        """
+        Returns hit/miss counters for this process plus the current number of entries.
+        """
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = metrics["hits"] / lookups if lookups else 0.0
+        metrics["entries"] = self._connection().execute(f"SELECT COUNT(*) FROM {CACHE_TABLE_NAME}").fetchone()[0]
+        return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the LLM response cache.")
+    parser.add_argument("--clear", action="store_true", help="Delete every cached response.")
+    parser.add_argument("--purge-expired", action="store_true", help="Delete responses older than the TTL.")
+    args = parser.parse_args()
+
+    cache = LLMResponseCache()
+    if args.clear:
+        cache.clear()
+        print("LLM cache cleared.")
+    if args.purge_expired:
+        print(f"Purged {cache.purge_expired()} expired responses.")
+    print(cache.metrics())
@@ -0,0 +1,105 @@
+# File: llm_pool.py
+# Description: process wide pool of LLM clients
+#  keeps one client per (backend, model, json_mode) so HTTP keep-alive connections are reused
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LLMClientPool:
+    """
+    Holds long lived LLM clients keyed by (backend, model, json_mode).
+    Clients are built once with the given factory and then shared, so the per call
+    client setup and TCP/TLS handshakes drop out of the hot path.
+    Also keeps connection and latency stats per key.
+    on_call(key, seconds, ok) is called after every tracked call, e.g. to feed the model router.
+    """
+
+    def __init__(self, on_call=None):
+        self._clients = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.on_call = on_call
+
+    def _new_stats(self):
+        return {"created": 0, "reused": 0, "calls": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0}
+
+    def get(self, key, factory):
+        """
+        Returns the pooled client for key, building it with factory() on first use.
+        """
+        client = self._clients.get(key)
+        if client is not None:
+            with self._lock:
+                self._stats[key]["reused"] += 1
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory()
+                self._clients[key] = client
+                self._stats.setdefault(key, self._new_stats())["created"] += 1
+            else:
+                self._stats[key]["reused"] += 1
+        return client
+
+    @contextmanager
+    def track(self, key):
+        """
+        Records the latency and outcome of one call made with the client for key.
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record_call(key, time.perf_counter() - start, ok)
+
+    def record_call(self, key, seconds, ok=True):
+        with self._lock:
+            stats = self._stats.setdefault(key, self._new_stats())
+            stats["calls"] += 1
+            stats["total_latency"] += seconds
+            stats["max_latency"] = max(stats["max_latency"], seconds)
+            if not ok:
+                stats["errors"] += 1
+        if self.on_call is not None:
+            self.on_call(key, seconds, ok)
+
+    def evict(self, key=None):
+        """
+        Drops a pooled client (or all of them), e.g. after its connection went bad.
+        """
+        with self._lock:
+            if key is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(key, None)
+
+    def stats(self):
+        """
+        Returns a copy of the stats per key, with the average latency filled in.
+        """
+        with self._lock:
+            snapshot = {}
+            for key, stats in self._stats.items():
+                stats = dict(stats)
+                stats["avg_latency"] = stats["total_latency"] / stats["calls"] if stats["calls"] else 0.0
+                stats["pooled"] = key in self._clients
+                snapshot[key] = stats
+            return snapshot
+
+    def print_stats(self):
+        for key, stats in self.stats().items():
+            backend, model, json_mode = key
+            print(f"{backend}/{model} (json={json_mode}): created={stats['created']} reused={stats['reused']} "
+                  f"calls={stats['calls']} errors={stats['errors']} avg={stats['avg_latency']:.2f}s max={stats['max_latency']:.2f}s")
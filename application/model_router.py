@@ -0,0 +1,134 @@
+# File: model_router.py
+# Description: picks the backend and model for each pipeline step
+#  from a per step config and the observed latency / success rate of every model
+#  unhealthy models are skipped until a cooldown has passed, the next candidate is used instead
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Step whose call is in flight, set by the routed call so the latency of a call made deep down in
+# the client code (LLMClientPool.on_call) is recorded for that step
+ROUTED_STEP = contextvars.ContextVar("routed_step", default=None)
+
+
+@contextmanager
+def routed_step(step):
+    token = ROUTED_STEP.set(step)
+    try:
+        yield
+    finally:
+        ROUTED_STEP.reset(token)
+
+
+class ModelRouter:
+    """
+    Routes are step name -> candidates, e.g.
+        {"tables": [{"backend": "ollama", "model": "phi4", "tier": 0, "max_latency": 60},
+                    {"backend": "gemini", "model": "gemini-2.5-flash", "tier": 1}]}
+
+    A candidate is healthy while its success rate (EWMA) is at least 1 - max_error_rate and its
+    latency (EWMA) is under its optional max_latency. Unhealthy candidates move to the back of the
+    list, and get probed again once cooldown seconds have passed since they were last used.
+    The success rate is kept per model, the latency per (step, model): a model's calls for the
+    short steps are not judged by its calls for the long generation steps.
+    Every candidate has a "tier", the order of preference: lower tiers go first, candidates with
+    the same tier are interchangeable and the faster one goes first. Raises ValueError for a
+    candidate without a tier.
+    """
+
+    def __init__(self, routes, alpha=0.3, max_error_rate=0.5, cooldown=60.0):
+        for step, candidates in routes.items():
+            for candidate in candidates:
+                if not isinstance(candidate.get("tier"), int):
+                    raise ValueError(f"Route for step '{step}': candidate {candidate.get('backend')}/{candidate.get('model')} needs an integer 'tier'")
+        self.routes = routes
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self._stats = {}
+        self._step_latency = {}
+        self._lock = threading.Lock()
+
+    def _ewma(self, value, sample):
+        return sample if value is None else value + self.alpha * (sample - value)
+
+    def observe(self, backend, model, seconds, ok=True, step=None):
+        """
+        Records the outcome of one call, made for step (default: ROUTED_STEP). Failed calls don't
+        update the latency.
+        """
+        step = step or ROUTED_STEP.get()
+        with self._lock:
+            stats = self._stats.get((backend, model))
+            if stats is None:
+                stats = {"latency": None, "success": 1.0 if ok else 0.0, "calls": 0, "errors": 0, "last_call": 0.0}
+                self._stats[(backend, model)] = stats
+            else:
+                stats["success"] += self.alpha * ((1.0 if ok else 0.0) - stats["success"])
+            if ok:
+                stats["latency"] = self._ewma(stats["latency"], seconds)
+                if step is not None:
+                    key = (step, backend, model)
+                    self._step_latency[key] = self._ewma(self._step_latency.get(key), seconds)
+            stats["calls"] += 1
+            if not ok:
+                stats["errors"] += 1
+            stats["last_call"] = time.monotonic()
+
+    def is_healthy(self, candidate, step=None):
+        with self._lock:
+            stats = self._stats.get((candidate["backend"], candidate["model"]))
+            if stats is None:
+                return True
+            healthy = stats["success"] >= 1.0 - self.max_error_rate
+            max_latency = candidate.get("max_latency")
+            latency = self._step_latency.get((step, candidate["backend"], candidate["model"]))
+            if max_latency is not None and latency is not None and latency > max_latency:
+                healthy = False
+            # give a demoted model another chance once it has rested
+            return healthy or time.monotonic() - stats["last_call"] >= self.cooldown
+
+    def expected_latency(self, candidate, step=None):
+        """
+        Latency EWMA of the candidate's calls for step, 0.0 before its first call for the step.
+        """
+        with self._lock:
+            return self._step_latency.get((step, candidate["backend"], candidate["model"])) or 0.0
+
+    def candidates(self, step, prefer_backend=None):
+        """
+        Returns the candidates for step, best first: healthy before unhealthy, candidates of
+        prefer_backend first, then by tier, and by latency for this step within a tier.
+        """
+        def rank(candidate):
+            preferred = prefer_backend is None or candidate["backend"] == prefer_backend
+            return (not self.is_healthy(candidate, step), not preferred, candidate["tier"], self.expected_latency(candidate, step))
+
+        return sorted(self.routes.get(step, []), key=rank)
+
+    def stats(self):
+        with self._lock:
+            return {key: dict(stats) for key, stats in self._stats.items()}
+
+    def step_latencies(self):
+        """
+        Returns (step, backend, model) -> latency EWMA.
+        """
+        with self._lock:
+            return dict(self._step_latency)
+
+    def print_stats(self):
+        for (backend, model), stats in self.stats().items():
+            print(f"route {backend}/{model}: calls={stats['calls']} errors={stats['errors']} "
+                  f"latency_ewma={stats['latency'] or 0.0:.2f}s success_ewma={stats['success']:.2f}")
+        for (step, backend, model), latency in sorted(self.step_latencies().items()):
+            print(f"  {step} {backend}/{model}: latency_ewma={latency:.2f}s")
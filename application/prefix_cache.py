@@ -0,0 +1,118 @@
+# File: prefix_cache.py
+# Description: prompts with a shared prefix, and Gemini context caching of that prefix
+#  the step prompts of one question all start with the same schema / business terms / question
+#  block, so only the step specific suffix has to be prefilled from the second step on
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import datetime
+import hashlib
+import threading
+import time
+from tracing import estimate_tokens
+
+
+class SharedPrefixPrompt(str):
+    """
+    A prompt made of a prefix shared by several calls and a call specific suffix.
+    It is the full prompt string everywhere (LLM cache keys, Ollama, logs), backends that can
+    cache the prefix read .prefix and .suffix and send only the suffix.
+    """
+
+    def __new__(cls, prefix, suffix):
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix = prefix
+        prompt.suffix = suffix
+        return prompt
+
+
+class GeminiPrefixCache:
+    """
+    Gemini CachedContent per (model, prefix), created on first use and reused by every call that
+    starts with the same prefix until ttl_seconds have passed.
+    Prefixes under min_tokens (estimated) are not cached, Gemini rejects small caches. A failed
+    create is remembered for the prefix, those calls send the full prompt instead.
+    The create call runs outside the cache's lock, only callers for the same prefix wait for it.
+    """
+
+    def __init__(self, ttl_seconds=600, min_tokens=2048):
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._metrics = {"created": 0, "reused": 0, "skipped": 0, "failed": 0}
+
+    def _prune(self, now):
+        for key in [key for key, entry in self._entries.items() if entry["expires"] <= now]:
+            del self._entries[key]
+
+    def get_model(self, model_name, prefix, json_mode=False, response_schema=None, schema_name=None):
+        """
+        Returns a GenerativeModel bound to the cached prefix, or None if the prefix is not cached.
+        response_schema (named schema_name) constrains the output, see step_schemas.
+        genai must already be configured.
+        """
+        if estimate_tokens(prefix) < self.min_tokens:
+            self._count("skipped")
+            return None
+
+        import google.generativeai as genai
+        from google.generativeai import caching
+
+        key = (model_name, hashlib.sha256(prefix.encode("utf-8")).hexdigest())
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            entry = self._entries.get(key)
+            creator = entry is None
+            if creator:
+                # other callers for this prefix wait on 'ready', callers for other prefixes don't wait at all
+                # a little under the server side ttl, so an entry never outlives its cache
+                entry = {"content": None, "models": {}, "ready": threading.Event(), "lock": threading.Lock(),
+                         "expires": now + self.ttl_seconds * 0.9}
+                self._entries[key] = entry
+
+        if creator:
+            try:
+                entry["content"] = caching.CachedContent.create(
+                    model=model_name,
+                    contents=[prefix],
+                    ttl=datetime.timedelta(seconds=self.ttl_seconds),
+                )
+                self._count("created")
+            except Exception as e:
+                # remembered until the entry expires, those calls send the full prompt
+                print(f"Could not cache prompt prefix for {model_name}: {e}")
+                self._count("failed")
+            finally:
+                entry["ready"].set()
+        else:
+            entry["ready"].wait()
+            if entry["content"] is not None:
+                self._count("reused")
+
+        if entry["content"] is None:
+            return None
+        with entry["lock"]:
+            model = entry["models"].get((json_mode, schema_name))
+            if model is None:
+                generation_config = None
+                if response_schema is not None:
+                    generation_config = genai.GenerationConfig(response_mime_type="application/json", response_schema=response_schema)
+                elif json_mode:
+                    generation_config = genai.GenerationConfig(response_mime_type="application/json")
+                model = genai.GenerativeModel.from_cached_content(cached_content=entry["content"], generation_config=generation_config)
+                entry["models"][(json_mode, schema_name)] = model
+            return model
+
+    def _count(self, metric):
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics, entries=len(self._entries))
@@ -0,0 +1,217 @@
+# File: progress_bus.py
+# Description: in-process pub/sub channel for pipeline progress
+#  the pipeline publishes every step result of a run here, the UI subscribes to the fields that changed
+#  SQLite (internal_db run history) is kept as the durable log
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import threading
+import time
+from internal_db import start_run, start_run_step, update_run_steps, finish_run, dismiss_runs
+from internal_db import astart_run, astart_run_step, aupdate_run_steps, afinish_run
+from run_control import cancel_run
+
+# A finished run stays on the bus this long (seconds) for the UI's last polls, after that the UI
+# reads it from the run history
+PROGRESS_RETENTION_SECONDS = 120
+
+
+class ProgressBus:
+    """
+    Holds the latest progress fields per run. Every published field gets a new version number,
+    so a subscriber only needs to remember the last version it saw to get exactly the fields
+    that changed since then. Subscribers can block on wait() until something is published.
+    Finished runs are evicted retention_seconds after finish(), so a long running process only
+    holds the runs in flight.
+    """
+
+    def __init__(self, retention_seconds=PROGRESS_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._condition = threading.Condition()
+        self._version = 0
+        # run_id -> {"fields": {field: (version, value)}, "reset_version": int}
+        self._runs = {}
+        # run_id -> time.monotonic() when the run finished
+        self._finished = {}
+
+    def _evict_expired(self, now):
+        expired = [run_id for run_id, finished_at in self._finished.items() if now - finished_at >= self.retention_seconds]
+        for run_id in expired:
+            self._runs.pop(run_id, None)
+            del self._finished[run_id]
+
+    def _run(self, run_id):
+        return self._runs.setdefault(run_id, {"fields": {}, "reset_version": 0})
+
+    def publish(self, run_id, updates):
+        with self._condition:
+            self._evict_expired(time.monotonic())
+            if run_id in self._finished:
+                # late output of a finished run, e.g. from an abandoned LLM call
+                return
+            self._version += 1
+            fields = self._run(run_id)["fields"]
+            for field, value in updates.items():
+                fields[field] = (self._version, value)
+            self._condition.notify_all()
+
+    def clear(self, run_id):
+        with self._condition:
+            self._version += 1
+            run = self._run(run_id)
+            run["fields"] = {}
+            run["reset_version"] = self._version
+            self._condition.notify_all()
+
+    def finish(self, run_id):
+        """
+        Marks the run finished, it is evicted once retention_seconds have passed.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._evict_expired(now)
+            if run_id in self._runs:
+                self._finished[run_id] = now
+
+    def discard(self, run_id):
+        """
+        Forgets a run entirely, its history stays in SQLite.
+        """
+        with self._condition:
+            self._version += 1
+            self._runs.pop(run_id, None)
+            self._finished.pop(run_id, None)
+            self._condition.notify_all()
+
+    def has_run(self, run_id):
+        with self._condition:
+            self._evict_expired(time.monotonic())
+            return run_id in self._runs
+
+    def snapshot(self, run_id):
+        """
+        Returns all current fields for the run, or None if nothing has been published since the last clear.
+        """
+        with self._condition:
+            run = self._runs.get(run_id)
+            if not run or not run["fields"]:
+                return None
+            return {field: value for field, (version, value) in run["fields"].items()}
+
+    def changes_since(self, run_id, version, fields=None):
+        """
+        Returns (changed fields, reset, current version) for everything published after version.
+        """
+        with self._condition:
+            run = self._runs.get(run_id)
+            if run is None:
+                return {}, False, self._version
+            changes = {
+                field: value for field, (field_version, value) in run["fields"].items()
+                if field_version > version and (fields is None or field in fields)
+            }
+            return changes, run["reset_version"] > version, self._version
+
+    def subscribe(self, run_id, fields=None):
+        return ProgressSubscription(self, run_id, fields)
+
+    def wait(self, version, timeout=None):
+        """
+        Blocks until anything newer than version is published, or timeout. Returns True if there is news.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._version > version, timeout=timeout)
+
+
+class ProgressSubscription:
+    """
+    A subscriber's view of one run's progress. poll() returns only the fields that changed since the
+    previous poll. No queue is kept per subscriber, so abandoned subscriptions cost nothing.
+    """
+
+    def __init__(self, bus, run_id, fields=None):
+        self.bus = bus
+        self.run_id = run_id
+        self.fields = set(fields) if fields else None
+        self.version = 0
+
+    def poll(self):
+        """
+        Returns (changes, reset). reset is True when the run's progress was cleared since the last poll.
+        """
+        changes, reset, self.version = self.bus.changes_since(self.run_id, self.version, self.fields)
+        return changes, reset
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds for a publish, then polls.
+        """
+        self.bus.wait(self.version, timeout)
+        return self.poll()
+
+
+PROGRESS_BUS = ProgressBus()
+
+
+def start_progress_run(user_id, question, run_id=None):
+    """
+    Starts a new run in the history table and returns its run_id. Earlier runs of the user are kept.
+    """
+    return start_run(user_id, question, run_id)
+
+
+def start_progress_step(run_id, step):
+    start_run_step(run_id, step)
+
+
+def publish_progress(run_id, updates, persist=True):
+    """
+    Publishes step results to subscribers, and writes them to the durable run history unless persist is False.
+    """
+    PROGRESS_BUS.publish(run_id, updates)
+    if persist:
+        update_run_steps(run_id, updates)
+
+
+def finish_progress_run(run_id, status='done'):
+    """
+    Called when a run completes: makes its step writes durable and records the final status.
+    The run leaves the bus PROGRESS_RETENTION_SECONDS later.
+    """
+    finish_run(run_id, status)
+    PROGRESS_BUS.finish(run_id)
+
+
+def reset_progress(user_id):
+    """
+    Dismisses every run of the user from the UI and cancels the ones still in flight, so their
+    LLM calls stop holding worker slots. The runs stay in the history table.
+    Runs in another worker process see the dismissal through internal_db.is_run_dismissed.
+    """
+    for run_id in dismiss_runs(user_id):
+        cancel_run(run_id)
+        PROGRESS_BUS.discard(run_id)
+    return True
+
+
+async def astart_progress_run(user_id, question, run_id=None):
+    return await astart_run(user_id, question, run_id)
+
+
+async def astart_progress_step(run_id, step):
+    await astart_run_step(run_id, step)
+
+
+async def apublish_progress(run_id, updates, persist=True):
+    PROGRESS_BUS.publish(run_id, updates)
+    if persist:
+        await aupdate_run_steps(run_id, updates)
+
+
+async def afinish_progress_run(run_id, status='done'):
+    await afinish_run(run_id, status)
+    PROGRESS_BUS.finish(run_id)
@@ -35,7 +35,7 @@ def run_prompt_tests(test_filename = "./sql_test_set.jsonl", use_gemini=False, u
         instance_id = query.get('instance_id')
         print(f"\n\n!!!Generating results for prompt evaluation: {i+1}/{len(jsonl_file)}\n\n")
 
-        sql = generate_thinking_agent_response(question, user_id="default_user", use_gemini=use_gemini, save_logs=True, test_id=instance_id, use_pro=use_pro)
+        sql = generate_thinking_agent_response(question, user_id="default_user", use_gemini=use_gemini, save_logs=True, test_id=instance_id, use_pro=use_pro, use_question_cache=False)
 
         # CLEAN?
 
@@ -121,5 +121,92 @@ def run_prompt_model_tests(test_filename = "./sql_test_set.jsonl"):
     print("\n\n ------- DONE RUN PROMPT TEST ------------")
 
 
+
+def run_context_stress_test(num_runs=24, max_workers=8):
+    """
+    Runs num_runs pipelines concurrently in this process, each with its own backend, Gemini model and
+    model list, behind a fake LLM and retrieval layer (no Ollama, Gemini or Chroma needed).
+    Every LLM call is checked against the settings of the run whose question is in the prompt, and
+    every final SQL must come from its own run. Returns the list of mismatches, empty when routing is safe.
+    """
+    import re
+    import random
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import gen_sql
+    from progress_bus import reset_progress
+
+    runs = {}
+    for i in range(num_runs):
+        use_pro = i % 2 == 1
+        gemini_model = gen_sql.GEMINI_PRO_MODEL if use_pro else gen_sql.GEMINI_MODEL
+        if i % 4 == 0:
+            use_gemini, model_list = True, None
+        elif i % 4 == 1:
+            use_gemini, model_list = False, [f"stress-model-{i}"] * 5
+        else:
+            use_gemini, model_list = False, ["Gemini", f"stress-model-{i}", "Gemini", f"stress-model-{i}", "Gemini" if i % 4 == 2 else f"stress-model-{i}"]
+
+        # (backend, model) pairs this run may call
+        if model_list is None:
+            allowed = {("gemini", gemini_model)}
+        else:
+            allowed = {("ollama", gen_sql.OLLAMA_MODEL)}
+            allowed |= {("gemini", gemini_model) if value == "Gemini" else ("ollama", value) for value in model_list}
+        runs[i] = {"use_gemini": use_gemini, "use_pro": use_pro, "model_list": model_list, "allowed": allowed}
+
+    mismatches = []
+    calls = [0]
+    lock = threading.Lock()
+
+    def fake_llm_response(prompt, model_name=gen_sql.OLLAMA_MODEL, json_mode=False, use_gemini=False, gemini_model=None, on_token=None, output_cls=None, control=None, deadline=None):
+        run_index = int(re.search(r"stress-run-(\d+)", prompt).group(1))
+        used = ("gemini", gemini_model or gen_sql.GEMINI_MODEL) if use_gemini else ("ollama", model_name)
+        with lock:
+            calls[0] += 1
+            if used not in runs[run_index]["allowed"]:
+                mismatches.append(f"run {run_index} called {used}, allowed {sorted(runs[run_index]['allowed'])}")
+
+        # let the runs interleave
+        time.sleep(random.uniform(0, 0.01))
+
+        if json_mode:
+            return json.dumps({
+                "rephrased_question": f"how many orders for stress-run-{run_index}",
+                "cancel_process": False,
+                "tables": ["orders"], "columns": ["id"], "joins": [], "group_by_columns": [],
+                "aggregations": [], "calculations": [], "filters": [], "reasoning": "stress test",
+            })
+        text = f"SELECT COUNT(*) FROM orders -- stress-run-{run_index}"
+        if on_token is not None:
+            on_token(text)
+        return text
+
+    def fake_rag_context(user_question, reranker=None):
+        return "orders(id)", "no terms", [], [], {}
+
+    original_llm_response, original_rag_context = gen_sql.get_llm_response, gen_sql.get_rag_context
+    gen_sql.get_llm_response, gen_sql.get_rag_context = fake_llm_response, fake_rag_context
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                i: pool.submit(gen_sql.generate_thinking_agent_response, f"stress-run-{i}: how many orders?", user_id="stress_test",
+                               use_gemini=run["use_gemini"], use_pro=run["use_pro"], model_list=run["model_list"], use_question_cache=False)
+                for i, run in runs.items()
+            }
+            for i, future in futures.items():
+                sql = future.result()
+                if f"stress-run-{i}" not in (sql or ""):
+                    mismatches.append(f"run {i} returned another run's SQL: {sql}")
+    finally:
+        gen_sql.get_llm_response, gen_sql.get_rag_context = original_llm_response, original_rag_context
+        reset_progress("stress_test")
+
+    print(f"\n\n ------- CONTEXT STRESS TEST: {num_runs} runs, {calls[0]} LLM calls, {len(mismatches)} mismatches ------------")
+    for mismatch in mismatches:
+        print(mismatch)
+    return mismatches
+
+
 if __name__ == "__main__":
     run_prompt_tests("../sql_test_set.jsonl", True,False)
\ No newline at end of file
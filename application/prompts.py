@@ -10,6 +10,7 @@
 #
 
 
+import re
 from llama_index.core.prompts import PromptTemplate
 
 #########################################################################
@@ -1199,3 +1200,80 @@ The user's first message to you will be the `user_query`. This is your cue to be
 
 """
     
+
+
+
+#
+# Shared prefix + step suffix layout.
+# Every step prompt of a question starts with the same context block, rendered once per question,
+# so Ollama's prompt cache and Gemini context caching only have to prefill the step's suffix.
+# The suffixes are the step prompts above with their context sections taken out.
+#
+SHARED_CONTEXT_PREFIX = PromptTemplate(
+"""You are part of a pipeline that turns a user's question into a SQL query, one decision at a time.
+The context below is shared by every step. The instructions for the current step follow after it.
+
+--- Database Schema Context ---
+{schema_context}
+
+--- Business Terms & Definitions Context ---
+{business_terms_context}
+
+--- User Question ---
+{query_str}
+
+--- End of Shared Context ---
+
+"""
+)
+
+SHARED_CONTEXT_REFERENCE = "--- Schema Context, Business Terms Context and User Question: see the shared context at the top ---\n"
+_SHARED_SECTION = re.compile(r"--- [^\n]*---[ \t]*\n\{(schema_context|business_terms_context|query_str|original_question)\}[ \t]*\n(?:[ \t]*\n)?")
+
+
+def to_step_suffix(template: PromptTemplate) -> PromptTemplate:
+    """
+    The step specific part of a step prompt: the template without its schema, business terms
+    and question sections, which come from SHARED_CONTEXT_PREFIX instead.
+    """
+    sections = []
+
+    def replace(match):
+        sections.append(match.group(1))
+        return SHARED_CONTEXT_REFERENCE if len(sections) == 1 else ""
+
+    suffix = _SHARED_SECTION.sub(replace, template.template)
+    if not sections or "{schema_context}" in suffix:
+        raise ValueError("Prompt has no shared context sections to take out")
+    return PromptTemplate(suffix)
+
+
+TABLE_COLUMN_SUFFIX_V4 = to_step_suffix(TABLE_COLUMN_PROMPT_V4)
+JOIN_SUFFIX_V4 = to_step_suffix(JOIN_PROMPT_V4)
+GROUPING_SUFFIX_V3 = to_step_suffix(GROUPING_PROMPT_V3)
+CALCULATIONS_SUFFIX_V3 = to_step_suffix(CALCULATIONS_PROMPT_V3)
+FILTERING_SUFFIX_V3 = to_step_suffix(FILTERING_PROMPT_V3)
+SQL_GEN_SUFFIX_V4 = to_step_suffix(SQL_GEN_PROMPT_TEMPLATE_V4)
+CLEAN_SQL_SUFFIX_V4 = to_step_suffix(CLEAN_SQL_PROMPT_V4)
+
+
+#
+# One repair pass for step json that did not match the step's output schema
+#
+JSON_REPAIR_PROMPT = PromptTemplate(
+"""
+The JSON below was supposed to match the JSON schema that follows it, but it did not.
+Return the same content as a single JSON object that matches the schema. Keep every value that fits the schema, do not add new information.
+
+--- Invalid JSON ---
+{response}
+
+--- Error ---
+{error}
+
+--- JSON Schema ---
+{schema}
+
+JSON Output:
+"""
+)
@@ -0,0 +1,89 @@
+# File: rerank.py
+# Description: process wide cross-encoder reranker shared by all pipeline runs
+#  uses sentence-transformers
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import threading
+from typing import Dict, List
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+
+class RerankerService:
+    """
+    Loads a cross-encoder once per process (lazily, on first use) and scores candidates
+    for several collections in a single batch. Inference is serialized with a lock so
+    concurrent users can share one model in memory.
+    """
+
+    def __init__(self, model_name, top_n=5, min_score=0.0, max_length=512):
+        self.model_name = model_name
+        self.top_n = top_n
+        self.min_score = min_score
+        self.max_length = max_length
+        self._model = None
+        self._load_failed = False
+        self._load_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.model_name) and not self._load_failed
+
+    def get_model(self):
+        """
+        Returns the loaded cross-encoder, or None if no model is configured or loading failed.
+        A failed load is remembered so it is not retried on every request.
+        """
+        if not self.enabled:
+            return None
+        if self._model is not None:
+            return self._model
+
+        with self._load_lock:
+            if self._model is None and not self._load_failed:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+                    print(f"Successfully loaded reranker model: {self.model_name}")
+                except Exception as e:
+                    print(f"Could not load reranker model ({self.model_name}). Retrieval quality might be lower. Error: {e}")
+                    self._load_failed = True
+        return self._model
+
+    def rerank(self, query: str, node_groups: Dict[str, List[NodeWithScore]]) -> Dict[str, List[NodeWithScore]]:
+        """
+        Scores every (query, node) pair across all groups in one predict call, then sorts each
+        group, keeps the top_n and drops nodes scoring below min_score.
+        Groups are returned unchanged when no reranker is available.
+        """
+        model = self.get_model()
+        if model is None:
+            return node_groups
+
+        pairs = []
+        for nodes in node_groups.values():
+            for node_with_score in nodes:
+                pairs.append((query, node_with_score.node.get_content(metadata_mode=MetadataMode.EMBED)))
+
+        if not pairs:
+            return node_groups
+
+        with self._predict_lock:
+            scores = model.predict(pairs, show_progress_bar=False)
+
+        reranked_groups = {}
+        offset = 0
+        for name, nodes in node_groups.items():
+            group_scores = scores[offset: offset + len(nodes)]
+            offset += len(nodes)
+
+            rescored = [NodeWithScore(node=n.node, score=float(score)) for n, score in zip(nodes, group_scores)]
+            rescored.sort(key=lambda n: n.score, reverse=True)
+            reranked_groups[name] = [n for n in rescored[:self.top_n] if n.score >= self.min_score]
+
+        return reranked_groups
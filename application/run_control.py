@@ -0,0 +1,258 @@
+# File: run_control.py
+# Description: deadlines, cancellation and retry for the LLM calls of a pipeline run
+#  every run has a deadline, every step a deadline within it, and a Reset in the UI cancels
+#  the run's in-flight calls so a hung backend doesn't hold a worker slot
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class RunAborted(Exception):
+    """
+    Base for the errors that end a whole run, they are not retried and not caught per call.
+    """
+
+
+class RunCancelled(RunAborted):
+    pass
+
+
+class RunTimeout(RunAborted):
+    pass
+
+
+class StepTimeout(TimeoutError):
+    """
+    The step's deadline passed. Only the step gives up, the run goes on.
+    """
+
+
+# Threads the blocking LLM calls run on. An abandoned call keeps its thread until the client's
+# request timeout, later calls queue (still under their deadline) when all of them are taken
+LLM_CALL_WORKERS = 16
+_CALL_POOL = ThreadPoolExecutor(max_workers=LLM_CALL_WORKERS, thread_name_prefix="llm_call")
+
+
+class RunControl:
+    """
+    Deadline and cancel flag of one run. Deadlines are time.monotonic() values.
+    finished is set once the run is over, output that arrives later belongs to an abandoned call.
+    is_cancelled: optional callable polled at most every poll_interval seconds, for a cancel
+    that comes from another process (see internal_db.is_run_dismissed).
+    """
+
+    def __init__(self, run_id=None, deadline_seconds=None, is_cancelled=None, poll_interval=2.0):
+        self.run_id = run_id
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+        self.is_cancelled = is_cancelled
+        self.poll_interval = poll_interval
+        self.finished = False
+        self._cancelled = threading.Event()
+        self._last_poll = 0.0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def finish(self):
+        self.finished = True
+
+    def cancelled(self):
+        if self._cancelled.is_set():
+            return True
+        if self.is_cancelled is not None and time.monotonic() - self._last_poll >= self.poll_interval:
+            self._last_poll = time.monotonic()
+            try:
+                if self.is_cancelled():
+                    self._cancelled.set()
+            except Exception as e:
+                print(f"Error checking cancellation of run '{self.run_id}': {e}")
+        return self._cancelled.is_set()
+
+    def step_deadline(self, seconds=None):
+        """
+        Deadline for a step starting now, never later than the run's deadline.
+        """
+        if seconds is None:
+            return self.deadline
+        deadline = time.monotonic() + seconds
+        return deadline if self.deadline is None else min(deadline, self.deadline)
+
+    def remaining(self, deadline=None):
+        """
+        Seconds left until deadline (or the run's deadline), None if there is none.
+        """
+        deadlines = [d for d in (deadline, self.deadline) if d is not None]
+        if not deadlines:
+            return None
+        return min(deadlines) - time.monotonic()
+
+    def check(self, deadline=None):
+        """
+        Raises RunCancelled, RunTimeout or StepTimeout if the run or step has to stop.
+        """
+        if self.cancelled():
+            raise RunCancelled(f"run '{self.run_id}' was cancelled")
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            raise RunTimeout(f"run '{self.run_id}' passed its deadline")
+        if deadline is not None and now >= deadline:
+            raise StepTimeout("step deadline passed")
+
+
+_RUNS = {}
+_RUNS_LOCK = threading.Lock()
+
+
+def register_run(run_id, deadline_seconds=None, is_cancelled=None):
+    """
+    Creates the RunControl of a run, cancel_run(run_id) reaches it until unregister_run.
+    """
+    control = RunControl(run_id, deadline_seconds, is_cancelled)
+    if run_id is not None:
+        with _RUNS_LOCK:
+            _RUNS[run_id] = control
+    return control
+
+
+def unregister_run(run_id):
+    with _RUNS_LOCK:
+        _RUNS.pop(run_id, None)
+
+
+def cancel_run(run_id):
+    """
+    Cancels a run in flight in this process. Returns False if there is no such run.
+    """
+    with _RUNS_LOCK:
+        control = _RUNS.get(run_id)
+    if control is None:
+        return False
+    control.cancel()
+    return True
+
+
+# Exception class names (anywhere in the MRO) of transient errors: timeouts, dropped connections,
+# rate limits and overloaded servers, from httpx (Ollama) and google.api_core (Gemini)
+TRANSIENT_ERROR_NAMES = {
+    "TimeoutError", "ConnectionError", "TimeoutException", "NetworkError", "RemoteProtocolError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError", "TooManyRequests",
+}
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient_error(error):
+    if isinstance(error, (RunAborted, StepTimeout)):
+        return False
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    # httpx.HTTPStatusError has the response, google.api_core errors the code
+    status = getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "code", None)
+    return status in TRANSIENT_STATUS_CODES
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time between 0 and
+    min(max_delay, base_delay * 2**n). Only transient errors are retried.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=20.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def call_with_deadline(fn, control, deadline=None, poll_interval=0.25, executor=None):
+    """
+    Runs fn() on the LLM call pool (or executor) and waits for it, checking the cancel flag and
+    deadlines every poll_interval seconds. A blocking call can't be interrupted, when the run or
+    step has to stop the call is abandoned and ends with the client's own request timeout.
+    """
+    future = (executor or _CALL_POOL).submit(contextvars.copy_context().run, fn)
+    try:
+        while not wait([future], timeout=poll_interval).done:
+            control.check(deadline)
+    except BaseException:
+        # a call that hasn't started yet never runs
+        future.cancel()
+        raise
+    return future.result()
+
+
+def call_with_retry(fn, control, deadline=None, policy=None, on_retry=None, executor=None):
+    """
+    Calls fn() under the run's deadline and cancel flag, retrying transient errors with backoff.
+    on_retry(error, attempt) is called before each retry.
+    """
+    policy = policy or RetryPolicy()
+    for attempt in range(policy.max_attempts):
+        control.check(deadline)
+        try:
+            return call_with_deadline(fn, control, deadline, executor=executor)
+        except Exception as e:
+            if not is_transient_error(e) or attempt + 1 >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt)
+            remaining = control.remaining(deadline)
+            if remaining is not None and delay >= remaining:
+                raise
+            if on_retry is not None:
+                on_retry(e, attempt)
+            # the backoff sleep wakes up for a cancel as well
+            end = time.monotonic() + delay
+            while time.monotonic() < end:
+                control.check(deadline)
+                time.sleep(min(0.25, max(0.0, end - time.monotonic())))
+
+
+async def acall_with_deadline(coro_fn, control, deadline=None, poll_interval=0.25):
+    """
+    Async version of call_with_deadline. Here the call really is cancelled, the task is.
+    """
+    task = asyncio.ensure_future(coro_fn())
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            control.check(deadline)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def acall_with_retry(coro_fn, control, deadline=None, policy=None, on_retry=None):
+    """
+    Async version of call_with_retry.
+    """
+    policy = policy or RetryPolicy()
+    for attempt in range(policy.max_attempts):
+        control.check(deadline)
+        try:
+            return await acall_with_deadline(coro_fn, control, deadline)
+        except Exception as e:
+            if not is_transient_error(e) or attempt + 1 >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt)
+            remaining = control.remaining(deadline)
+            if remaining is not None and delay >= remaining:
+                raise
+            if on_retry is not None:
+                on_retry(e, attempt)
+            end = time.monotonic() + delay
+            while time.monotonic() < end:
+                control.check(deadline)
+                await asyncio.sleep(min(0.25, max(0.0, end - time.monotonic())))
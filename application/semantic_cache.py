@@ -0,0 +1,131 @@
+# File: semantic_cache.py
+# Description: semantic cache of answered questions
+#  near identical cleaned questions reuse the stored SQL and step outputs
+#  only when their literals (numbers, dates, quoted values) are the same
+#  uses chromadb and the same embedding model as the RAG collections
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import hashlib
+import json
+import re
+from datetime import datetime
+from injest import get_chroma_client, get_embed_model, QUESTION_CACHE_COLLECTION_NAME
+
+SIMILARITY_THRESHOLD = 0.95
+# Closest stored questions checked for matching literals on a lookup
+LOOKUP_CANDIDATES = 3
+
+# "top 5 customers in 2023" and "top 10 customers in 2024" embed almost the same, the literals
+# tell them apart: quoted values, dates, numbers, and month / number words
+QUOTED_LITERAL = re.compile(r"(?<!\w)'([^']*)'(?!\w)|\"([^\"]*)\"")
+DATE_LITERAL = re.compile(r"\b\d{4}-\d{1,2}(?:-\d{1,2})?\b|\b\d{1,2}/\d{1,2}/\d{2,4}\b")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:[.,]\d+)*\b")
+WORD_LITERALS = {
+    "january", "february", "march", "april", "may", "june", "july", "august", "september", "october", "november", "december",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve",
+    "twenty", "fifty", "hundred", "thousand", "million", "first", "second", "third", "last", "q1", "q2", "q3", "q4",
+}
+
+
+def extract_literals(question):
+    """
+    The literals of a question as a sorted list, two questions are only the same question when
+    these match.
+    """
+    literals = [next(group for group in match.groups() if group is not None).strip().lower() for match in QUOTED_LITERAL.finditer(question)]
+    rest = QUOTED_LITERAL.sub(" ", question)
+    literals += DATE_LITERAL.findall(rest)
+    rest = DATE_LITERAL.sub(" ", rest)
+    literals += [number.replace(",", "") for number in NUMBER_LITERAL.findall(rest)]
+    literals += [word for word in re.findall(r"[a-z0-9]+", rest.lower()) if word in WORD_LITERALS]
+    return sorted(literals)
+
+
+class SemanticQuestionCache:
+    """
+    Stores (cleaned question, final SQL, intermediate step json) records in a dedicated Chroma
+    collection. A lookup above the similarity threshold whose literals (extract_literals) match
+    returns the stored answer so the pipeline can skip retrieval and every step after the
+    question cleaning.
+
+    Records are tagged with a signature (prompt versions + models) and only matched against
+    records with the same signature, so changing prompts or models does not serve stale answers.
+    """
+
+    def __init__(self, collection_name=QUESTION_CACHE_COLLECTION_NAME, threshold=SIMILARITY_THRESHOLD):
+        self.collection_name = collection_name
+        self.threshold = threshold
+
+    def _collection(self):
+        # cosine space so 1 - distance is the similarity
+        return get_chroma_client().get_or_create_collection(self.collection_name, metadata={"hnsw:space": "cosine"})
+
+    def _embed(self, question):
+        # questions are compared with questions, so both sides use the query embedding
+        return get_embed_model().get_query_embedding(question)
+
+    def lookup(self, cleaned_question, signature):
+        """
+        Returns {"question", "sql", "steps", "similarity"} for the closest stored question,
+        or None when nothing is above the threshold.
+        """
+        try:
+            collection = self._collection()
+            if collection.count() == 0:
+                return None
+
+            results = collection.query(
+                query_embeddings=[self._embed(cleaned_question)],
+                n_results=LOOKUP_CANDIDATES,
+                where={"signature": signature},
+                include=["documents", "metadatas", "distances"],
+            )
+            if not results["ids"] or not results["ids"][0]:
+                return None
+
+            literals = extract_literals(cleaned_question)
+            for document, metadata, distance in zip(results["documents"][0], results["metadatas"][0], results["distances"][0]):
+                similarity = 1.0 - distance
+                if similarity < self.threshold:
+                    print(f"Question cache miss (closest similarity {similarity:.4f})")
+                    return None
+                if extract_literals(document) != literals:
+                    print(f"Question cache skip, literals differ (similarity {similarity:.4f}): '{document}'")
+                    continue
+                print(f"Question cache hit (similarity {similarity:.4f}): '{document}'")
+                return {
+                    "question": document,
+                    "sql": metadata["sql"],
+                    "steps": json.loads(metadata["steps"]),
+                    "similarity": similarity,
+                }
+            return None
+        except Exception as e:
+            print(f"Error reading question cache: {e}")
+            return None
+
+    def store(self, cleaned_question, signature, sql, steps):
+        """
+        Saves the answer for a cleaned question. steps is step name -> step json.
+        """
+        try:
+            record_id = hashlib.sha256(f"{signature}\x00{cleaned_question}".encode("utf-8")).hexdigest()
+            self._collection().upsert(
+                ids=[record_id],
+                embeddings=[self._embed(cleaned_question)],
+                documents=[cleaned_question],
+                metadatas=[{
+                    "signature": signature,
+                    "sql": sql,
+                    "steps": json.dumps(steps),
+                    "created_at": datetime.now().isoformat(),
+                }],
+            )
+        except Exception as e:
+            print(f"Error writing question cache: {e}")
@@ -0,0 +1,179 @@
+# File: step_schemas.py
+# Description: typed output schemas for the thinking steps (3-7)
+#  used for constrained decoding (Ollama format, Gemini response_schema) and to validate
+#  the step json, with the alternate keys the models like to use accepted as aliases
+#  each step's main keys are required, so json without them gets the repair pass
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#
+#
+#
+import json
+from typing import Any, List
+from pydantic import BaseModel, ConfigDict, Field, AliasChoices, ValidationError
+
+
+class StepOutput(BaseModel):
+    # keys the prompts don't ask for are kept, the later steps get the whole json
+    model_config = ConfigDict(extra="allow")
+
+    reasoning: str = Field(default="", validation_alias=AliasChoices("reasoning", "reason"))
+
+
+class TablesOutput(StepOutput):
+    tables: List[str] = Field(validation_alias=AliasChoices("tables", "table"))
+    columns: List[str] = Field(default_factory=list, validation_alias=AliasChoices("columns", "column"))
+
+
+class Join(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    join_type: str = "INNER"
+    left_on: str = ""
+    right_on: str = ""
+
+
+class JoinsOutput(StepOutput):
+    joins: List[Join] = Field(validation_alias=AliasChoices("joins", "join"))
+
+
+class Aggregation(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    function: str = ""
+    column: str = ""
+    alias: str = ""
+
+
+class ComplexAggregation(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    expression: str = ""
+    alias: str = ""
+
+
+class GroupingOutput(StepOutput):
+    group_by_columns: List[str] = Field(validation_alias=AliasChoices("group_by_columns", "group_by"))
+    aggregations: List[Aggregation] = Field(validation_alias=AliasChoices("aggregations", "aggregation"))
+    complex_aggregations: List[ComplexAggregation] = Field(default_factory=list, validation_alias=AliasChoices("complex_aggregations", "complex_aggregation"))
+
+
+class Calculation(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    alias: str = ""
+    formula: str = ""
+
+
+class CalculationsOutput(StepOutput):
+    calculations: List[Calculation] = Field(validation_alias=AliasChoices("calculations", "calculation"))
+
+
+class Filter(BaseModel):
+    # the filtering prompt shows both shapes: column/operator/value and clause_type/condition
+    model_config = ConfigDict(extra="allow")
+
+    clause_type: str = ""
+    column: str = ""
+    operator: str = ""
+    value: Any = ""
+    condition: str = ""
+
+
+class FilteringOutput(StepOutput):
+    filters: List[Filter] = Field(validation_alias=AliasChoices("filters", "filtering"))
+
+
+STEP_OUTPUT_SCHEMAS = {
+    'tables': TablesOutput,
+    'joins': JoinsOutput,
+    'grouping': GroupingOutput,
+    'calculations': CalculationsOutput,
+    'filtering': FilteringOutput,
+}
+
+
+def parse_step_output(response, output_cls):
+    """
+    Returns (output, None) for a valid response, or (None, error message).
+    """
+    if not response:
+        return None, "empty response"
+    try:
+        data = json.loads(response)
+        # a bare string filter, e.g. "orders.status = 'delivered'", is still a filter
+        if output_cls is FilteringOutput and isinstance(data, dict):
+            filters = data.get("filters", data.get("filtering"))
+            if isinstance(filters, list):
+                data["filters"] = [{"condition": f} if isinstance(f, str) else f for f in filters]
+                data.pop("filtering", None)
+        return output_cls.model_validate(data), None
+    except (json.JSONDecodeError, ValidationError) as e:
+        return None, str(e)
+
+
+def empty_step_output(output_cls):
+    """
+    The output of a step whose json could not be repaired: every required list empty.
+    """
+    return output_cls.model_construct(**{name: [] for name, field in output_cls.model_fields.items() if field.is_required()})
+
+
+def parse_with_repair(response, output_cls, repair, step=""):
+    """
+    Validates response against output_cls. Invalid output gets exactly one repair(response, error)
+    call, which returns a new response. Returns the output, or empty_step_output(output_cls) if
+    the repaired response is invalid as well.
+    """
+    output, error = parse_step_output(response, output_cls)
+    if error is None:
+        return output
+    print(f"Step '{step}' output did not match its schema ({error}), repairing")
+    output, error = parse_step_output(repair(response, error), output_cls)
+    if error is None:
+        return output
+    print(f"Step '{step}' output could not be repaired: {error}")
+    return empty_step_output(output_cls)
+
+
+async def aparse_with_repair(response, output_cls, repair, step=""):
+    """
+    Async version of parse_with_repair, repair is a coroutine function.
+    """
+    output, error = parse_step_output(response, output_cls)
+    if error is None:
+        return output
+    print(f"Step '{step}' output did not match its schema ({error}), repairing")
+    output, error = parse_step_output(await repair(response, error), output_cls)
+    if error is None:
+        return output
+    print(f"Step '{step}' output could not be repaired: {error}")
+    return empty_step_output(output_cls)
+
+
+def gemini_response_schema(output_cls):
+    """
+    The output schema in the OpenAPI subset Gemini's response_schema accepts: refs inlined,
+    only type/properties/items/required/description kept. required is kept on every object, so
+    constrained decoding has to emit the step's main keys.
+    """
+    schema = output_cls.model_json_schema()
+    definitions = schema.get("$defs", {})
+
+    def convert(node):
+        if "$ref" in node:
+            return convert(definitions[node["$ref"].split("/")[-1]])
+        converted = {"type": node.get("type", "string").upper()}
+        if "description" in node:
+            converted["description"] = node["description"]
+        if "properties" in node:
+            converted["properties"] = {name: convert(value) for name, value in node["properties"].items()}
+            if node.get("required"):
+                converted["required"] = node["required"]
+        if "items" in node:
+            converted["items"] = convert(node["items"])
+        return converted
+
+    return convert(schema)
@@ -0,0 +1,10 @@
+# File: tests/conftest.py
+# Description: the application modules import each other by module name, so the application
+#  directory goes on sys.path for the tests
+#
+# Usage: python -m pytest -q tests   (from the application directory)
+#
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
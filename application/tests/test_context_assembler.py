@@ -0,0 +1,87 @@
+import pytest
+
+pytest.importorskip("llama_index.core")
+
+from context_assembler import SchemaContextAssembler, SchemaContextSlicer
+
+
+class FakeNode:
+    def __init__(self, text, metadata, node_id="n"):
+        self.text = text
+        self.metadata = metadata
+        self.node = type("Inner", (), {"node_id": node_id})()
+
+
+def ddl(table, columns):
+    return FakeNode(f"Database: shop\nTable: {table}\nDDL: CREATE TABLE {table} ({columns})",
+                    {"type": "ddl", "database_name": "shop", "table_name": table})
+
+
+def metadata(table, column_lines):
+    text = f"Database: shop\nTable: {table}\nColumns:\n" + "\n".join(f"  {line}" for line in column_lines) + "\n"
+    return FakeNode(text, {"type": "table_metadata", "database_name": "shop", "table_name": table})
+
+
+def test_merges_nodes_of_a_table():
+    nodes = [
+        ddl("orders", "id INT, total REAL"),
+        metadata("orders", ["id (INT)", "total (REAL): order total incl. tax"]),
+        ddl("orders", "id INT, total REAL"),
+    ]
+    context, stats = SchemaContextAssembler().assemble(nodes)
+    assert context.count("Table: orders") == 1
+    assert context.count("CREATE TABLE orders") == 1
+    # the bare column line repeats the DDL, the description is kept
+    assert "id (INT)" not in context
+    assert "total (REAL): order total incl. tax" in context
+    assert (stats["nodes"], stats["tables"]) == (3, 1)
+    assert stats["tokens_after"] < stats["tokens_before"]
+
+
+def test_drops_whole_tables_over_budget():
+    nodes = [ddl("orders", "x " * 100), ddl("customers", "y " * 100), ddl("items", "z")]
+    context, stats = SchemaContextAssembler(token_budget=80).assemble(nodes)
+    assert "Table: orders" in context
+    assert "Table: customers" not in context
+    assert "Table: items" in context
+    assert stats["dropped_tables"] == ["shop.customers"]
+    assert stats["tokens_after"] <= 80
+
+
+def test_most_relevant_table_is_cut_to_budget():
+    context, stats = SchemaContextAssembler(token_budget=10).assemble([ddl("orders", "x " * 100)])
+    assert context.startswith("Database: shop\nTable: orders")
+    assert stats["tokens_after"] <= 10
+
+
+def schema_context():
+    nodes = [
+        metadata("orders", ["id (INT)", "customer_id (INT)", "total (REAL)"]),
+        metadata("customers", ["id (INT)", "name (TEXT)"]),
+        metadata("items", ["id (INT)"]),
+    ]
+    return SchemaContextAssembler().assemble(nodes)[0]
+
+
+def test_slice_keeps_selected_tables():
+    tables_info = {"tables": ["shop.customers", "`orders`"], "columns": ["orders.total"]}
+    context, stats = SchemaContextSlicer().slice(schema_context(), tables_info, "joins")
+    assert context.index("Table: orders") < context.index("Table: customers")
+    assert "Table: items" not in context
+    assert "customer_id (INT)" in context
+    assert stats["tables"] == 2
+    assert stats["tokens_sliced"] < stats["tokens_full"]
+
+
+def test_slice_prunes_columns_for_column_steps():
+    tables_info = {"tables": ["orders"], "columns": ["orders.total"]}
+    context, _ = SchemaContextSlicer().slice(schema_context(), tables_info, "filtering")
+    assert "total (REAL)" in context
+    assert "customer_id (INT)" not in context
+
+
+def test_slice_falls_back_to_full_context():
+    full = schema_context()
+    context, stats = SchemaContextSlicer().slice(full, {"tables": ["unknown"]}, "joins")
+    assert context == full
+    assert stats["tables"] is None
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+import pytest
+
+from dag import run_dag, arun_dag, BackendLimits, validate_dag
+
+
+def test_dependencies_see_results():
+    steps = {
+        "a": {"deps": [], "fn": lambda results: 1},
+        "b": {"deps": ["a"], "fn": lambda results: results["a"] + 1},
+        "c": {"deps": ["a", "b"], "fn": lambda results: results["a"] + results["b"]},
+    }
+    assert run_dag(steps) == {"a": 1, "b": 2, "c": 3}
+
+
+def test_cycle_is_rejected():
+    with pytest.raises(ValueError):
+        validate_dag({"a": {"deps": ["b"]}, "b": {"deps": ["a"]}})
+
+
+def test_backend_limit_holds_across_runs():
+    limits = BackendLimits({"ollama": 1})
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+
+    def call(results):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+
+    def run():
+        steps = {name: {"deps": [], "fn": call, "backend": "ollama"} for name in ("a", "b")}
+        run_dag(steps, max_workers=2, backend_limits=limits)
+
+    runs = [threading.Thread(target=run) for _ in range(3)]
+    for thread in runs:
+        thread.start()
+    for thread in runs:
+        thread.join()
+    assert peak[0] == 1
+
+
+def test_async_backend_limit_holds_across_runs():
+    limits = BackendLimits({"gemini": 2})
+    active = [0]
+    peak = [0]
+
+    async def call(results):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.02)
+        active[0] -= 1
+
+    async def main():
+        steps = lambda: {name: {"deps": [], "fn": call, "backend": "gemini"} for name in ("a", "b", "c")}
+        await asyncio.gather(*(arun_dag(steps(), backend_limits=limits) for _ in range(3)))
+
+    asyncio.run(main())
+    assert peak[0] == 2
+    # a new event loop gets its own semaphores
+    asyncio.run(main())
+    assert peak[0] == 2
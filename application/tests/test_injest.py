@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.core")
+
+import injest
+
+
+def parse_range(start, count):
+    return list(range(start, start + count))
+
+
+def test_iter_parsed_yields_everything():
+    tasks = [(str(i), parse_range, (i * 10, 10)) for i in range(6)]
+    assert sorted(injest.iter_parsed(tasks, max_workers=2, queue_size=4)) == list(range(60))
+
+
+def test_iter_parsed_stops_when_the_consumer_does():
+    tasks = [(str(i), parse_range, (i * 100, 100)) for i in range(20)]
+    nodes = injest.iter_parsed(tasks, max_workers=2, queue_size=4)
+    assert next(nodes) is not None
+    # the producer is blocked on the full queue, closing the generator has to release it
+    nodes.close()
+    assert not any(t.name == "ingest_parser" for t in threading.enumerate())
+
+
+def parse_broken(source_id):
+    raise ValueError(f"can't parse {source_id}")
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_iter_parsed_reports_failed_sources(max_workers):
+    tasks = [("a", parse_range, (0, 3)), ("b", parse_broken, ("b",)), ("c", parse_range, (3, 2))]
+    failed = set()
+    nodes = list(injest.iter_parsed(tasks, max_workers=max_workers, failed_sources=failed))
+    assert sorted(nodes) == [0, 1, 2, 3, 4]
+    assert failed == {"b"}
+
+
+class FakeNode:
+    def __init__(self, id_, content_hash, source_id):
+        self.id_ = id_
+        self.metadata = {"content_hash": content_hash, "source_id": source_id}
+
+
+class FakeCollection:
+    def __init__(self, records):
+        # node id -> metadata
+        self.records = records
+        self.deleted = []
+
+    def get(self, include):
+        return {"ids": list(self.records), "metadatas": list(self.records.values())}
+
+    def delete(self, ids):
+        self.deleted.extend(ids)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection({
+        "t1": {"content_hash": "h1", "source_id": "db/t1.json"},
+        "t2": {"content_hash": "h2", "source_id": "db/t2.json"},
+        "t3": {"content_hash": "h3", "source_id": "db/t3.json"},
+    })
+    upserted = []
+
+    class FakeClient:
+        def get_or_create_collection(self, name):
+            return collection
+
+    monkeypatch.setattr(injest, "get_chroma_client", lambda: FakeClient())
+    monkeypatch.setattr(injest, "upsert_nodes", lambda c, nodes: upserted.extend(node.id_ for node in nodes))
+    collection.upserted = upserted
+    return collection
+
+
+def test_sync_only_writes_changes(collection):
+    nodes = [FakeNode("t1", "h1", "db/t1.json"), FakeNode("t2", "changed", "db/t2.json"),
+             FakeNode("t4", "h4", "db/t4.json")]
+    counts = injest.sync_collection("schema", nodes, batch_size=2)
+    assert collection.upserted == ["t2", "t4"]
+    assert collection.deleted == ["t3"]
+    assert (counts["upserted"], counts["deleted"], counts["unchanged"]) == (2, 1, 1)
+
+
+def test_sync_keeps_documents_of_files_that_failed_to_parse(collection):
+    nodes = [FakeNode("t1", "h1", "db/t1.json")]
+    counts = injest.sync_collection("schema", nodes, failed_sources={"db/t3.json"})
+    assert collection.deleted == ["t2"]
+    assert counts["deleted"] == 1
+
+
+def test_chroma_client_is_created_once(monkeypatch):
+    created = []
+
+    def slow_client(path):
+        created.append(path)
+        time.sleep(0.05)
+        return object()
+
+    monkeypatch.setattr(injest, "_CHROMA_CLIENT", None)
+    monkeypatch.setattr(injest.chromadb, "PersistentClient", slow_client, raising=False)
+    threads = [threading.Thread(target=injest.get_chroma_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+
+
+def test_cached_index_is_rebuilt_with_its_collection(monkeypatch):
+    collection_ids = {"schema": "id-1"}
+    built = []
+
+    def build(collection_name):
+        built.append(collection_name)
+        return f"index-{len(built)}"
+
+    monkeypatch.setattr(injest, "_INDEX_REGISTRY", {})
+    monkeypatch.setattr(injest, "get_embed_model_name", lambda: "embedder")
+    monkeypatch.setattr(injest, "get_collection_id", lambda name: collection_ids.get(name))
+    monkeypatch.setattr(injest, "get_vector_storage_index", build)
+
+    assert injest.get_cached_vector_storage_index("schema") == "index-1"
+    assert injest.get_cached_vector_storage_index("schema") == "index-1"
+    # dropped and created again by another process
+    collection_ids["schema"] = "id-2"
+    assert injest.get_cached_vector_storage_index("schema") == "index-2"
+    assert injest.get_cached_vector_storage_index("schema") == "index-2"
+    assert built == ["schema", "schema"]
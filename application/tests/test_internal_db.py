@@ -0,0 +1,32 @@
+import threading
+
+from internal_db import WriteBehindStatusWriter
+
+
+class FlakyStore:
+    def __init__(self):
+        self.batches = []
+        self.fail = True
+        self.written = threading.Event()
+
+    def update_many(self, batch):
+        if self.fail:
+            self.fail = False
+            raise TypeError("payload is not serializable")
+        self.batches.append(batch)
+        self.written.set()
+
+
+def test_writer_survives_a_failed_batch():
+    store = FlakyStore()
+    writer = WriteBehindStatusWriter(store, interval=0.01)
+    try:
+        writer.submit("run1", {"tables": object()})
+        # the failed batch is dropped, flush returns instead of waiting for it forever
+        assert writer.flush("run1", timeout=5)
+        writer.submit("run1", {"tables": "{}"})
+        assert store.written.wait(5)
+        assert writer.flush(timeout=5)
+        assert store.batches == [{"run1": {"tables": "{}"}}]
+    finally:
+        writer.stop()
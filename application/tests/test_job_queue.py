@@ -0,0 +1,96 @@
+import datetime
+import threading
+import pytest
+
+from job_queue import JobQueue, JOBS_TABLE_NAME
+from internal_db import create_db_and_table
+from run_control import RunCancelled, RunTimeout
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "status.db")
+    create_db_and_table(path)
+    return path
+
+
+def make_queue(db_path, runner=None, **kwargs):
+    return JobQueue(db_path=db_path, runner=runner or (lambda question, user_id, run_id, **params: "done"), **kwargs)
+
+
+def test_claim_respects_max_per_user(db_path):
+    queue = make_queue(db_path, max_per_user=1)
+    first = queue.submit("alice", "q1")
+    queue.submit("alice", "q2")
+    bob = queue.submit("bob", "q3")
+
+    assert queue.claim()["job_id"] == first
+    # alice is at her limit, bob's job is next
+    assert queue.claim()["job_id"] == bob
+    assert queue.claim() is None
+
+
+def test_job_status_follows_run_outcome(db_path):
+    outcomes = {"done": "done", "rejected": "rejected", "cancelled": RunCancelled("reset"),
+                "timeout": RunTimeout("deadline"), "failed": ValueError("boom")}
+
+    def runner(question, user_id, run_id, **params):
+        # the runner returns the status its run was finished with
+        if isinstance(outcomes[question], Exception):
+            raise outcomes[question]
+        return outcomes[question]
+
+    queue = make_queue(db_path, runner=runner, max_per_user=10)
+    for question in outcomes:
+        queue.submit("alice", question)
+    while (job := queue.claim()) is not None:
+        queue.run_job(job)
+        assert queue.get_job(job["job_id"])["status"] == job["question"]
+
+
+def test_expired_running_job_is_requeued_then_failed(db_path):
+    queue = make_queue(db_path, max_per_user=1, lease_seconds=60, max_attempts=2)
+    job_id = queue.submit("alice", "q1")
+    stale = (datetime.datetime.now() - datetime.timedelta(seconds=120)).isoformat()
+
+    def expire():
+        queue._connection().execute(f"UPDATE {JOBS_TABLE_NAME} SET heartbeat_at = ? WHERE job_id = ?", (stale, job_id))
+
+    assert queue.claim()["job_id"] == job_id
+    expire()
+    assert queue.recover_expired() == 1
+    assert queue.get_job(job_id)["status"] == "queued"
+
+    # the user's slot is free again
+    assert queue.claim()["job_id"] == job_id
+    expire()
+    queue.recover_expired()
+    assert queue.get_job(job_id)["status"] == "failed"
+
+
+def test_heartbeat_keeps_running_job(db_path):
+    queue = make_queue(db_path, lease_seconds=60)
+    job_id = queue.submit("alice", "q1")
+    queue.claim()
+    stale = (datetime.datetime.now() - datetime.timedelta(seconds=120)).isoformat()
+    queue._connection().execute(f"UPDATE {JOBS_TABLE_NAME} SET heartbeat_at = ? WHERE job_id = ?", (stale, job_id))
+    queue._running.add(job_id)
+    queue.heartbeat()
+    assert queue.recover_expired() == 0
+    assert queue.get_job(job_id)["status"] == "running"
+
+
+def test_workers_run_jobs(db_path):
+    done = threading.Event()
+
+    def runner(question, user_id, run_id, **params):
+        done.set()
+
+    queue = make_queue(db_path, runner=runner, num_workers=1, poll_interval=0.05)
+    queue.start()
+    try:
+        job_id = queue.submit("alice", "q1")
+        assert done.wait(5)
+    finally:
+        queue.stop()
+    assert queue.get_job(job_id)["status"] == "done"
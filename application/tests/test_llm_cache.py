@@ -0,0 +1,56 @@
+import time
+
+from llm_cache import LLMResponseCache
+
+
+def make_cache(tmp_path, **kwargs):
+    return LLMResponseCache(db_path=str(tmp_path / "llm_cache.db"), **kwargs)
+
+
+def test_hit_and_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("llama3", False, "prompt") is None
+    cache.put("llama3", False, "prompt", "answer")
+    assert cache.get("llama3", False, "prompt") == "answer"
+    # the model and json mode are part of the key
+    assert cache.get("llama3", True, "prompt") is None
+    assert cache.get("gemini", False, "prompt") is None
+    metrics = cache.metrics()
+    assert (metrics["hits"], metrics["misses"], metrics["entries"]) == (1, 3, 1)
+
+
+def test_expired_entries_are_removed_on_read(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    cache.put("llama3", False, "prompt", "answer")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("llama3", False, "prompt") is None
+    metrics = cache.metrics()
+    assert (metrics["expired"], metrics["entries"]) == (1, 0)
+
+
+def test_purge_expired(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    cache.put("llama3", False, "old", "answer")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    cache.put("llama3", False, "new", "answer")
+    assert cache.purge_expired() == 1
+    assert cache.get("llama3", False, "new") == "answer"
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, max_entries=2)
+    clock = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    for prompt in ("a", "b"):
+        cache.put("llama3", False, prompt, prompt.upper())
+        clock[0] += 1
+    # reading "a" makes "b" the least recently used one
+    assert cache.get("llama3", False, "a") == "A"
+    clock[0] += 1
+    cache.put("llama3", False, "c", "C")
+    assert cache.get("llama3", False, "b") is None
+    assert cache.get("llama3", False, "a") == "A"
+    assert cache.get("llama3", False, "c") == "C"
+    assert cache.metrics()["evictions"] == 1
@@ -0,0 +1,22 @@
+import pytest
+
+from llm_pool import LLMClientPool
+
+
+def test_client_is_built_once_and_calls_are_tracked_under_its_key():
+    observed = []
+    pool = LLMClientPool(on_call=lambda key, seconds, ok: observed.append((key, ok)))
+    key = ("gemini", "flash", "TablesOutput")
+    client = pool.get(key, object)
+    assert pool.get(key, object) is client
+
+    with pool.track(key):
+        pass
+    with pytest.raises(RuntimeError):
+        with pool.track(key):
+            raise RuntimeError("quota")
+
+    stats = pool.stats()[key]
+    assert stats["created"] == 1 and stats["reused"] == 1
+    assert stats["calls"] == 2 and stats["errors"] == 1 and stats["pooled"]
+    assert observed == [(key, True), (key, False)]
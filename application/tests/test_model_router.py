@@ -0,0 +1,60 @@
+import pytest
+
+from model_router import ModelRouter, routed_step
+
+LOCAL = {"backend": "ollama", "model": "phi4", "tier": 0, "max_latency": 10}
+FLASH = {"backend": "gemini", "model": "flash", "tier": 1}
+FLASH_LITE = {"backend": "gemini", "model": "flash-lite", "tier": 1}
+
+
+def names(candidates):
+    return [candidate["model"] for candidate in candidates]
+
+
+def test_tier_is_required():
+    with pytest.raises(ValueError):
+        ModelRouter({"tables": [LOCAL, {"backend": "gemini", "model": "flash"}]})
+
+
+def test_lower_tier_first():
+    router = ModelRouter({"tables": [FLASH, LOCAL]})
+    assert names(router.candidates("tables")) == ["phi4", "flash"]
+
+
+def test_faster_candidate_first_within_a_tier():
+    router = ModelRouter({"tables": [FLASH, FLASH_LITE]})
+    router.observe("gemini", "flash", 3.0, step="tables")
+    router.observe("gemini", "flash-lite", 1.0, step="tables")
+    assert names(router.candidates("tables")) == ["flash-lite", "flash"]
+
+
+def test_unhealthy_candidate_moves_back_until_cooldown():
+    router = ModelRouter({"tables": [LOCAL, FLASH]}, cooldown=3600)
+    for _ in range(3):
+        router.observe("ollama", "phi4", 1.0, ok=False)
+    assert names(router.candidates("tables")) == ["flash", "phi4"]
+
+    router.cooldown = 0
+    assert names(router.candidates("tables")) == ["phi4", "flash"]
+
+
+def test_slow_candidate_is_unhealthy():
+    router = ModelRouter({"tables": [LOCAL, FLASH]}, cooldown=3600)
+    router.observe("ollama", "phi4", 30.0, step="tables")
+    assert names(router.candidates("tables")) == ["flash", "phi4"]
+
+
+def test_latency_is_judged_per_step():
+    router = ModelRouter({"tables": [LOCAL, FLASH], "generation": [LOCAL, FLASH]}, cooldown=3600)
+    # slow generation calls don't demote the model for the short steps
+    with routed_step("generation"):
+        router.observe("ollama", "phi4", 30.0)
+    router.observe("ollama", "phi4", 2.0, step="tables")
+    assert names(router.candidates("tables")) == ["phi4", "flash"]
+    assert router.expected_latency(LOCAL, "generation") == 30.0
+    assert router.expected_latency(LOCAL, "tables") == 2.0
+
+
+def test_preferred_backend_first():
+    router = ModelRouter({"tables": [LOCAL, FLASH]})
+    assert names(router.candidates("tables", prefer_backend="gemini")) == ["flash", "phi4"]
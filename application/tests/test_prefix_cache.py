@@ -0,0 +1,88 @@
+import sys
+import threading
+import types
+import pytest
+
+from prefix_cache import GeminiPrefixCache, SharedPrefixPrompt
+
+LONG_PREFIX = "schema " * 4000
+
+
+@pytest.fixture
+def fake_genai(monkeypatch):
+    """
+    Stand-in google.generativeai: create() blocks for prefixes containing 'slow' until released.
+    """
+    state = {"creates": [], "release": threading.Event()}
+
+    class CachedContent:
+        @staticmethod
+        def create(model, contents, ttl):
+            state["creates"].append(contents[0][:20])
+            if "slow" in contents[0]:
+                assert state["release"].wait(5)
+            return object()
+
+    class GenerativeModel:
+        @staticmethod
+        def from_cached_content(cached_content, generation_config=None):
+            return ("model", cached_content, generation_config)
+
+    genai = types.ModuleType("google.generativeai")
+    genai.GenerativeModel = GenerativeModel
+    genai.GenerationConfig = lambda **kwargs: kwargs
+    genai.caching = types.SimpleNamespace(CachedContent=CachedContent)
+    google = types.ModuleType("google")
+    google.generativeai = genai
+    monkeypatch.setitem(sys.modules, "google", google)
+    monkeypatch.setitem(sys.modules, "google.generativeai", genai)
+    monkeypatch.setitem(sys.modules, "google.generativeai.caching", genai.caching)
+    return state
+
+
+def test_shared_prefix_prompt_is_the_full_prompt():
+    prompt = SharedPrefixPrompt("prefix ", "suffix")
+    assert prompt == "prefix suffix" and prompt.prefix == "prefix " and prompt.suffix == "suffix"
+
+
+def test_small_prefix_is_not_cached(fake_genai):
+    cache = GeminiPrefixCache(min_tokens=2048)
+    assert cache.get_model("gemini", "short") is None
+    assert cache.metrics()["skipped"] == 1 and fake_genai["creates"] == []
+
+
+def test_concurrent_callers_create_once(fake_genai):
+    cache = GeminiPrefixCache(min_tokens=10)
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(cache.get_model("gemini", LONG_PREFIX))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fake_genai["creates"]) == 1
+    assert len({id(model) for model in models}) == 1
+    assert cache.metrics()["created"] == 1 and cache.metrics()["reused"] == 7
+
+
+def test_slow_create_does_not_block_other_prefixes(fake_genai):
+    cache = GeminiPrefixCache(min_tokens=10)
+    slow = threading.Thread(target=cache.get_model, args=("gemini", "slow " + LONG_PREFIX))
+    slow.start()
+    try:
+        other = threading.Thread(target=cache.get_model, args=("gemini", "fast " + LONG_PREFIX))
+        other.start()
+        other.join(2)
+        assert not other.is_alive()
+    finally:
+        fake_genai["release"].set()
+        slow.join()
+    assert cache.metrics()["created"] == 2
+
+
+def test_models_are_cached_per_output_schema(fake_genai):
+    cache = GeminiPrefixCache(min_tokens=10)
+    plain = cache.get_model("gemini", LONG_PREFIX)
+    typed = cache.get_model("gemini", LONG_PREFIX, json_mode=True, response_schema={"type": "OBJECT"}, schema_name="TablesOutput")
+    assert plain is not typed
+    assert typed[2] == {"response_mime_type": "application/json", "response_schema": {"type": "OBJECT"}}
+    assert cache.get_model("gemini", LONG_PREFIX, json_mode=True, response_schema={"type": "OBJECT"}, schema_name="TablesOutput") is typed
@@ -0,0 +1,40 @@
+import progress_bus
+from progress_bus import ProgressBus
+
+
+def test_subscription_gets_only_changes():
+    bus = ProgressBus()
+    subscription = bus.subscribe("run")
+    bus.publish("run", {"tables": "a"})
+    assert subscription.poll() == ({"tables": "a"}, False)
+    bus.publish("run", {"joins": "b"})
+    assert subscription.poll() == ({"joins": "b"}, False)
+
+
+def test_finished_run_is_evicted_after_retention(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(progress_bus.time, "monotonic", lambda: now[0])
+    bus = ProgressBus(retention_seconds=60)
+    bus.publish("run", {"sql": "SELECT 1"})
+    bus.finish("run")
+
+    now[0] += 30
+    assert bus.has_run("run")
+    assert bus.snapshot("run") == {"sql": "SELECT 1"}
+
+    now[0] += 31
+    assert not bus.has_run("run")
+
+
+def test_publish_after_finish_is_dropped():
+    bus = ProgressBus(retention_seconds=60)
+    bus.publish("run", {"sql": "SELECT 1"})
+    bus.finish("run")
+    bus.publish("run", {"sql_draft": "SELECT"})
+    assert bus.snapshot("run") == {"sql": "SELECT 1"}
+
+
+def test_unpublished_run_is_not_kept():
+    bus = ProgressBus(retention_seconds=0)
+    bus.finish("never_published")
+    assert not bus.has_run("never_published")
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+from run_control import (RunControl, RunCancelled, RunTimeout, StepTimeout, RetryPolicy, register_run, unregister_run,
+                         cancel_run, call_with_retry, acall_with_retry, is_transient_error)
+
+FAST = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.02)
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("reset by peer")
+        return "ok"
+
+    retries = []
+    assert call_with_retry(flaky, RunControl(), policy=FAST, on_retry=lambda e, attempt: retries.append(attempt)) == "ok"
+    assert len(calls) == 3 and retries == [0, 1]
+
+
+def test_retries_are_bounded():
+    calls = []
+
+    def down():
+        calls.append(1)
+        raise ConnectionError("refused")
+
+    with pytest.raises(ConnectionError):
+        call_with_retry(down, RunControl(), policy=FAST)
+    assert len(calls) == 3
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError):
+        call_with_retry(broken, RunControl(), policy=FAST)
+    assert len(calls) == 1
+
+
+def test_status_codes_decide_transient():
+    class StatusError(Exception):
+        def __init__(self, code):
+            self.code = code
+
+    assert is_transient_error(StatusError(429))
+    assert is_transient_error(StatusError(503))
+    assert not is_transient_error(StatusError(400))
+    assert not is_transient_error(StepTimeout())
+
+
+def test_step_deadline_stops_a_hung_call():
+    control = RunControl("run", deadline_seconds=10)
+    start = time.monotonic()
+    with pytest.raises(StepTimeout):
+        call_with_retry(lambda: time.sleep(2), control, control.step_deadline(0.3))
+    assert time.monotonic() - start < 1.5
+
+
+def test_run_deadline_ends_the_run():
+    control = RunControl("run", deadline_seconds=0.3)
+    with pytest.raises(RunTimeout):
+        call_with_retry(lambda: time.sleep(2), control, control.step_deadline(5))
+
+
+def test_cancel_run_stops_the_call():
+    control = register_run("cancel_me", deadline_seconds=10)
+    try:
+        threading.Timer(0.2, cancel_run, ["cancel_me"]).start()
+        with pytest.raises(RunCancelled):
+            call_with_retry(lambda: time.sleep(2), control)
+    finally:
+        unregister_run("cancel_me")
+    assert not cancel_run("cancel_me")
+
+
+def test_polled_cancel():
+    dismissed = threading.Event()
+    control = RunControl("run", is_cancelled=dismissed.is_set, poll_interval=0.05)
+    threading.Timer(0.2, dismissed.set).start()
+    with pytest.raises(RunCancelled):
+        call_with_retry(lambda: time.sleep(2), control)
+
+
+def test_queued_call_is_dropped_when_the_pool_is_busy():
+    executor = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    executor.submit(release.wait, 5)
+    ran = []
+    control = RunControl("run")
+    with pytest.raises(StepTimeout):
+        call_with_retry(lambda: ran.append(1), control, control.step_deadline(0.2), executor=executor)
+    release.set()
+    executor.shutdown(wait=True)
+    assert ran == []
+
+
+def test_finish_marks_the_run_over():
+    control = RunControl("run")
+    assert not control.finished
+    control.finish()
+    assert control.finished
+
+
+def test_async_cancel_cancels_the_task():
+    cancelled = []
+
+    async def hang():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        control = RunControl("run")
+        asyncio.get_running_loop().call_later(0.2, control.cancel)
+        with pytest.raises(RunCancelled):
+            await acall_with_retry(hang, control)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert cancelled == [1]
+
+
+def test_async_retry():
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 2:
+            raise TimeoutError()
+        return "ok"
+
+    assert asyncio.run(acall_with_retry(flaky, RunControl(), policy=FAST)) == "ok"
@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.core")
+
+from semantic_cache import SemanticQuestionCache, extract_literals
+
+
+def test_literals():
+    assert extract_literals("top 5 customers in 2023") == ["2023", "5"]
+    assert extract_literals("orders with status 'Delivered' since 2024-01-31") == ["2024-01-31", "delivered"]
+    assert extract_literals("sales in March vs five years ago") == ["five", "march"]
+    assert extract_literals("what's the customer's total") == []
+
+
+class FakeCollection:
+    def __init__(self, records):
+        # (document, sql, similarity), closest first
+        self.records = records
+
+    def count(self):
+        return len(self.records)
+
+    def query(self, query_embeddings, n_results, where, include):
+        records = self.records[:n_results]
+        return {
+            "ids": [[str(i) for i in range(len(records))]],
+            "documents": [[document for document, sql, similarity in records]],
+            "metadatas": [[{"sql": sql, "steps": "{}"} for document, sql, similarity in records]],
+            "distances": [[1.0 - similarity for document, sql, similarity in records]],
+        }
+
+
+class FakeCache(SemanticQuestionCache):
+    def __init__(self, records):
+        super().__init__()
+        self.collection = FakeCollection(records)
+
+    def _collection(self):
+        return self.collection
+
+    def _embed(self, question):
+        return [0.0]
+
+
+def test_different_literals_are_not_a_hit():
+    cache = FakeCache([("top 5 customers in 2023", "SELECT ... LIMIT 5", 0.98)])
+    assert cache.lookup("top 10 customers in 2024", "sig") is None
+
+
+def test_same_literals_are_a_hit():
+    cache = FakeCache([("top 5 customers in 2023", "SELECT ... LIMIT 5", 0.98)])
+    assert cache.lookup("the top 5 customers in 2023", "sig")["sql"] == "SELECT ... LIMIT 5"
+
+
+def test_next_candidate_with_matching_literals_is_used():
+    cache = FakeCache([
+        ("top 5 customers in 2023", "SELECT 2023", 0.99),
+        ("top 5 customers in 2024", "SELECT 2024", 0.97),
+    ])
+    assert cache.lookup("top 5 customers in 2024", "sig")["sql"] == "SELECT 2024"
+
+
+def test_below_threshold_is_a_miss():
+    cache = FakeCache([("top 5 customers in 2023", "SELECT 1", 0.90)])
+    assert cache.lookup("top 5 customers in 2023", "sig") is None
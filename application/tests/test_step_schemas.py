@@ -0,0 +1,79 @@
+import asyncio
+import json
+import pytest
+
+pytest.importorskip("pydantic")
+
+from step_schemas import (TablesOutput, FilteringOutput, GroupingOutput, parse_step_output, parse_with_repair,
+                          aparse_with_repair, empty_step_output, gemini_response_schema)
+
+
+def test_alternate_keys_are_accepted():
+    output, error = parse_step_output(json.dumps({"table": ["orders"], "column": ["orders.id"], "reason": "r"}), TablesOutput)
+    assert error is None
+    assert output.tables == ["orders"] and output.columns == ["orders.id"] and output.reasoning == "r"
+
+
+def test_missing_main_key_is_an_error():
+    output, error = parse_step_output(json.dumps({"foo": 1}), TablesOutput)
+    assert output is None and error
+
+
+def test_bare_string_filters_become_conditions():
+    output, error = parse_step_output(json.dumps({"filtering": ["orders.status = 'delivered'"]}), FilteringOutput)
+    assert error is None
+    assert output.filters[0].condition == "orders.status = 'delivered'"
+
+
+def test_missing_keys_trigger_exactly_one_repair():
+    calls = []
+
+    def repair(response, error):
+        calls.append((response, error))
+        return json.dumps({"tables": ["orders"]})
+
+    output = parse_with_repair(json.dumps({"foo": 1}), TablesOutput, repair, "tables")
+    assert len(calls) == 1
+    assert output.tables == ["orders"]
+
+
+def test_valid_response_is_not_repaired():
+    def repair(response, error):
+        raise AssertionError("repair must not run")
+
+    assert parse_with_repair(json.dumps({"tables": []}), TablesOutput, repair).tables == []
+
+
+def test_failed_repair_falls_back_to_empty_output():
+    calls = []
+
+    def repair(response, error):
+        calls.append(error)
+        return "not json"
+
+    output = parse_with_repair("", GroupingOutput, repair, "grouping")
+    assert len(calls) == 1
+    assert output.model_dump()["group_by_columns"] == [] and output.model_dump()["aggregations"] == []
+
+
+def test_async_repair_runs_once():
+    calls = []
+
+    async def repair(response, error):
+        calls.append(error)
+        return json.dumps({"bar": 2})
+
+    output = asyncio.run(aparse_with_repair(json.dumps({"foo": 1}), FilteringOutput, repair))
+    assert len(calls) == 1
+    assert output.model_dump()["filters"] == []
+
+
+def test_empty_step_output_dumps():
+    assert empty_step_output(TablesOutput).model_dump()["tables"] == []
+
+
+def test_gemini_schema_has_required_keys():
+    schema = gemini_response_schema(GroupingOutput)
+    assert set(schema["required"]) == {"group_by_columns", "aggregations"}
+    assert schema["properties"]["aggregations"]["type"] == "ARRAY"
+    assert schema["properties"]["aggregations"]["items"]["type"] == "OBJECT"
@@ -0,0 +1,273 @@
+# File: tracing.py
+# Description: per step spans for the pipeline
+#  records wall time, queue wait, token counts, backend/model, retries and cache hits for every step
+#  spans are written to a local SQLite table and summarized per step and per model
+#
+# Copyright (c) 2025 Michael Powers
+#
+# Usage: not to be run directly
+#   python3 tracing.py                 -> p50/p95/p99 per step and per model
+#   python3 tracing.py --since 2025-07-01 --run <run_id>
+#
+import sqlite3
+import contextvars
+import threading
+import datetime
+import time
+import math
+import argparse
+from contextlib import contextmanager
+
+TRACE_DB_PATH = 'traces.db'
+SPANS_TABLE_NAME = 'pipeline_spans'
+TRACING_ENABLED = True
+
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One pipeline step of one run. LLM calls made while the span is current are added to it.
+    """
+
+    def __init__(self, step, run_id=None, queue_wait=0.0):
+        self.step = step
+        self.run_id = run_id
+        self.queue_wait = queue_wait
+        self.started_at = datetime.datetime.now().isoformat()
+        self.wall_time = 0.0
+        self.backend = None
+        self.model = None
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add_llm_call(self, backend, model, prompt_tokens, completion_tokens, cache_hit=False):
+        with self._lock:
+            self.backend = backend
+            self.model = model
+            self.llm_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            if cache_hit:
+                self.cache_hits += 1
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+
+class TraceStore:
+    """
+    Span table in its own SQLite file, one connection per thread.
+    """
+
+    def __init__(self, db_path=TRACE_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._ensure_table()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    def _ensure_table(self):
+        conn = self._connection()
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SPANS_TABLE_NAME} (
+            run_id TEXT,
+            step TEXT,
+            started_at TEXT,
+            wall_time REAL,
+            queue_wait REAL,
+            backend TEXT,
+            model TEXT,
+            llm_calls INTEGER,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            retries INTEGER,
+            cache_hits INTEGER,
+            error TEXT
+        );
+        """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{SPANS_TABLE_NAME}_step_started ON {SPANS_TABLE_NAME} (step, started_at);")
+        conn.commit()
+
+    def write(self, span):
+        try:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT INTO {SPANS_TABLE_NAME} (run_id, step, started_at, wall_time, queue_wait, backend, model, llm_calls, "
+                f"prompt_tokens, completion_tokens, retries, cache_hits, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (span.run_id, span.step, span.started_at, span.wall_time, span.queue_wait, span.backend, span.model, span.llm_calls,
+                 span.prompt_tokens, span.completion_tokens, span.retries, span.cache_hits, span.error)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing span '{span.step}': {e}")
+
+    def spans(self, since=None, run_id=None):
+        sql = f"SELECT * FROM {SPANS_TABLE_NAME} WHERE 1 = 1"
+        params = []
+        if since is not None:
+            sql += " AND started_at >= ?"
+            params.append(since)
+        if run_id is not None:
+            sql += " AND run_id = ?"
+            params.append(run_id)
+        cursor = self._connection().execute(sql, params)
+        col_names = [description[0] for description in cursor.description]
+        return [dict(zip(col_names, row)) for row in cursor.fetchall()]
+
+
+_TRACE_STORE = None
+_TRACE_STORE_LOCK = threading.Lock()
+
+
+def get_trace_store():
+    global _TRACE_STORE
+    if _TRACE_STORE is None:
+        with _TRACE_STORE_LOCK:
+            if _TRACE_STORE is None:
+                _TRACE_STORE = TraceStore()
+    return _TRACE_STORE
+
+
+@contextmanager
+def span(step, run_id=None, queue_wait=0.0):
+    """
+    Times a pipeline step and writes it to the span table when it ends.
+    Works in threads and in asyncio tasks, the current span is held in a contextvar.
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    current = Span(step, run_id, queue_wait)
+    token = _CURRENT_SPAN.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.wall_time = time.perf_counter() - start
+        _CURRENT_SPAN.reset(token)
+        get_trace_store().write(current)
+
+
+def current_span():
+    return _CURRENT_SPAN.get()
+
+
+def estimate_tokens(text):
+    # rough count (~4 characters per token) for backends that don't report usage, e.g. streamed calls
+    return (len(text) + 3) // 4 if text else 0
+
+
+def token_usage(response):
+    """
+    Returns (prompt_tokens, completion_tokens) reported by an Ollama or Gemini response, or None.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "prompt_token_count", None) is not None:
+        return usage.prompt_token_count, getattr(usage, "candidates_token_count", 0) or 0
+
+    raw = getattr(response, "raw", None)
+    if isinstance(raw, dict) and raw.get("prompt_eval_count") is not None:
+        return raw.get("prompt_eval_count", 0), raw.get("eval_count", 0) or 0
+    return None
+
+
+def record_llm_call(backend, model, prompt, completion, response=None, cache_hit=False):
+    """
+    Adds one LLM call to the current span. Token counts come from the response when the backend
+    reports them, otherwise they are estimated from the text. Cache hits count no tokens.
+    """
+    current = _CURRENT_SPAN.get()
+    if current is None:
+        return
+
+    if cache_hit:
+        current.add_llm_call(backend, model, 0, 0, cache_hit=True)
+        return
+
+    usage = token_usage(response) if response is not None else None
+    if usage is None:
+        usage = (estimate_tokens(prompt), estimate_tokens(completion))
+    current.add_llm_call(backend, model, usage[0], usage[1])
+
+
+def record_retry():
+    current = _CURRENT_SPAN.get()
+    if current is not None:
+        current.add_retry()
+
+
+def percentile(values, pct):
+    # nearest rank
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+
+def summarize(spans, group_by):
+    """
+    Returns group -> {count, p50, p95, p99, avg_queue_wait, avg_prompt_tokens, avg_completion_tokens, retries, cache_hit_rate}.
+    """
+    groups = {}
+    for row in spans:
+        groups.setdefault(group_by(row), []).append(row)
+
+    summary = {}
+    for group, rows in groups.items():
+        wall_times = [row["wall_time"] for row in rows]
+        llm_calls = sum(row["llm_calls"] for row in rows)
+        summary[group] = {
+            "count": len(rows),
+            "p50": percentile(wall_times, 50),
+            "p95": percentile(wall_times, 95),
+            "p99": percentile(wall_times, 99),
+            "total": sum(wall_times),
+            "avg_queue_wait": sum(row["queue_wait"] for row in rows) / len(rows),
+            "avg_prompt_tokens": sum(row["prompt_tokens"] for row in rows) / len(rows),
+            "avg_completion_tokens": sum(row["completion_tokens"] for row in rows) / len(rows),
+            "retries": sum(row["retries"] for row in rows),
+            "cache_hit_rate": sum(row["cache_hits"] for row in rows) / llm_calls if llm_calls else 0.0,
+        }
+    return summary
+
+
+def print_summary(title, summary):
+    print(f"\n{title}")
+    print(f"{'':<32} {'n':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'total':>9} {'wait':>7} {'in tok':>8} {'out tok':>8} {'retry':>6} {'cache':>6}")
+    for group, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+        print(f"{str(group):<32} {stats['count']:>5} {stats['p50']:>7.2f}s {stats['p95']:>7.2f}s {stats['p99']:>7.2f}s "
+              f"{stats['total']:>8.1f}s {stats['avg_queue_wait']:>6.2f}s {stats['avg_prompt_tokens']:>8.0f} "
+              f"{stats['avg_completion_tokens']:>8.0f} {stats['retries']:>6} {stats['cache_hit_rate']:>6.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize pipeline spans per step and per model.")
+    parser.add_argument("--since", help="Only spans started at or after this iso date/time.")
+    parser.add_argument("--run", help="Only spans of this run_id.")
+    args = parser.parse_args()
+
+    spans = get_trace_store().spans(since=args.since, run_id=args.run)
+    if not spans:
+        print("No spans recorded.")
+    else:
+        print_summary("Per step", summarize(spans, lambda row: row["step"]))
+        llm_spans = [row for row in spans if row["model"]]
+        print_summary("Per model", summarize(llm_spans, lambda row: f"{row['backend']}/{row['model']}"))